@@ -0,0 +1,152 @@
+# Admission control, run by the API before it reads an upload.
+#
+# A capture accepted during a spike costs its upload bandwidth and S3 storage right away, and if its job then
+# waits longer than its TTL it expires without ever being looked at. Instead, a capture is turned away while:
+#
+#     - the queues of its lane are backed up: the estimated wait (redis_utils.queue_wait) is over ADMISSION_MAX_WAIT,
+#       or ADMISSION_MAX_QUEUED jobs are already waiting. 503, retry once the backlog is back under budget
+#     - its client is out of tokens: each client has a token bucket refilled at RATE_LIMIT_PER_MINUTE captures a
+#       minute, holding up to RATE_LIMIT_BURST. 429, retry once the tokens it needs are due
+#
+# Both answers carry a Retry-After header with that many seconds.
+#
+#     ratelimit:<client>    hash of a client's tokens and when they were counted, expires once its bucket is full
+#     admission:stats       hash of refusals per reason
+
+from redis_utils import *
+from api_types import *
+
+import redis
+import math
+import os
+
+# ================================================
+#               Admission Settings
+# ================================================
+
+ADMISSION_MAX_WAIT = int(os.environ.get("ADMISSION_MAX_WAIT", 3600)) # Seconds a new job may expect to wait in its queue, 0 disables
+ADMISSION_MAX_QUEUED = int(os.environ.get("ADMISSION_MAX_QUEUED", 1000)) # Jobs waiting per queue, 0 disables
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 60)) # Seconds suggested when the queue's pace is unknown
+
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", 0)) # Captures per client, 0 disables
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 20)) # Captures a client can send at once after a pause
+
+# Where the client's address comes from. Caddy sets X-Forwarded-For, leave it empty when the API isn't behind it
+RATE_LIMIT_CLIENT_HEADER = os.environ.get("RATE_LIMIT_CLIENT_HEADER", "X-Forwarded-For")
+
+# ================================================
+
+STATS_KEY = "admission:stats"
+
+# Refills the bucket for the time since it was last counted, then takes the tokens if there are enough, or
+# anyway when forced (a batch that turned out larger than announced). Redis' own clock, so every API process
+# agrees. Returns whether the tokens were taken and what is left, as a string so Redis doesn't round it
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst, cost, force = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), ARGV[4] == '1'
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'counted_at')
+local tokens = tonumber(bucket[1]) or burst
+local counted_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - counted_at) * rate)
+
+local taken = force or tokens >= cost
+if taken then
+    tokens = tokens - cost
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'counted_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+return {taken and 1 or 0, tostring(tokens)}
+"""
+
+class Refusal:
+    # Why a request was turned away and when trying again makes sense
+    def __init__(self, status: int, reason: str, retry_after: float, message: str):
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.message = message.format(seconds=self.retry_after)
+
+    def headers(self) -> dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+def admit(redis_client: redis.Redis, lanes: list[str], client: str | None, cost: int = 1) -> Refusal | None:
+    # None when cost more captures bound for these lanes may come in from client, counting them against its tokens.
+    # The backlog goes first, so a client isn't charged for captures the server refuses anyway
+    refusal = backlog_refusal(redis_client, get_pcap_queues(redis_client, lanes) + get_ml_queues(redis_client, lanes))
+    if refusal is None and client is not None:
+        refusal = rate_limit_refusal(redis_client, client, cost)
+
+    if refusal is not None:
+        redis_client.hincrby(STATS_KEY, refusal.reason, 1)
+    return refusal
+
+def backlog_refusal(redis_client: redis.Redis, queues: list[Queue]) -> Refusal | None:
+    # Refused while any of the queues is over budget, until the slowest of them drained back under it
+    retry_after = None
+    for queue in queues:
+        queued, workers, average = queue_load(redis_client, queue)
+        wait = queue_wait(queued, workers, average)
+
+        # Without workers the wait can't tell anything, the pool may be scaling up for these very jobs
+        over_wait = ADMISSION_MAX_WAIT > 0 and workers > 0 and wait is not None and wait > ADMISSION_MAX_WAIT
+        over_depth = ADMISSION_MAX_QUEUED > 0 and queued >= ADMISSION_MAX_QUEUED
+        if not over_wait and not over_depth:
+            continue
+
+        # Time for the workers to get through the jobs past the budget, at the pace recent jobs took
+        drain = ADMISSION_RETRY_AFTER
+        if workers > 0 and average is not None:
+            drain = max(wait - ADMISSION_MAX_WAIT if over_wait else 0,
+                        (queued - ADMISSION_MAX_QUEUED + 1) * average / workers if over_depth else 0)
+
+        retry_after = max(retry_after or 0, drain)
+
+    if retry_after is None:
+        return None
+    return Refusal(503, "backlog", retry_after, "The analysis queues are full right now, please try again in {seconds} seconds.")
+
+def rate_limit_refusal(redis_client: redis.Redis, client: str, cost: int = 1) -> Refusal | None:
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return None
+
+    taken, tokens = take_tokens(redis_client, client, cost)
+    if taken:
+        return None
+
+    # Tokens it still needs, at the rate they come back, or a full bucket's worth when it asked for more than that
+    retry_after = (min(cost, RATE_LIMIT_BURST) - tokens) / (RATE_LIMIT_PER_MINUTE / 60)
+    return Refusal(429, "rate_limit", retry_after, "You are sending captures too quickly, please try again in {seconds} seconds.")
+
+def take_tokens(redis_client: redis.Redis, client: str, cost: int = 1, force: bool = False) -> tuple[bool, float]:
+    # Whether client's bucket had cost tokens, and how many are left. With force they are taken regardless,
+    # the bucket going negative makes the client wait until it's paid back
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return True, float(RATE_LIMIT_BURST)
+
+    script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+    taken, tokens = script(keys=[f"ratelimit:{client}"], args=[RATE_LIMIT_PER_MINUTE / 60, RATE_LIMIT_BURST, cost, int(force)])
+    return bool(taken), float(tokens)
+
+def queue_states(redis_client: redis.Redis, queues: list[Queue]) -> list[QueueState]:
+    states = []
+    for queue in queues:
+        queued, workers, average = queue_load(redis_client, queue)
+        wait = queue_wait(queued, workers, average)
+        states.append(QueueState(
+            name=queue.name,
+            lane=queue_lane(queue),
+            queued=queued,
+            workers=workers,
+            job_seconds=average,
+            estimated_wait=wait if wait is not None and math.isfinite(wait) else None,
+            admitting=backlog_refusal(redis_client, [queue]) is None
+        ))
+
+    return states
+
+def admission_stats(redis_client: redis.Redis) -> dict[str, int]:
+    stats = redis_client.hgetall(STATS_KEY)
+    return {reason: int(stats.get(reason.encode(), 0)) for reason in ("backlog", "rate_limit")}
@@ -2,7 +2,6 @@
 # Use ../generate_typescript.sh to transfer these types to the frontend.
 
 from functools import reduce
-from werkzeug.datastructures import FileStorage
 from pydantic import BaseModel
 from typing import Optional
 from uuid import uuid4
@@ -28,6 +27,8 @@ class Stage(BaseModel):
     name: str
     description: Optional[str]
     
+    timings: Optional[dict[str, float]] = None # Seconds spent in each phase, once the stage's job has ended
+    
     def new_cicflowmeter_stage(id: Optional[str] = None):
         return Stage(
             id=id,
@@ -35,12 +36,61 @@ class Stage(BaseModel):
             description="Processing the uploaded pcap with CICFlowMeter-V3 to extract 80+ network flow parameters."
         )
         
+    def new_split_stage(id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name="Splitting PCAP into Shards",
+            description="Cutting the large capture into connection-aligned shards so several workers can extract flows in parallel."
+        )
+        
+    def new_shard_stage(index: int, count: int, id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name=f"Converting Shard {index + 1} of {count}",
+            description="Processing one shard of the capture with CICFlowMeter-V3 to extract its network flows."
+        )
+        
+    def new_merge_stage(id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name="Merging Shard Flows",
+            description="Combining the flows extracted from every shard into a single flow table."
+        )
+        
     def new_ml_stage(id: Optional[str] = None):
         return Stage(
             id=id,
             name="Machine Learning Analysis",
             description="Analyzing the extracted network flow features using machine learning to detect potential threats."
         )
+        
+    def new_cached_stage(id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name="Reusing a Previous Analysis",
+            description="This exact capture was already analyzed by the current model, so its verdict was reused."
+        )
+        
+    def new_ingestion_stage(source: str, id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name="Following Live Traffic",
+            description=f"Extracting flows continuously from {source}, a verdict follows for every window of completed flows."
+        )
+        
+    def new_window_stage(index: int, flows: int, start: str, end: str, id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name=f"Window {index + 1}: {start} to {end}",
+            description=f"Analyzing the {flows} network flows that completed in this window using machine learning."
+        )
+        
+    def new_ingestion_end_stage(id: Optional[str] = None):
+        return Stage(
+            id=id,
+            name="Stopped Following Traffic",
+            description="No more traffic will be analyzed for this assignment."
+        )
     
 class Assignment(BaseModel):
     id: str
@@ -60,11 +110,11 @@ class UploadResponse(BaseModel):
     
     assignment_id: Optional[str]
     
-    def report_success(self, file: FileStorage, file_size: int = 0, assignment_id: Optional[str] = None):
-        self.filename = file.filename
+    def report_success(self, filename: str, file_size: int = 0, assignment_id: Optional[str] = None):
+        self.filename = filename
         self.success = True
         
-        self.filesize = file_size # Getting file size without reading the whole file into memory is tricky
+        self.filesize = file_size
         
         self.message = "File uploaded successfully!"
         
@@ -79,6 +129,40 @@ class UploadResponse(BaseModel):
             assignment_id=assignment_id
         )
         
+class UploadRequest(BaseModel):
+    # Sent by the client to start a direct upload
+    filename: str
+    size: int
+
+class UploadTicket(BaseModel):
+    # One presigned PUT URL, or one per part of a multipart upload (part N is urls[N - 1])
+    upload_id: str
+    multipart: bool
+    part_size: int
+    urls: list[str]
+    
+    def new(upload_id: str, urls: list[str], part_size: int, multipart: bool = False):
+        return UploadTicket(upload_id=upload_id, multipart=multipart, part_size=part_size, urls=urls)
+
+class UploadedPart(BaseModel):
+    part_number: int
+    etag: str
+
+class UploadCompletion(BaseModel):
+    # Sent by the client once every part is in S3, parts are left empty for single PUT uploads
+    parts: list[UploadedPart] = []
+
+class PendingUpload(BaseModel):
+    # Server side record of a direct upload between its ticket and its completion
+    id: str
+    filename: str
+    s3_key: str
+    s3_upload_id: Optional[str]
+    
+    def new(filename: str, s3_upload_id: Optional[str] = None, id: Optional[str] = None):
+        id = id or str(uuid4())
+        return PendingUpload(id=id, filename=filename, s3_key=f"uploads/{id}.pcap", s3_upload_id=s3_upload_id)
+
 class JobResult(BaseModel):
     success: bool
     message: Optional[str]
@@ -123,10 +207,84 @@ class HealthCheckResult(JobResult):
     def new(health: Health, success=False, message: Optional[str] = None):
         return HealthCheckResult(success=success, message=message, health=health)
     
+class AssignmentEvent(BaseModel):
+    # Pushed to clients streaming an assignment's progress, see event_server.py
+    assignment_id: str
+    job_id: Optional[str]
+    status: str # The job's RQ status: queued, deferred, finished or failed
+    stage: Optional[Stage]
+    result: Optional[JobResult | MLJobResult]
+    final: bool # Nothing else will happen to this assignment
+    
+    def new(assignment_id: str, job_id: Optional[str], status: str, stage: Optional[Stage] = None, 
+            result: Optional[JobResult | MLJobResult] = None, final: bool = False):
+        return AssignmentEvent(assignment_id=assignment_id, job_id=job_id, status=status, stage=stage, result=result, final=final)
+    
 class JobResponse(BaseModel):
     id: str
     status: str
     queue: str
     enqeued_at: Optional[str]
     ended_at: Optional[str]
-    result: Optional[JobResult | MLJobResult]
\ No newline at end of file
+    result: Optional[JobResult | MLJobResult]
+
+class AssignmentStatus(BaseModel):
+    # An assignment with the current state of each stage's job, None where the job has expired
+    assignment: Assignment
+    jobs: list[Optional[JobResponse]]
+
+class AssignmentsResponse(BaseModel):
+    # Same order as the requested IDs, None for assignments that don't exist
+    assignments: list[Optional[AssignmentStatus]]
+
+class BatchMember(BaseModel):
+    # One capture of a batch, with its assignment, or the reason it has none
+    filename: str
+    assignment_id: Optional[str]
+    message: Optional[str]
+    
+    def new(filename: str, assignment_id: Optional[str] = None, message: Optional[str] = None):
+        return BatchMember(filename=filename, assignment_id=assignment_id, message=message)
+
+class Batch(BaseModel):
+    id: str
+    members: list[BatchMember]
+    
+    def new(members: list[BatchMember], new_id: str | None = None):
+        return Batch(id=new_id or str(uuid4()), members=members)
+
+class BatchResponse(BaseModel):
+    success: bool
+    message: Optional[str]
+    batch: Optional[Batch]
+    
+    def new(success: bool = False, message: Optional[str] = None, batch: Optional[Batch] = None):
+        return BatchResponse(success=success, message=message, batch=batch)
+
+class BatchMemberStatus(BaseModel):
+    filename: str
+    assignment_id: Optional[str]
+    status: str # queued, started, finished, failed, expired, or skipped when the capture has no assignment
+    prediction: Optional[Prediction]
+    message: Optional[str]
+
+class BatchStatus(BaseModel):
+    # A batch at a glance, for polling until done instead of following every assignment
+    id: str
+    counts: dict[str, int] # Captures per status
+    predictions: dict[str, int] # Finished captures per verdict
+    done: bool # Nothing else will happen to any capture of the batch
+    members: list[BatchMemberStatus]
+
+class QueueState(BaseModel):
+    name: str
+    lane: str
+    queued: int
+    workers: int
+    job_seconds: Optional[float] # Moving average of how long its jobs run, None before any ended
+    estimated_wait: Optional[float] # Seconds until a job enqueued now would start, None when unknown or without workers
+    admitting: bool # Whether uploads bound for this queue are accepted, see admission.py
+
+class QueuesResponse(BaseModel):
+    queues: list[QueueState]
+    refusals: dict[str, int] # Uploads turned away so far, per reason
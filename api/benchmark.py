@@ -0,0 +1,496 @@
+# Throughput and latency benchmarks for the whole pipeline and its hot spots, written as JSON so runs on
+# different commits can be compared.
+#
+#     python3 benchmark.py --fake                          Redis and S3 replaced by local stand-ins, nothing else needed
+#     python3 benchmark.py                                 against the Redis and S3 configured in the environment
+#     python3 benchmark.py --fake --output before.json     then, on another commit: --compare before.json
+#
+# Synthetic captures (random TCP conversations) and synthetic CSE-CIC-IDS2018 flow tables stand in for real
+# traffic, and a small random forest trained on synthetic flows stands in for the model unless RF_MODEL_PATH is set.
+# The pipeline runs for real: uploads go through the Flask app, jobs through RQ workers forked by this script
+# (stop any other workers on the same Redis first). Only CICFlowMeter is mocked by default, see --extractor.
+
+import io, os, sys, json, time, shutil, struct, socket, tempfile, argparse, threading, subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+# ======== Synthetic data ========
+
+# Byte offsets of the fields we fill in an Ethernet + IPv4 + TCP packet, behind its 16 byte pcap record header
+PACKET_FIELDS = {
+    "ts_sec": ("<u4", 0), "ts_usec": ("<u4", 4), "incl_len": ("<u4", 8), "orig_len": ("<u4", 12),
+    "ethertype": (">u2", 28), "version_ihl": ("u1", 30), "ip_len": (">u2", 32), "ip_flags": (">u2", 36),
+    "ttl": ("u1", 38), "protocol": ("u1", 39), "src": (">u4", 42), "dst": (">u4", 46),
+    "sport": (">u2", 50), "dport": (">u2", 52), "seq": (">u4", 54), "ack": (">u4", 58),
+    "data_offset": ("u1", 62), "tcp_flags": ("u1", 63), "window": (">u2", 64),
+}
+
+def synthetic_pcap(path: str, size_mb: float, seed: int = 0, packets_per_flow: int = 20, payload: int = 200) -> int:
+    # Writes roughly size_mb of TCP conversations (handshake, data both ways, FIN) and returns the packet count
+    rng = np.random.default_rng(seed)
+    record_size = 16 + 54 + payload
+    flows = max(1, int(size_mb * 1024 * 1024) // record_size // packets_per_flow)
+    packets = flows * packets_per_flow
+
+    flow = np.repeat(np.arange(flows), packets_per_flow)
+    position = np.tile(np.arange(packets_per_flow), flows)
+    forward = position % 2 == 0
+
+    client = rng.integers(0x0A000001, 0x0AFFFFFE, flows, dtype=np.uint32)[flow]
+    server = rng.integers(0xC0A80001, 0xC0A8FFFE, flows, dtype=np.uint32)[flow]
+    client_port = rng.integers(1024, 65535, flows)[flow]
+    server_port = rng.choice([22, 53, 80, 443, 3389, 8080], flows)[flow]
+
+    # Flows start over a minute, packets follow each other within milliseconds
+    gaps = rng.exponential(0.005, (flows, packets_per_flow)).cumsum(axis=1).ravel()
+    timestamps = 1_700_000_000 + rng.uniform(0, 60, flows)[flow] + gaps
+
+    flags = np.full(packets, 0x18, dtype=np.uint8) # PSH ACK
+    flags[position == 0] = 0x02 # SYN
+    flags[position == 1] = 0x12 # SYN ACK
+    flags[position == packets_per_flow - 1] = 0x11 # FIN ACK
+
+    names = list(PACKET_FIELDS)
+    records = np.zeros(packets, dtype=np.dtype({
+        "names": names,
+        "formats": [PACKET_FIELDS[name][0] for name in names],
+        "offsets": [PACKET_FIELDS[name][1] for name in names],
+        "itemsize": record_size,
+    }))
+
+    records["ts_sec"] = timestamps.astype(np.uint32)
+    records["ts_usec"] = ((timestamps % 1) * 1e6).astype(np.uint32)
+    records["incl_len"] = records["orig_len"] = 54 + payload
+    records["ethertype"] = 0x0800
+    records["version_ihl"] = 0x45
+    records["ip_len"] = 40 + payload
+    records["ip_flags"] = 0x4000 # Don't fragment
+    records["ttl"] = 64
+    records["protocol"] = 6
+    records["src"] = np.where(forward, client, server)
+    records["dst"] = np.where(forward, server, client)
+    records["sport"] = np.where(forward, client_port, server_port)
+    records["dport"] = np.where(forward, server_port, client_port)
+    records["seq"] = position * payload
+    records["ack"] = position * payload
+    records["data_offset"] = 0x50
+    records["tcp_flags"] = flags
+    records["window"] = 65535
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)) # Microsecond pcap, Ethernet
+        f.write(records[np.argsort(timestamps, kind="stable")].tobytes())
+
+    return packets
+
+def feature_columns() -> list[str]:
+    from flow_extractor import FLOW_COLUMNS
+    return [column for column in FLOW_COLUMNS if column != "Timestamp"]
+
+def synthetic_flows(rows: int, seed: int = 0, duplicates: float = 0.0) -> pd.DataFrame:
+    # Flow table with CICFlowMeter's columns. duplicates is the share of rows copied from a few common flows,
+    # the way DNS lookups and health checks repeat in real traffic
+    rng = np.random.default_rng(seed)
+    columns = feature_columns()
+
+    values = rng.lognormal(3, 2, (rows, len(columns))).round(3)
+    values[:, columns.index("Dst Port")] = rng.choice([22, 53, 80, 443, 3389, 8080], rows)
+    values[:, columns.index("Protocol")] = rng.choice([6, 17], rows)
+
+    repeated = rng.random(rows) < duplicates
+    values[repeated] = values[rng.integers(0, min(rows, 100), repeated.sum())]
+
+    frame = pd.DataFrame(values, columns=columns)
+    frame.insert(2, "Timestamp", "01/01/2024 00:00:00")
+    return frame
+
+def synthetic_model(path: str, trees: int, seed: int = 0) -> str:
+    # Same bundle layout as ml/train_rf.py, fitted on synthetic flows with a made up notion of malicious
+    import joblib
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    columns = feature_columns()
+    flows = synthetic_flows(20_000, seed)[columns]
+    labels = np.where(flows["Flow Pkts/s"] > flows["Flow Pkts/s"].median(), "Malicious", "Benign")
+
+    model = make_pipeline(StandardScaler(), RandomForestClassifier(n_estimators=trees, n_jobs=-1, random_state=seed))
+    model.fit(flows, labels)
+    joblib.dump({"model": model, "feature_names": columns, "target_col": "Label"}, path)
+    return path
+
+# ======== Stand-ins ========
+
+class DirectoryS3:
+    # The boto3 client calls the pipeline makes, on a local directory, so forked workers share the objects
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, bucket: str, key: str) -> str:
+        path = os.path.join(self.root, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _missing(self, operation: str):
+        from botocore.exceptions import ClientError
+        return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+    def upload_file(self, filename, bucket, key, **kwargs):
+        shutil.copyfile(filename, self._path(bucket, key))
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        with open(self._path(bucket, key), "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+    def download_file(self, bucket, key, filename, **kwargs):
+        if not os.path.exists(self._path(bucket, key)):
+            raise self._missing("HeadObject")
+        shutil.copyfile(self._path(bucket, key), filename)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        if not os.path.exists(self._path(Bucket, Key)):
+            raise self._missing("GetObject")
+        with open(self._path(Bucket, Key), "rb") as f:
+            data = f.read()
+
+        if Range is not None: # "bytes=<first>-<last>" or "bytes=-<suffix length>"
+            first, last = Range.removeprefix("bytes=").split("-")
+            data = data[int(first):int(last) + 1] if first else data[-int(last):]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if not os.path.exists(self._path(Bucket, Key)):
+            raise self._missing("HeadObject")
+        stat = os.stat(self._path(Bucket, Key))
+        return {"ContentLength": stat.st_size, "LastModified": datetime.fromtimestamp(stat.st_mtime, timezone.utc)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        if os.path.exists(self._path(Bucket, Key)):
+            os.remove(self._path(Bucket, Key))
+
+    def head_bucket(self, **kwargs):
+        return {}
+
+    def list_buckets(self):
+        return {"Buckets": [{"Name": name} for name in os.listdir(self.root)]}
+
+    def create_bucket(self, Bucket, **kwargs):
+        os.makedirs(os.path.join(self.root, Bucket), exist_ok=True)
+
+    def get_bucket_lifecycle_configuration(self, **kwargs):
+        return {"Rules": []}
+
+    def put_bucket_lifecycle_configuration(self, **kwargs):
+        pass
+
+def start_fake_redis() -> tuple[object, int]:
+    # fakeredis speaking the Redis protocol on a local port, so forked workers can reach it like a real server
+    from fakeredis import TcpFakeServer
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    server = TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # fakeredis has no INFO, which rq sends once per connection for the server version, and closes the
+    # connection on it. rq caches the answer on the client, so answer for it on every client
+    import redis
+    setattr(redis.Redis, "__rq_redis_server_version", (7, 4, 0))
+
+    return server, port
+
+def use_directory_s3(root: str):
+    # Every S3 client the pipeline creates, in this process and forked ones, becomes the directory store
+    import s3_utils, utils
+
+    store = DirectoryS3(root)
+    s3_utils.new_s3_client = utils.new_s3_client = lambda *args, **kwargs: store
+    s3_utils._s3_clients.clear()
+
+def mock_extractor(template_csv: str):
+    # CICFlowMeter replaced by copying a pre-made flow CSV, so the numbers don't depend on the JVM
+    import run_cicflowmeter
+
+    def extract_flows(pcap_directory: str, output_directory: str, engine: str = "mock", format: str = "csv"):
+        shutil.copyfile(template_csv, os.path.join(output_directory, "flows.csv"))
+
+    run_cicflowmeter.extract_flows = extract_flows
+
+# ======== Measuring ========
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    if not samples:
+        return {}
+
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {"p50": round(float(p50), 4), "p95": round(float(p95), 4), "p99": round(float(p99), 4),
+            "mean": round(float(np.mean(samples)), 4), "max": round(float(np.max(samples)), 4)}
+
+def measure(func, repeat: int) -> dict[str, float]:
+    # Best and median of repeat runs, in seconds
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+
+    return {"best": round(min(samples), 4), "median": round(float(np.median(samples)), 4)}
+
+def microbenchmarks(work_directory: str, rows: int, duplicates: float, repeat: int) -> dict:
+    import run_ml
+    from flow_format import csv_to_flows
+
+    csv_path = os.path.join(work_directory, "micro.csv")
+    npz_path = os.path.join(work_directory, "micro.npz")
+    synthetic_flows(rows, seed=1, duplicates=duplicates).to_csv(csv_path, index=False)
+    csv_to_flows(csv_path, npz_path)
+
+    results = {"rows": rows, "duplicates": duplicates}
+
+    def load_model():
+        run_ml._model_bundle = None # Load from disk every time
+        return run_ml.load_model_bundle()
+
+    results["model_load"] = measure(load_model, repeat)
+    bundle = run_ml.load_model_bundle()
+    model, feature_names = bundle["model"], bundle["feature_names"]
+
+    frame = pd.read_csv(csv_path)
+    results["read_csv"] = measure(lambda: pd.read_csv(csv_path), repeat)
+    results["prepare_features"] = measure(lambda: run_ml.prepare_features(frame, feature_names), repeat)
+    results["iter_flow_features_csv"] = measure(lambda: list(run_ml.iter_flow_features(csv_path, feature_names)), repeat)
+    results["iter_flow_features_npz"] = measure(lambda: list(run_ml.iter_flow_features(npz_path, feature_names)), repeat)
+
+    X, _ = run_ml.prepare_features(frame, feature_names)
+    results["predict"] = measure(lambda: model.predict(X), repeat)
+    results["predict_cached_cold"] = measure(lambda: run_ml.PredictionCache(model).predict(X), repeat)
+
+    warm = run_ml.PredictionCache(model)
+    warm.predict(X)
+    results["predict_cached_warm"] = measure(lambda: warm.predict(X), repeat)
+
+    results["predict_rows_per_second"] = round(rows / results["predict"]["median"])
+    return results
+
+# ======== Pipeline ========
+
+def run_worker():
+    # Forked worker process, serving both queues like a small deployment would
+    from redis_utils import get_redis_client, get_pcap_queues, get_ml_queues, SimpleWeightedLaneWorker
+
+    REDIS = get_redis_client()
+    SimpleWeightedLaneWorker(get_pcap_queues(REDIS) + get_ml_queues(REDIS), connection=REDIS).work(logging_level="WARNING")
+
+def wait_for_assignments(REDIS, assignments: dict[str, float], timeout: float) -> dict[str, float]:
+    # Seconds from the start of each upload until its final event (see redis_utils.publish_assignment_event)
+    from api_types import AssignmentEvent
+    from redis_utils import assignment_events_key
+
+    finished: dict[str, float] = {}
+    deadline = time.monotonic() + timeout
+    while len(finished) < len(assignments) and time.monotonic() < deadline:
+        pending = [id for id in assignments if id not in finished]
+        with REDIS.pipeline(transaction=False) as pipeline:
+            for id in pending:
+                pipeline.xrevrange(assignment_events_key(id), count=1)
+            latest = pipeline.execute()
+
+        for id, events in zip(pending, latest):
+            if events and AssignmentEvent.model_validate_json(events[0][1][b"data"]).final:
+                event_time = int(events[0][0].decode().split("-")[0]) / 1000 # Stream IDs start with the time in ms
+                finished[id] = event_time - assignments[id]
+
+        time.sleep(0.05)
+
+    return finished
+
+def pipeline_benchmark(work_directory: str, concurrency: int, assignments: int, workers: int, pcap_mb: float, timeout: float) -> dict:
+    import main
+    from redis_utils import get_redis_client, get_assignments
+    from rq.job import Job
+
+    captures = []
+    for index in range(assignments):
+        path = os.path.join(work_directory, f"capture-{concurrency}-{index}.pcap")
+        synthetic_pcap(path, pcap_mb, seed=concurrency * 100_000 + index) # Distinct captures, no verdict cache hits
+        captures.append(path)
+
+    client_local = threading.local()
+    started_at: dict[str, float] = {}
+    upload_latency: list[float] = []
+
+    def upload(path: str):
+        if not hasattr(client_local, "client"):
+            client_local.client = main.app.test_client()
+
+        started_wall, started = time.time(), time.perf_counter()
+        with open(path, "rb") as f:
+            response = client_local.client.post("/upload", data={"file": (f, os.path.basename(path))}, content_type="multipart/form-data")
+        upload_latency.append(time.perf_counter() - started)
+
+        body = json.loads(response.data)
+        if body.get("assignment_id"):
+            started_at[body["assignment_id"]] = started_wall
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, captures))
+
+    REDIS = get_redis_client()
+    end_to_end = wait_for_assignments(REDIS, started_at, timeout)
+    elapsed = time.perf_counter() - started
+
+    # Only jobs a worker ran, cached verdicts and the ML stage of fused jobs are recorded as finished right away
+    stage_ids = [stage.id for assignment in get_assignments(REDIS, list(end_to_end)) if assignment is not None
+                 for stage in assignment.stages if stage.id is not None]
+    jobs = sum(not job.meta.get("replayed") for job in Job.fetch_many(stage_ids, connection=REDIS) if job is not None)
+
+    return {
+        "concurrency": concurrency,
+        "assignments": assignments,
+        "completed": len(end_to_end),
+        "workers": workers,
+        "upload_seconds": percentiles(upload_latency),
+        "end_to_end_seconds": percentiles(list(end_to_end.values())),
+        "assignments_per_second": round(len(end_to_end) / elapsed, 3),
+        "jobs_per_second_per_worker": round(jobs / elapsed / workers, 3),
+    }
+
+# ======== Reporting ========
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        elif isinstance(value, list):
+            for entry in value:
+                flat.update(flatten(entry, f"{prefix}{name}[concurrency={entry.get('concurrency')}]."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+def compare(current: dict, baseline: dict):
+    # Change of every number both runs have, times are better lower and rates better higher
+    ours, theirs = flatten(current["results"]), flatten(baseline["results"])
+    print(f"\nCompared with {baseline.get('commit', '?')[:10]} ({baseline.get('created', '?')}):")
+    if not ours.keys() & theirs.keys():
+        print("    Nothing in common, were both runs made with the same --skip options?")
+    for name in sorted(ours.keys() & theirs.keys()):
+        if theirs[name]:
+            print(f"    {name}: {theirs[name]} -> {ours[name]} ({(ours[name] - theirs[name]) / theirs[name]:+.1%})")
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upload -> flows -> ML pipeline and its hot spots.")
+    parser.add_argument("--fake", action="store_true", help="Use fakeredis and a directory instead of Redis and S3")
+    parser.add_argument("--extractor", choices=["mock", "native", "cicflowmeter"], default="mock",
+                        help="Flow extraction in the pipeline: copy a synthetic CSV (default), or a real engine")
+    parser.add_argument("--concurrency", default="1,4,8", help="Comma separated numbers of simultaneous uploads")
+    parser.add_argument("--assignments", type=int, default=20, help="Captures uploaded per concurrency level")
+    parser.add_argument("--workers", type=int, default=2, help="RQ worker processes serving both queues")
+    parser.add_argument("--pcap-mb", type=float, default=1, help="Size of every synthetic capture")
+    parser.add_argument("--flows", type=int, default=5_000, help="Flows per capture when the extractor is mocked")
+    parser.add_argument("--micro-rows", type=int, default=100_000, help="Flow rows used by the microbenchmarks")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Share of repeated flows in the synthetic flow tables")
+    parser.add_argument("--trees", type=int, default=100, help="Trees of the synthetic model, when RF_MODEL_PATH isn't set")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every microbenchmark")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the assignments of one level")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    work_directory = tempfile.mkdtemp(prefix="benchmark-")
+
+    # ======== Settings read at import time go first ========
+
+    if args.fake:
+        server, port = start_fake_redis()
+        os.environ["REDIS_HOST"], os.environ["REDIS_PORT"] = "127.0.0.1", str(port)
+        os.environ.pop("REDIS_PASSWORD", None)
+    if args.extractor != "mock":
+        os.environ["FLOW_EXTRACTOR"] = args.extractor
+    if "RF_MODEL_PATH" not in os.environ:
+        print(f"Training a {args.trees} tree model on synthetic flows...")
+        os.environ["RF_MODEL_PATH"] = synthetic_model(os.path.join(work_directory, "model.joblib"), args.trees)
+        os.environ["ML_ENGINE"] = "sklearn"
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.fake:
+        use_directory_s3(os.path.join(work_directory, "s3"))
+    if args.extractor == "mock":
+        template_csv = os.path.join(work_directory, "template.csv")
+        synthetic_flows(args.flows, seed=2, duplicates=args.duplicates).to_csv(template_csv, index=False)
+        mock_extractor(template_csv)
+
+    import run_ml
+    from utils import start_health_monitor
+
+    start_health_monitor() # Forked workers start from this result instead of probing
+    run_ml.load_model_bundle() # Loaded once and shared with the workers
+
+    results = {}
+    if not args.skip_micro:
+        print(f"Microbenchmarks on {args.micro_rows} flows...")
+        results["micro"] = microbenchmarks(work_directory, args.micro_rows, args.duplicates, args.repeat)
+        print(json.dumps(results["micro"], indent=4))
+
+    if not args.skip_pipeline:
+        import multiprocessing
+        processes = [multiprocessing.get_context("fork").Process(target=run_worker, daemon=True) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+
+        results["pipeline"] = []
+        try:
+            for concurrency in [int(level) for level in args.concurrency.split(",")]:
+                print(f"Pipeline: {args.assignments} captures of {args.pcap_mb} MB, {concurrency} at a time, {args.workers} workers...")
+                level = pipeline_benchmark(work_directory, concurrency, args.assignments, args.workers, args.pcap_mb, args.timeout)
+                results["pipeline"].append(level)
+                print(json.dumps(level, indent=4))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join(5)
+                if process.is_alive():
+                    process.kill()
+
+    report = {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": vars(args),
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    shutil.rmtree(work_directory, ignore_errors=True)
+    if args.fake:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Captures as they are uploaded: pcap or pcapng, raw or compressed with gzip or zstd (sensors ship rotated
+# .pcap.gz and .pcap.zst files). The format is told from the leading bytes, never from the file name.
+#
+# Compressed captures are stored as uploaded. The pcap workers decompress them while they stream out of S3,
+# so only the raw capture the extractor needs is written to local disk, never the compressed copy as well.
+
+from flow_extractor import CaptureFormatError, PCAP_MAGIC, PCAPNG_MAGIC
+
+from typing import BinaryIO, Iterator
+import zipfile
+import tarfile
+import boto3
+import shutil
+import gzip
+import zlib
+import os
+
+try:
+    import zstandard
+except ImportError: # Only needed for .zst captures
+    zstandard = None
+
+# ================================================
+#                Capture Settings
+# ================================================
+
+# Assumed ratio between a compressed capture and the raw one when the file doesn't state its own size,
+# only used to pick the queue lane, sharding and fused extraction
+CAPTURE_COMPRESSION_RATIO = float(os.environ.get("CAPTURE_COMPRESSION_RATIO", 5))
+
+# ================================================
+
+GZIP, ZSTD = "gzip", "zstd"
+COMPRESSION_MAGIC = {GZIP: b"\x1f\x8b", ZSTD: b"\x28\xb5\x2f\xfd"}
+COMPRESSION_SUFFIX = {None: "", GZIP: ".gz", ZSTD: ".zst"}
+
+HEAD_BYTES = 18 # Longest zstd frame header, which may carry the raw size
+TAIL_BYTES = 4  # gzip's trailer ends with the raw size modulo 2^32
+COPY_CHUNK = 1024 * 1024
+
+# Corrupt or truncated compressed data, as opposed to failing to write the raw capture
+DECOMPRESSION_ERRORS = (gzip.BadGzipFile, zlib.error, EOFError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Archives of captures, submitted to /batches
+TAR, ZIP = "tar", "zip"
+ZIP_MAGIC = b"PK\x03\x04"
+TAR_MAGIC_OFFSET = 257 # ustar header field of the first member
+ARCHIVE_HEAD_BYTES = 4096 # Enough of a .tar.gz to decompress the first member's header
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipFile, zlib.error, EOFError)
+
+def detect_compression(head: bytes) -> str | None:
+    return next((name for name, magic in COMPRESSION_MAGIC.items() if head.startswith(magic)), None)
+
+def is_capture(head: bytes) -> bool:
+    # Compressed files are taken on trust, the pcap worker rejects them if there is no capture inside
+    return detect_compression(head) is not None or head[:4] in PCAP_MAGIC or head.startswith(PCAPNG_MAGIC)
+
+def detect_archive(head: bytes) -> str | None:
+    # A tar (plain or gzip compressed) or zip archive of captures, rather than a capture
+    if head.startswith(ZIP_MAGIC):
+        return ZIP
+
+    if detect_compression(head) == GZIP:
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, TAR_MAGIC_OFFSET + 5)
+        except zlib.error:
+            return None
+
+    return TAR if head[TAR_MAGIC_OFFSET:TAR_MAGIC_OFFSET + 5] == b"ustar" else None
+
+def archive_members(stream: BinaryIO, archive: str) -> Iterator[tuple[str, BinaryIO]]:
+    # Name and contents of every file in the archive, in order. A tar is read front to back, so it can come
+    # straight from the request body. A zip keeps its index at the end, its stream has to be seekable
+    if archive == ZIP:
+        with zipfile.ZipFile(stream) as zip:
+            for info in zip.infolist():
+                if not info.is_dir():
+                    with zip.open(info) as member:
+                        yield info.filename, member
+        return
+
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for info in tar:
+            if info.isfile():
+                yield info.name, tar.extractfile(info)
+
+def decompressed_size(compression: str | None, size: int, head: bytes, tail: bytes) -> int:
+    # Size of the raw capture, read from the compressed file's own headers where it has one, estimated otherwise
+    if compression == GZIP and len(tail) == TAIL_BYTES:
+        raw = int.from_bytes(tail, "little")
+        if raw >= size:
+            return raw
+        # The trailer wrapped around 4 GiB, the raw capture is at least as large as the compressed one
+        return raw + (size - raw + 2 ** 32 - 1) // 2 ** 32 * 2 ** 32
+
+    if compression == ZSTD and zstandard is not None:
+        try:
+            raw = zstandard.frame_content_size(head)
+            if raw >= size: # Only the first frame's size when there are several, it can't be the whole capture then
+                return raw
+        except zstandard.ZstdError:
+            pass # Not enough of the frame header to tell
+
+    if compression is not None:
+        return int(size * CAPTURE_COMPRESSION_RATIO)
+
+    return size
+
+def inspect_upload(stream: BinaryIO, size: int) -> tuple[str | None, int]:
+    # Compression and raw size of a seekable upload, which is rewound afterwards
+    stream.seek(0)
+    head = stream.read(HEAD_BYTES)
+    stream.seek(max(0, size - TAIL_BYTES))
+    tail = stream.read(TAIL_BYTES)
+    stream.seek(0)
+
+    compression = detect_compression(head)
+    return compression, decompressed_size(compression, size, head, tail)
+
+def inspect_object(s3_client: boto3.client, bucket_name: str, key: str, size: int) -> tuple[str | None, int]:
+    # Same as inspect_upload for a capture already in S3, from two small ranged reads
+    head = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{HEAD_BYTES - 1}")["Body"].read()
+    compression = detect_compression(head)
+
+    tail = b""
+    if compression == GZIP:
+        tail = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=-{TAIL_BYTES}")["Body"].read()
+
+    return compression, decompressed_size(compression, size, head, tail)
+
+def decompress(source: BinaryIO, destination: BinaryIO, compression: str):
+    if compression == GZIP:
+        with gzip.GzipFile(fileobj=source, mode="rb") as reader:
+            shutil.copyfileobj(reader, destination, COPY_CHUNK)
+        return
+
+    if zstandard is None:
+        raise CaptureFormatError("zstd compressed captures need the zstandard package")
+
+    # zstandard's stream readers end quietly at a truncated frame, decompression objects tell when a frame is
+    # complete. Streaming compressors (zstd -, pzstd) write several frames, each gets its own object
+    decompressor = None
+    while chunk := source.read(COPY_CHUNK):
+        while chunk:
+            if decompressor is None or decompressor.eof:
+                decompressor = zstandard.ZstdDecompressor().decompressobj()
+            destination.write(decompressor.decompress(chunk))
+            chunk = decompressor.unused_data if decompressor.eof else b""
+
+    if decompressor is None or not decompressor.eof:
+        raise CaptureFormatError("The zstd capture is truncated")
+
+def capture_filename(key: str) -> str:
+    # Local name of a capture once decompressed, with the compression's suffix dropped
+    name = os.path.basename(key)
+    for suffix in COMPRESSION_SUFFIX.values():
+        if suffix and name.endswith(suffix):
+            return name.removesuffix(suffix)
+    return name
+
+def download_capture(s3_client: boto3.client, bucket_name: str, key: str, filename: str):
+    # Download a capture as a raw pcap/pcapng, decompressing it on the way when needed
+    head = s3_client.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{HEAD_BYTES - 1}")["Body"].read()
+    compression = detect_compression(head)
+
+    if compression is None:
+        s3_client.download_file(bucket_name, key, filename) # Parallel ranged reads, nothing to decompress
+        return
+
+    body = s3_client.get_object(Bucket=bucket_name, Key=key)["Body"]
+    try:
+        with open(filename, "wb") as f:
+            decompress(body, f, compression)
+    except DECOMPRESSION_ERRORS as e:
+        raise CaptureFormatError(f"Could not decompress the {compression} capture: {e}")
+    finally:
+        body.close()
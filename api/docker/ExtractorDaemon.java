@@ -0,0 +1,52 @@
+package cic.cs.unb.ca.ifm;
+
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+
+// Resident wrapper around CICFlowMeter's Cmd entry point, driven by ../extractor_daemon.py.
+// Keeping the JVM alive between jobs avoids paying for Gradle and JVM startup on every pcap.
+//
+// Protocol (one request per line on stdin, one answer per line on stdout):
+//     PING                          -> PONG
+//     <pcap path>\t<output folder>  -> OK | ERR <message>
+//
+// Anything CICFlowMeter prints itself is redirected to stderr so it can't corrupt the protocol.
+public class ExtractorDaemon {
+    public static void main(String[] args) throws IOException {
+        PrintStream protocol = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        System.setOut(System.err);
+
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        protocol.println("READY");
+
+        String line;
+        while ((line = requests.readLine()) != null) {
+            line = line.trim();
+            if (line.isEmpty())
+                continue;
+
+            if (line.equals("PING")) {
+                protocol.println("PONG");
+                continue;
+            }
+
+            String[] paths = line.split("\t");
+            if (paths.length != 2) {
+                protocol.println("ERR malformed request");
+                continue;
+            }
+
+            try {
+                Cmd.main(new String[] { paths[0], paths[1] });
+                protocol.println("OK");
+            } catch (Throwable t) {
+                protocol.println("ERR " + String.valueOf(t).replace('\n', ' '));
+            }
+        }
+    }
+}
@@ -0,0 +1,155 @@
+# Streams assignment progress to clients as server-sent events, so they don't have to poll /assignment and /job.
+#
+# GET /assignment/<id>/events replays the assignment's event stream (from Last-Event-ID when reconnecting),
+# then forwards new events as the workers publish them (see redis_utils.publish_assignment_event).
+# One Redis pattern subscription per process feeds every connection, so an idle client costs an asyncio
+# queue and a socket instead of a Redis connection.
+
+from redis_utils import *
+
+from aiohttp import web
+import redis.asyncio
+import asyncio, json, re, uuid
+
+# ================================================
+#                Event Server Settings
+# ================================================
+
+EVENTS_PORT = int(os.environ.get("EVENTS_PORT", 5001))
+EVENTS_KEEPALIVE = int(os.environ.get("EVENTS_KEEPALIVE", 15)) # Seconds between comments that keep proxies from closing idle streams
+EVENTS_RETRY_MS = int(os.environ.get("EVENTS_RETRY_MS", 3000)) # How long browsers wait before reconnecting
+
+# ================================================
+
+STREAM_ID = re.compile(r"^\d+-\d+$")
+
+def stream_position(event_id: str) -> tuple[int, int]:
+    milliseconds, sequence = event_id.split("-")
+    return int(milliseconds), int(sequence)
+
+class EventHub:
+    # Fans the single pattern subscription out to every open stream of the matching assignment.
+    # A None in a queue means the subscription dropped, so the stream should catch up from Redis.
+
+    def __init__(self, client: redis.asyncio.Redis):
+        self.client = client
+        self.listeners: dict[str, set[asyncio.Queue]] = {}
+
+    def listen(self, assignment_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.listeners.setdefault(assignment_id, set()).add(queue)
+        return queue
+
+    def forget(self, assignment_id: str, queue: asyncio.Queue):
+        queues = self.listeners.get(assignment_id)
+        if queues is None:
+            return
+
+        queues.discard(queue)
+        if not queues:
+            del self.listeners[assignment_id]
+
+    async def run(self):
+        while True:
+            try:
+                async with self.client.pubsub() as pubsub:
+                    await pubsub.psubscribe(assignment_events_key("*"))
+
+                    # Anything published while we were disconnected is only in the streams now
+                    for queues in self.listeners.values():
+                        for queue in queues:
+                            queue.put_nowait(None)
+
+                    async for message in pubsub.listen():
+                        if message["type"] != "pmessage":
+                            continue
+
+                        assignment_id = message["channel"].decode().split(":")[1]
+                        for queue in self.listeners.get(assignment_id, ()):
+                            queue.put_nowait(json.loads(message["data"]))
+            except (redis.exceptions.RedisError, OSError) as e:
+                print(f"[events] Lost the Redis subscription ({e}), reconnecting")
+                await asyncio.sleep(1)
+
+REDIS_CLIENT = web.AppKey("redis", redis.asyncio.Redis)
+HUB = web.AppKey("hub", EventHub)
+HUB_TASK = web.AppKey("hub_task", asyncio.Task)
+
+async def stream_events(request: web.Request) -> web.StreamResponse:
+    assignment_id = request.match_info["assignment_id"]
+    try:
+        uuid.UUID(assignment_id)
+    except ValueError:
+        raise web.HTTPNotFound()
+
+    client = request.app[REDIS_CLIENT]
+    hub = request.app[HUB]
+    key = assignment_events_key(assignment_id)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no" # Don't let a proxy hold events back
+    })
+    await response.prepare(request)
+    await response.write(f"retry: {EVENTS_RETRY_MS}\n\n".encode())
+
+    # Listen before reading the stream, so nothing published in between is lost
+    queue = hub.listen(assignment_id)
+    last_id = request.headers.get("Last-Event-ID", "")
+    last_id = last_id if STREAM_ID.match(last_id) else "0-0"
+
+    async def send(event_id: str, data: str) -> bool:
+        nonlocal last_id
+        last_id = event_id
+        await response.write(f"id: {event_id}\ndata: {data}\n\n".encode())
+        return AssignmentEvent.model_validate_json(data).final
+
+    async def catch_up() -> bool:
+        final = False
+        for event_id, fields in await client.xrange(key, min=f"({last_id}"):
+            final = await send(event_id.decode(), fields[b"data"].decode()) or final
+        return final
+
+    try:
+        finished = await catch_up()
+        while not finished:
+            try:
+                message = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+
+            if message is None:
+                finished = await catch_up()
+            elif stream_position(message["id"]) > stream_position(last_id): # Otherwise already sent while catching up
+                finished = await send(message["id"], message["data"])
+
+        # Tell the browser not to reconnect
+        await response.write(b"event: end\ndata: {}\n\n")
+    except ConnectionResetError:
+        pass # Client went away
+    finally:
+        hub.forget(assignment_id, queue)
+
+    return response
+
+async def start_hub(app: web.Application):
+    app[REDIS_CLIENT] = redis.asyncio.Redis(host=REDIS_HOSTNAME, port=REDIS_PORT, password=REDIS_PASSWORD)
+    app[HUB] = EventHub(app[REDIS_CLIENT])
+    app[HUB_TASK] = asyncio.create_task(app[HUB].run())
+
+async def stop_hub(app: web.Application):
+    app[HUB_TASK].cancel()
+    await app[REDIS_CLIENT].aclose()
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/assignment/{assignment_id}/events", stream_events)
+    app.on_startup.append(start_hub)
+    app.on_cleanup.append(stop_hub)
+    return app
+
+if __name__ == "__main__":
+    print(f"[events] Serving assignment events on port {EVENTS_PORT}")
+    web.run_app(create_app(), port=EVENTS_PORT, print=None)
@@ -0,0 +1,284 @@
+# Resident CICFlowMeter service for the flow extraction worker.
+#
+# Running `gradle --no-daemon ... runcmd` per pcap pays for a Gradle build and a cold JVM on every job.
+# This daemon keeps a small pool of warm JVMs (see docker/ExtractorDaemon.java) and serves extraction
+# requests over a local unix socket, restarting any JVM that crashes, hangs or stops answering pings.
+
+import os, sys, json, time, queue, signal, socket, socketserver, subprocess, threading
+
+# ================================================
+#            Flow Extractor Settings
+# ================================================
+
+EXTRACTOR_SOCKET = os.environ.get("EXTRACTOR_SOCKET", "/tmp/cicflowmeter.sock")
+EXTRACTOR_CONCURRENCY = int(os.environ.get("EXTRACTOR_CONCURRENCY", 2)) # Number of resident JVMs
+EXTRACTOR_JOB_TIMEOUT = int(os.environ.get("EXTRACTOR_JOB_TIMEOUT", 1800)) # Seconds before a stuck extraction is killed
+EXTRACTOR_HEALTH_INTERVAL = int(os.environ.get("EXTRACTOR_HEALTH_INTERVAL", 10)) # Seconds between pings of idle JVMs
+EXTRACTOR_JVM_OPTS = os.environ.get("EXTRACTOR_JVM_OPTS", "-Xmx1g").split()
+
+CICFLOWMETER_DIR = os.environ.get("CICFLOWMETER_DIR", "/worker")
+CICFLOWMETER_CLASSPATH_FILE = os.path.join(CICFLOWMETER_DIR, "classpath.txt") # Written at image build time
+CICFLOWMETER_LIBRARY_PATH = os.path.join(CICFLOWMETER_DIR, "jnetpcap/linux/jnetpcap-1.4.r1425")
+
+STARTUP_TIMEOUT = 60
+PING_TIMEOUT = 5
+
+# ================================================
+
+class ExtractorError(Exception):
+    pass
+
+class ResidentExtractor:
+    # One long-lived JVM running cic.cs.unb.ca.ifm.ExtractorDaemon
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: subprocess.Popen | None = None
+        self.responses: queue.Queue[str | None] = queue.Queue()
+        self.restarts = -1
+
+    def start(self):
+        with open(CICFLOWMETER_CLASSPATH_FILE) as f:
+            classpath = f.read().strip()
+
+        self.responses = queue.Queue()
+        self.process = subprocess.Popen(
+            ["java", *EXTRACTOR_JVM_OPTS, f"-Djava.library.path={CICFLOWMETER_LIBRARY_PATH}",
+             "-cp", classpath, "cic.cs.unb.ca.ifm.ExtractorDaemon"],
+            cwd=CICFLOWMETER_DIR,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1 # Line buffered
+        )
+        self.restarts += 1
+
+        # Pump stdout into a queue so every read can have a timeout
+        threading.Thread(target=self._read_responses, args=(self.process, self.responses), daemon=True).start()
+
+        if self._wait_for_response(STARTUP_TIMEOUT) != "READY":
+            self.stop()
+            raise ExtractorError(f"JVM #{self.index} did not start")
+
+        print(f"[extractor] JVM #{self.index} ready (pid {self.process.pid}, restarts {self.restarts})")
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def ping(self) -> bool:
+        try:
+            return self._request("PING", PING_TIMEOUT) == "PONG"
+        except ExtractorError:
+            return False
+
+    def extract(self, pcap_path: str, output_directory: str, timeout: int = EXTRACTOR_JOB_TIMEOUT):
+        response = self._request(f"{pcap_path}\t{output_directory}", timeout)
+        if response != "OK":
+            raise ExtractorError(response.removeprefix("ERR ").strip())
+
+    def _request(self, line: str, timeout: int) -> str:
+        if not self.alive():
+            raise ExtractorError(f"JVM #{self.index} is not running")
+
+        try:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise ExtractorError(f"JVM #{self.index} stopped accepting requests: {e}")
+
+        response = self._wait_for_response(timeout)
+        if response is None:
+            # Hung or crashed mid-request, either way the JVM is no longer usable
+            try:
+                self.process.wait(timeout=1)
+                reason = f"exited unexpectedly with code {self.process.returncode}"
+            except subprocess.TimeoutExpired:
+                reason = f"did not answer within {timeout}s"
+            self.stop()
+            raise ExtractorError(f"JVM #{self.index} {reason}")
+
+        return response
+
+    def _wait_for_response(self, timeout: int) -> str | None:
+        try:
+            return self.responses.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    @staticmethod
+    def _read_responses(process: subprocess.Popen, responses: queue.Queue):
+        for line in process.stdout:
+            responses.put(line.strip())
+        responses.put(None) # EOF, the JVM exited
+
+class ExtractorPool:
+    # Hands each request to an idle JVM and keeps every JVM healthy
+
+    def __init__(self, size: int = EXTRACTOR_CONCURRENCY):
+        self.extractors = [ResidentExtractor(i) for i in range(size)]
+        self.idle: queue.Queue[ResidentExtractor] = queue.Queue()
+
+        for extractor in self.extractors:
+            extractor.start()
+            self.idle.put(extractor)
+
+        self._stopping = threading.Event()
+        threading.Thread(target=self._supervise, daemon=True).start()
+
+    def extract(self, pcap_path: str, output_directory: str):
+        extractor = self.idle.get()
+        try:
+            if not extractor.alive():
+                extractor.restart()
+
+            extractor.extract(pcap_path, output_directory)
+        except ExtractorError:
+            # Timed out and crashed JVMs are stopped by the extractor itself, bring them back right away
+            if not extractor.alive():
+                self._replace(extractor)
+            raise
+        finally:
+            self.idle.put(extractor)
+
+    def stop(self):
+        self._stopping.set()
+        for extractor in self.extractors:
+            extractor.stop()
+
+    def _supervise(self):
+        # Ping idle JVMs in the background so a dead one is replaced before a job lands on it
+        while not self._stopping.wait(EXTRACTOR_HEALTH_INTERVAL):
+            for _ in range(len(self.extractors)):
+                try:
+                    extractor = self.idle.get_nowait()
+                except queue.Empty:
+                    break # Everything else is busy
+
+                if not extractor.ping():
+                    print(f"[extractor] JVM #{extractor.index} failed its health check, restarting")
+                    self._replace(extractor)
+
+                self.idle.put(extractor)
+
+    def _replace(self, extractor: ResidentExtractor):
+        try:
+            extractor.restart()
+        except (ExtractorError, OSError) as e:
+            print(f"[extractor] Could not restart JVM #{extractor.index}: {e}")
+
+# ================================================
+#                 Socket Server
+# ================================================
+
+class ExtractionRequestHandler(socketserver.StreamRequestHandler):
+    # Request:  {"pcap": "<file or folder>", "output": "<folder>"}
+    # Response: {"success": bool, "message": str | None, "seconds": float}
+
+    def handle(self):
+        started = time.perf_counter()
+        response = {"success": False, "message": None}
+
+        line = self.rfile.readline()
+        if not line:
+            return # Availability probe, nothing to do
+
+        try:
+            request = json.loads(line)
+            self.server.pool.extract(request["pcap"], request["output"])
+            response["success"] = True
+        except (ExtractorError, OSError, KeyError, ValueError) as e:
+            response["message"] = str(e)
+
+        response["seconds"] = time.perf_counter() - started
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+class ExtractionServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, pool: ExtractorPool):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        self.pool = pool
+        super().__init__(socket_path, ExtractionRequestHandler)
+
+def serve(socket_path: str = EXTRACTOR_SOCKET):
+    pool = ExtractorPool()
+    server = ExtractionServer(socket_path, pool)
+
+    def shutdown(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    print(f"[extractor] Serving {len(pool.extractors)} resident JVMs on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        pool.stop()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+# ================================================
+#                    Client
+# ================================================
+
+def extractor_available(socket_path: str = EXTRACTOR_SOCKET) -> bool:
+    if not os.path.exists(socket_path):
+        return False
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+def request_extraction(pcap_path: str, output_directory: str, socket_path: str = EXTRACTOR_SOCKET) -> float:
+    # Returns the number of seconds the extraction took, raises ExtractorError on failure
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps({"pcap": pcap_path, "output": output_directory}) + "\n").encode())
+        response = json.loads(s.makefile().readline() or "{}")
+
+    if not response.get("success", False):
+        raise ExtractorError(response.get("message") or "Extraction failed")
+
+    return response["seconds"]
+
+def start_extractor_daemon(socket_path: str = EXTRACTOR_SOCKET, concurrency: int = EXTRACTOR_CONCURRENCY) -> subprocess.Popen | None:
+    # Launch the daemon next to a worker (or a pool of them, see supervisor.py) unless one is already serving this socket
+    if extractor_available(socket_path):
+        return None
+
+    daemon = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                              env={**os.environ, "EXTRACTOR_SOCKET": socket_path, "EXTRACTOR_CONCURRENCY": str(concurrency)})
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT * max(1, concurrency)
+    while time.monotonic() < deadline:
+        if extractor_available(socket_path):
+            return daemon
+        if daemon.poll() is not None:
+            break
+        time.sleep(0.5)
+
+    print("[extractor] Resident extractor did not come up, falling back to gradle for each job")
+    return daemon
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,130 @@
+# Columnar flow files handed from the pcap stage to the ML stage.
+#
+# A flow file is a regular .npz archive (np.load can open it) with two members:
+#     columns.npy  column names, in the order CICFlowMeter wrote them
+#     flows.npy    (rows, columns) matrix in C order, text columns like Timestamp or IPs left out
+# Both sides stream the matrix through the zip member in row chunks, so neither a huge CSV nor a huge
+# matrix has to fit in memory, and reading a chunk is a decompress plus np.frombuffer instead of a CSV parse.
+
+import os, zipfile, tempfile, shutil
+from typing import Iterable, Iterator
+import numpy as np
+import pandas as pd
+
+# ================================================
+#               Flow Format Settings
+# ================================================
+
+FLOW_FORMAT = os.environ.get("FLOW_FORMAT", "npz") # Format the pcap stage hands to ML: "npz" or "csv"
+FLOW_DTYPE = os.environ.get("FLOW_DTYPE", "float64") # float32 halves the files but rounds the features the model sees
+FLOW_COMPRESSION = int(os.environ.get("FLOW_COMPRESSION", 1)) # zlib level, 0 stores the matrix uncompressed
+FLOW_CHUNK_ROWS = int(os.environ.get("FLOW_CHUNK_ROWS", 100_000))
+
+# ================================================
+
+COLUMNS_MEMBER = "columns.npy"
+FLOWS_MEMBER = "flows.npy"
+
+def flow_extension(path: str) -> str:
+    return os.path.splitext(path)[1].lstrip(".").lower()
+
+# ======== Writing ========
+
+def write_flows(path: str, columns: list[str], chunks: Iterable[np.ndarray], dtype: str = FLOW_DTYPE):
+    # The .npy header needs the row count up front, so rows are spooled to a scratch file first
+    dtype = np.dtype(dtype)
+    rows = 0
+
+    with tempfile.TemporaryFile() as spool:
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype=dtype)
+            spool.write(chunk.data)
+            rows += len(chunk)
+        spool.seek(0)
+
+        header = {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (rows, len(columns))}
+        compression = zipfile.ZIP_DEFLATED if FLOW_COMPRESSION > 0 else zipfile.ZIP_STORED
+
+        with zipfile.ZipFile(path, "w", compression, compresslevel=FLOW_COMPRESSION or None) as archive:
+            with archive.open(COLUMNS_MEMBER, "w") as member:
+                np.lib.format.write_array(member, np.array(columns, dtype=str))
+
+            with archive.open(FLOWS_MEMBER, "w", force_zip64=True) as member:
+                np.lib.format.write_array_header_1_0(member, header)
+                shutil.copyfileobj(spool, member, 16 * 1024 * 1024)
+
+    return rows
+
+def _numeric_columns(frame: pd.DataFrame) -> list[str]:
+    # Columns holding at least one number, which leaves out Timestamp, Flow ID and the IP addresses
+    return [c for c in frame.columns if pd.api.types.is_numeric_dtype(frame[c]) or pd.to_numeric(frame[c], errors="coerce").notna().any()]
+
+def _to_matrix(frame: pd.DataFrame, columns: list[str]) -> np.ndarray:
+    # Values that aren't numbers become NaN, run_ml drops those rows like it does for the CSV
+    return frame.reindex(columns=columns).apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+
+def frame_to_flows(frame: pd.DataFrame, path: str) -> int:
+    columns = _numeric_columns(frame)
+    return write_flows(path, columns, [_to_matrix(frame, columns)])
+
+def csv_to_flows(csv_path: str, path: str, chunk_rows: int = FLOW_CHUNK_ROWS) -> int:
+    # Parsed exactly like run_ml parses the CSV, so both formats give the model identical features
+    columns: list[str] = []
+
+    def chunks():
+        with pd.read_csv(csv_path, chunksize=chunk_rows or None) as reader:
+            for frame in reader:
+                if not columns:
+                    columns.extend(_numeric_columns(frame)) # Chosen once, every chunk has the same layout
+                yield _to_matrix(frame, columns)
+
+        if not columns:
+            columns.extend(pd.read_csv(csv_path, nrows=0).columns) # No flows, keep the header for run_ml
+
+    # write_flows only reads the column names once every chunk has been spooled
+    return write_flows(path, columns, chunks())
+
+def merge_flows(paths: list[str], path: str) -> int:
+    # Concatenate flow files, aligning columns on the first one
+    if not paths:
+        return 0
+
+    columns = read_flow_columns(paths[0])
+
+    def chunks():
+        for shard_path in paths:
+            shard_columns = read_flow_columns(shard_path)
+            present = [c for c in columns if c in shard_columns]
+            for values in iter_flows(shard_path, present):
+                if len(present) == len(columns):
+                    yield values
+                else:
+                    aligned = np.full((len(values), len(columns)), np.nan)
+                    aligned[:, [columns.index(c) for c in present]] = values
+                    yield aligned
+
+    return write_flows(path, columns, chunks())
+
+# ======== Reading ========
+
+def read_flow_columns(path: str) -> list[str]:
+    with zipfile.ZipFile(path) as archive, archive.open(COLUMNS_MEMBER) as member:
+        return np.lib.format.read_array(member).tolist()
+
+def iter_flows(path: str, columns: list[str], chunk_rows: int = FLOW_CHUNK_ROWS) -> Iterator[np.ndarray]:
+    # (rows, len(columns)) chunks of the requested columns, decompressed straight into numpy buffers
+    available = read_flow_columns(path)
+    missing = [c for c in columns if c not in available]
+    if missing:
+        raise ValueError(f"Missing expected features in flow file: {missing[:10]}...")
+    positions = [available.index(c) for c in columns]
+
+    with zipfile.ZipFile(path) as archive, archive.open(FLOWS_MEMBER) as member:
+        version = np.lib.format.read_magic(member)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        (rows, width), _, dtype = read_header(member)
+
+        chunk_rows = chunk_rows or max(rows, 1)
+        for _ in range(0, rows, chunk_rows):
+            values = np.frombuffer(member.read(chunk_rows * width * dtype.itemsize), dtype=dtype).reshape(-1, width)
+            yield values if positions == list(range(width)) else values[:, positions]
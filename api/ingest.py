@@ -0,0 +1,409 @@
+# Continuous ingestion: follows live traffic instead of a single upload, under one assignment that gets
+# a verdict for every window of flows.
+#
+#     python3 ingest.py /captures          a directory a sensor rotates captures into (tcpdump -G/-C, .gz/.zst too)
+#     python3 ingest.py capture.pcap       a pcap file, followed as it grows
+#     tcpdump -w - | python3 ingest.py -   a pcap stream on standard input
+#
+# New traffic is parsed segment by segment with the native extractor (flow_extractor.py). Only the packets
+# of flows still open are carried over to the next segment, every other flow has its features computed once
+# and joins the current window. Each INGEST_WINDOW seconds the window's flows go to the ML workers as one job.
+# CICFlowMeter can't keep flows open from one file to the next, so this always uses the native extractor.
+
+from redis_utils import *
+from s3_utils import *
+from api_types import *
+
+from typing import BinaryIO, Iterator
+from datetime import datetime, timezone
+import os, sys, mmap, time, queue, fnmatch, signal, shutil, tempfile, argparse, threading
+import numpy as np
+import pandas as pd
+from flow_extractor import (FLOW_TIMEOUT, ACTIVITY_TIMEOUT, FLOW_COLUMNS, FIN, PCAP_MAGIC, CaptureIndex, Packets, Flows,
+                            CaptureFormatError, index_capture, parse_packets, assemble_flows, compute_features, connection_keys)
+from flow_format import frame_to_flows
+from prefilter import PREFILTER, RULES, duplicate_records
+from captures import HEAD_BYTES, DECOMPRESSION_ERRORS, detect_compression, decompress
+from run_ml import run_ml
+
+# ================================================
+#               Ingestion Settings
+# ================================================
+
+INGEST_WINDOW = int(os.environ.get("INGEST_WINDOW", 60)) # Seconds of completed flows analyzed together
+INGEST_POLL_INTERVAL = float(os.environ.get("INGEST_POLL_INTERVAL", 2)) # Seconds between looks for new traffic
+INGEST_SETTLE = int(os.environ.get("INGEST_SETTLE", 10)) # Seconds a capture in the directory must stay unchanged before it's read
+
+INGEST_SEGMENT_SIZE = int(os.environ.get("INGEST_SEGMENT_MB", 16)) * 1024 * 1024 # Stream bytes parsed at a time...
+INGEST_SEGMENT_SECONDS = int(os.environ.get("INGEST_SEGMENT_SECONDS", 5))        # ...or fewer, once this long has passed
+
+# Bounds of the flow table under sustained traffic, the least recently active flows are cut off beyond them
+INGEST_MAX_FLOWS = int(os.environ.get("INGEST_MAX_FLOWS", 200_000))
+INGEST_MAX_PACKETS = int(os.environ.get("INGEST_MAX_PACKETS", 5_000_000))
+
+INGEST_KEEP_WINDOWS = int(os.environ.get("INGEST_KEEP_WINDOWS", 1000)) # Window stages listed on the assignment, oldest dropped first
+
+# ================================================
+
+# ================================================
+#                   Flow Table
+# ================================================
+
+class FlowTable:
+    # The flows still open at the end of the traffic seen so far, kept as their packets. A flow is complete once
+    # a FIN closed it, a later flow of its connection started or it outlived the flow timeout, by the same rules
+    # as assemble_flows. Timestamps come from the packets, so a quiet link doesn't expire anything by itself
+
+    def __init__(self, flow_timeout: int = FLOW_TIMEOUT, activity_timeout: int = ACTIVITY_TIMEOUT,
+                 max_flows: int = INGEST_MAX_FLOWS, max_packets: int = INGEST_MAX_PACKETS):
+        self.flow_timeout = flow_timeout
+        self.activity_timeout = activity_timeout
+        self.max_flows = max_flows
+        self.max_packets = max_packets
+
+        self.pending: Packets | None = None
+        self.open_flows = 0
+        self.watermark = 0 # Time of the latest packet seen, microseconds
+        self.evicted = 0   # Flows cut off early to stay within bounds
+
+    def __len__(self):
+        return self.open_flows
+
+    @property
+    def held_packets(self) -> int:
+        return len(self.pending) if self.pending is not None else 0
+
+    def add(self, packets: Packets) -> pd.DataFrame:
+        # Features of the flows these packets completed
+        if len(packets):
+            self.watermark = max(self.watermark, int(packets.ts.max()))
+        return self._update(packets, flush=False)
+
+    def flush(self) -> pd.DataFrame:
+        # Features of every open flow as it is now, when the traffic ended or went quiet
+        return self._update(None, flush=True)
+
+    def _update(self, packets: Packets | None, flush: bool) -> pd.DataFrame:
+        parts = [part for part in (self.pending, packets) if part is not None and len(part)]
+        if not parts:
+            return pd.DataFrame(columns=FLOW_COLUMNS)
+
+        flows = assemble_flows(Packets.concat(parts), self.flow_timeout)
+        first, last = self._bounds(flows)
+
+        complete = np.ones(len(flows), dtype=bool) if flush else self._complete(flows, first, last)
+        complete |= self._evict(flows, complete, last)
+
+        still_open = ~complete
+        self.pending = flows.packets.take(still_open[flows.flow])
+        self.open_flows = int(still_open.sum())
+
+        return compute_features(flows.take(complete), self.activity_timeout)
+
+    @staticmethod
+    def _bounds(flows: Flows) -> tuple[np.ndarray, np.ndarray]:
+        # First and last packet of every flow, whose packets are contiguous and in time order
+        first = np.flatnonzero(np.r_[True, flows.flow[1:] != flows.flow[:-1]])
+        return first, np.append(first[1:], len(flows.flow)) - 1
+
+    def _complete(self, flows: Flows, first: np.ndarray, last: np.ndarray) -> np.ndarray:
+        p = flows.packets
+
+        # Flows are sorted by connection, another flow of the same connection right after means this one ended
+        followed = np.ones(len(first) - 1, dtype=bool)
+        for key in connection_keys(p.take(first)):
+            followed &= key[1:] == key[:-1]
+        followed = np.append(followed, False)
+
+        closed = ((p.flags[last] & FIN) != 0) & (last > first) # A FIN only closes a flow it did not open
+
+        # assemble_flows drops a timed-out flow of one packet once its connection goes on, so those wait a
+        # second timeout for that to happen. The direction a timed-out flow hands down to the next flow of
+        # its connection isn't kept, that flow takes the direction of its own first packet
+        age = self.watermark - p.ts[first]
+        expired = (age > self.flow_timeout) & ((last > first) | (age > 2 * self.flow_timeout))
+
+        return followed | closed | expired
+
+    def _evict(self, flows: Flows, complete: np.ndarray, last: np.ndarray) -> np.ndarray:
+        # Open flows beyond max_flows or max_packets, the least recently active go first
+        evict = np.zeros(len(flows), dtype=bool)
+        still_open = np.flatnonzero(~complete)
+        sizes = np.bincount(flows.flow, minlength=len(flows))[still_open]
+        if len(still_open) <= self.max_flows and sizes.sum() <= self.max_packets:
+            return evict
+
+        recent = np.argsort(flows.packets.ts[last][still_open], kind="stable")[::-1]
+        within = (np.arange(len(recent)) < self.max_flows) & (np.cumsum(sizes[recent]) <= self.max_packets)
+        evict[still_open[recent[~within]]] = True
+
+        self.evicted += int(evict.sum())
+        return evict
+
+def segment_packets(data, index: CaptureIndex) -> Packets:
+    # TCP/UDP packets of a segment, less what the pre-filter would drop from an uploaded capture
+    packets = parse_packets(data, index)
+    if PREFILTER:
+        if RULES is not None:
+            packets = packets.take(RULES(packets))
+        packets = packets.take(~duplicate_records(data, index, packets.record))
+    return packets
+
+# ================================================
+#                Traffic Sources
+# ================================================
+
+# Sources yield (data, index) for each segment of new traffic, and None whenever there was nothing new
+
+def read_capture(path: str) -> Iterator[tuple[bytes, CaptureIndex]]:
+    # A whole capture as one segment, decompressed to a temporary file first when needed
+    with open(path, "rb") as f:
+        compression = detect_compression(f.read(HEAD_BYTES))
+        f.seek(0)
+
+        with tempfile.TemporaryFile() as raw:
+            if compression is not None:
+                decompress(f, raw, compression)
+                raw.flush()
+
+            source = raw if compression is not None else f
+            if os.fstat(source.fileno()).st_size == 0:
+                return
+
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data, index_capture(data)
+
+def directory_segments(directory: str, pattern: str, stopping: threading.Event,
+                       existing: bool = False) -> Iterator[tuple[bytes, CaptureIndex] | None]:
+    # Every capture put in the directory, oldest first, once it stopped changing for INGEST_SETTLE seconds
+    def captures() -> list[os.DirEntry]:
+        entries = [entry for entry in os.scandir(directory)
+                   if entry.is_file() and not entry.name.startswith(".") and fnmatch.fnmatch(entry.name, pattern)]
+        return sorted(entries, key=lambda entry: (entry.stat().st_mtime, entry.name))
+
+    done = set() if existing else {entry.name for entry in captures()}
+    changes: dict[str, tuple[int, float]] = {} # Name -> its size, and when that size was first seen
+
+    while not stopping.is_set():
+        entries = captures()
+        done &= {entry.name for entry in entries} # Forget captures that were deleted
+        now = time.monotonic()
+
+        ready = []
+        for entry in entries:
+            if entry.name in done:
+                continue
+
+            size = entry.stat().st_size
+            if changes.get(entry.name, (None,))[0] != size:
+                changes[entry.name] = (size, now)
+            elif size and now - changes[entry.name][1] >= INGEST_SETTLE: # Created but not written to yet otherwise
+                ready.append(entry)
+
+        for entry in ready:
+            done.add(entry.name)
+            changes.pop(entry.name, None)
+
+            try:
+                yield from read_capture(entry.path)
+            except (OSError, ValueError, *DECOMPRESSION_ERRORS) as e: # CaptureFormatError is a ValueError
+                print(f"[ingest] Skipping {entry.name}: {e}")
+
+            if stopping.is_set():
+                return
+
+        if not ready:
+            yield None
+            stopping.wait(INGEST_POLL_INTERVAL)
+
+def stream_segments(stream: BinaryIO, stopping: threading.Event, follow: bool = False) -> Iterator[tuple[bytes, CaptureIndex] | None]:
+    # A pcap stream, cut into segments of INGEST_SEGMENT_SIZE bytes or INGEST_SEGMENT_SECONDS of traffic.
+    # A record cut off at the end of a segment starts the next one. With follow, the end of the stream is
+    # only the end for now, like tail -f on a capture that is still being written
+    chunks: queue.Queue[bytes | None] = queue.Queue(maxsize=4) # Reading stalls rather than buffer without bound
+    threading.Thread(target=_read_stream, args=(stream, chunks, stopping, follow), daemon=True).start()
+
+    header, pending = b"", bytearray()
+    cut = time.monotonic()
+
+    while not stopping.is_set():
+        try:
+            chunk = chunks.get(timeout=INGEST_POLL_INTERVAL)
+        except queue.Empty:
+            chunk = b""
+
+        ended = chunk is None
+        pending += chunk or b""
+
+        if not header and len(pending) >= 24:
+            header, pending = bytes(pending[:24]), pending[24:]
+            if header[:4] not in PCAP_MAGIC:
+                raise CaptureFormatError("Only pcap streams can be followed, write pcapng captures to a directory instead")
+
+        due = ended or len(pending) >= INGEST_SEGMENT_SIZE or time.monotonic() - cut >= INGEST_SEGMENT_SECONDS
+        if header and pending and due:
+            data = header + bytes(pending)
+            index = index_capture(data)
+            cut = time.monotonic()
+
+            if len(index):
+                del pending[:int(index.offset[-1] + index.caplen[-1]) - len(header)]
+                yield data, index
+            else:
+                yield None
+        else:
+            yield None
+
+        if ended:
+            return
+
+def _read_stream(stream: BinaryIO, chunks: queue.Queue, stopping: threading.Event, follow: bool):
+    # Blocking reads in their own thread, so the segments keep their pace while the stream is quiet
+    read = getattr(stream, "read1", stream.read) # Whatever is available, without waiting for a full buffer
+    while not stopping.is_set():
+        chunk = read(1024 * 1024)
+        if chunk:
+            chunks.put(chunk)
+        elif follow:
+            stopping.wait(INGEST_POLL_INTERVAL)
+        else:
+            chunks.put(None)
+            return
+
+# ================================================
+#              Continuous Assignment
+# ================================================
+
+class ContinuousAssignment:
+    # One assignment for everything ingested: a stage that starts it, then a stage and an ML job per window.
+    # Window jobs are marked continuous, so their verdicts don't end the assignment (see publish_job_finished)
+
+    def __init__(self, redis_client: redis.Redis, s3_client, source: str):
+        self.redis = redis_client
+        self.s3 = s3_client
+        self.queue = get_ml_queue(redis_client) # Windows are small, they take the fast lane
+
+        self.assignment = complete_job(redis_client, self.queue, Stage.new_ingestion_stage(source), Assignment.new(),
+                                       JobResult.new(success=True, message=f"Following {source}.").model_dump_json(),
+                                       final=False)
+        self.windows: list[Stage] = [] # The latest INGEST_KEEP_WINDOWS
+        self.window_count = 0
+        self.flows: list[pd.DataFrame] = []
+        self.window_started = datetime.now(timezone.utc)
+
+    @property
+    def id(self) -> str:
+        return self.assignment.id
+
+    def collect(self, flows: pd.DataFrame):
+        if len(flows):
+            self.flows.append(flows)
+
+        if (datetime.now(timezone.utc) - self.window_started).total_seconds() >= INGEST_WINDOW:
+            self.submit()
+
+    def submit(self):
+        # Hand the window's flows to the ML workers, an empty window has no stage
+        started, self.window_started = self.window_started, datetime.now(timezone.utc)
+        if not self.flows:
+            return
+
+        flows = pd.concat(self.flows, ignore_index=True)
+        self.flows = []
+
+        self.window_count += 1
+        flow_key = f"flows/continuous/{self.id}/{self.window_count}.npz"
+        directory = tempfile.mkdtemp()
+        try:
+            flow_filepath = os.path.join(directory, "window.npz")
+            frame_to_flows(flows, flow_filepath)
+            self.s3.upload_file(flow_filepath, S3_BUCKET, flow_key)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        stage = Stage.new_window_stage(self.window_count - 1, len(flows), f"{started:%H:%M:%S}", f"{self.window_started:%H:%M:%S} UTC")
+        self.assignment = enqueue_job(self.redis, self.queue, stage, self.assignment, run_ml, flow_key, self.id,
+                                      meta={"continuous": True})
+        self.windows.append(stage)
+        print(f"[ingest] {stage.name}: {len(flows):,} flows sent for analysis")
+
+        # The assignment lists its latest windows, its record and its clients' pages would grow forever otherwise
+        if len(self.windows) > INGEST_KEEP_WINDOWS:
+            oldest = self.windows.pop(0)
+            self.assignment.stages.remove(oldest)
+            self.redis.lrem(assignment_stages_key(self.id), 1, oldest.model_dump_json())
+
+    def close(self, message: str):
+        # The last window, then a stage ending the assignment once every window still running is over
+        self.submit()
+
+        running = [job.id for job in Job.fetch_many([stage.id for stage in self.windows], connection=self.redis)
+                   if job is not None and job.get_status(refresh=False) not in ("finished", "failed", "canceled", "stopped")]
+
+        enqueue_job(self.redis, self.queue, Stage.new_ingestion_end_stage(), self.assignment, replay_result,
+                    JobResult.new(success=True, message=message).model_dump_json(),
+                    depends_on=Dependency(jobs=running, allow_failure=True) if running else None,
+                    ttl=None, meta={"final": True})
+
+# ================================================
+
+def ingest(segments: Iterator[tuple[bytes, CaptureIndex] | None], table: FlowTable, assignment: ContinuousAssignment):
+    quiet_since = time.monotonic()
+
+    for segment in segments:
+        if segment is not None:
+            data, index = segment
+            flows = table.add(segment_packets(data, index))
+            quiet_since = time.monotonic()
+
+            print(f"[ingest] {len(index):,} packets completed {len(flows):,} flows, {len(table):,} still open "
+                  f"({table.held_packets:,} packets held, {table.evicted:,} cut off so far)")
+        elif len(table) and time.monotonic() - quiet_since > table.flow_timeout / 1_000_000:
+            flows = table.flush() # Quiet for a whole flow timeout, every open flow is over
+            print(f"[ingest] No traffic for {table.flow_timeout / 1_000_000:.0f}s, closed {len(flows):,} open flows")
+        else:
+            flows = None
+
+        assignment.collect(flows if flows is not None else pd.DataFrame(columns=FLOW_COLUMNS))
+
+    assignment.collect(table.flush())
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow live traffic and analyze it continuously under one assignment.")
+    parser.add_argument("source", help="Directory of rotating captures, a pcap file to follow as it grows, or - for a pcap stream on stdin")
+    parser.add_argument("--pattern", default="*", help="Captures of the directory to read, e.g. '*.pcap.gz'")
+    parser.add_argument("--existing", action="store_true", help="Also read the captures already in the directory")
+    args = parser.parse_args()
+
+    REDIS = get_redis_client()
+    try:
+        REDIS.ping()
+    except redis.exceptions.ConnectionError:
+        print("Could not connect to the Redis server!")
+        exit(1)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    if args.source == "-":
+        source, segments = "standard input", stream_segments(sys.stdin.buffer, stopping)
+    elif os.path.isdir(args.source):
+        source, segments = args.source, directory_segments(args.source, args.pattern, stopping, args.existing)
+    else:
+        source, segments = args.source, stream_segments(open(args.source, "rb"), stopping, follow=True)
+
+    assignment = ContinuousAssignment(REDIS, get_s3_client(), source)
+    print(f"[ingest] Following {source} as assignment {assignment.id}")
+
+    message = f"Stopped following {source}."
+    try:
+        ingest(segments, FlowTable(), assignment)
+    except CaptureFormatError as e:
+        message = f"Stopped following {source}: {e}"
+        print(f"[ingest] {message}")
+    finally:
+        assignment.close(message)
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,28 @@ from redis_utils import *
 from s3_utils import *
 from api_types import *
 from utils import *
-from run_cicflowmeter import run_cicflowmeter
+from verdict_cache import *
+from metrics import render_metrics, span
+from admission import admit, take_tokens, queue_states, admission_stats, Refusal, RATE_LIMIT_CLIENT_HEADER
+from run_cicflowmeter import run_cicflowmeter, run_fused, FUSED_MAX_SIZE
+from run_sharding import split_pcap, SHARD_SIZE
+from captures import (COMPRESSION_SUFFIX, HEAD_BYTES, TAR, ARCHIVE_HEAD_BYTES, ARCHIVE_ERRORS, inspect_upload, inspect_object,
+                      is_capture, detect_archive, archive_members)
 
 from flask import Flask, request
-from typing import cast
+from typing import BinaryIO, Iterator, cast
 from werkzeug.datastructures import FileStorage
-import uuid
+from pydantic import ValidationError
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import Counter
+import os, uuid, tempfile
 
 app = Flask(__name__)
 
-HEALTH = healthcheck()
+HEALTH = start_health_monitor().get()
 
 REDIS = get_redis_client()
-if HEALTH.redis.working:
-    PCAP_QUEUE = get_pcap_queue(REDIS)
-    ML_QUEUE = get_ml_queue(REDIS)
+ML_QUEUE = get_ml_queue(REDIS)
 
 
 S3 = get_s3_client()
@@ -24,50 +31,391 @@ if HEALTH.s3.working:
     create_s3_bucket(S3, S3_BUCKET)
     apply_s3_deletion_policy(S3, S3_BUCKET, prefix="uploads/")
     apply_s3_deletion_policy(S3, S3_BUCKET, prefix="flows/")
+    apply_s3_deletion_policy(S3, S3_BUCKET, prefix="shards/")
 
 # API root
 @app.route('/')
 def root():
-    return HEALTH.model_dump_json()
+    return healthcheck().model_dump_json()
 
 # Upload pcap file
 @app.route("/upload", methods=["POST"])
 def upload():
     response = UploadResponse.new()
     
-    if not HEALTH.all_good():
+    if not healthcheck().all_good():
         response.message = "The API is having technical issues, please try again later!"
         return response.model_dump_json(), 500
     
+    # Turned away before the capture is read, the body's size tells its lane closely enough
+    refusal = admit(REDIS, [lane_for_size(request.content_length or 0)], client_address())
+    if refusal is not None:
+        response.message = refusal.message
+        return response.model_dump_json(), refusal.status, refusal.headers()
+    
     if "file" not in request.files:
         response.message = "No file found in the request!"
         return response.model_dump_json(), 400
 
     file: FileStorage = request.files["file"]
-    file_id = str(uuid.uuid4())
-    s3_key = f"uploads/{file_id}.pcap"
     
-    # Upload the file to S3
-    S3.upload_fileobj(file, S3_BUCKET, s3_key)
+    # The request body is already spooled to memory or disk, one pass over it gives the size and the hash
+    with span("hash", stage="upload"):
+        sha256, file_size = capture_digest(file.stream)
+    
+    # Compressed captures are stored as they came, their raw size is what decides how they are processed
+    compression, capture_size = inspect_upload(file.stream, file_size)
+    
+    # The current model has judged this exact capture before, answer right away
+    verdict = lookup_verdict(REDIS, sha256)
+    if verdict is not None:
+        assignment = complete_job(REDIS, ML_QUEUE, Stage.new_cached_stage(), Assignment.new(), verdict.model_dump_json())
+        
+        response.report_success(file.filename, file_size, assignment_id=assignment.id)
+        response.message = "This file was analyzed before, its results are ready!"
+        return response.model_dump_json(), 200
+    
+    # Identical captures are stored once, under their hash
+    s3_key = f"uploads/{sha256}.pcap{COMPRESSION_SUFFIX[compression]}"
+    if not reusable_object(S3, S3_BUCKET, s3_key):
+        with span("s3_upload", stage="upload"):
+            S3.upload_fileobj(file, S3_BUCKET, s3_key)
+    
+    assignment = start_assignment(s3_key, capture_size, sha256)
+    
+    # Send our response
+    response.report_success(file.filename, file_size, assignment_id=assignment.id)
+    return response.model_dump_json(), 202
 
-    # Enqueue the pcap processing job with reference to the uploaded .pcap file in S3
+def start_assignment(s3_key: str, file_size: int, sha256: str | None = None) -> Assignment:
+    # Enqueue the pcap processing job with reference to the uploaded .pcap file in S3,
+    # file_size being the size of the raw capture when it was uploaded compressed
     new_assignment = Assignment.new()
-    enqueue_job(
-                REDIS, 
-                PCAP_QUEUE, 
-                Stage.new_cicflowmeter_stage(),
-                new_assignment, 
-                run_cicflowmeter, 
-                s3_key,
-                new_assignment.id)
-    
-    # Get the size of the uploaded file
-    file_size = S3.head_object(Bucket=S3_BUCKET, Key=s3_key)["ContentLength"]
+    if sha256 is not None:
+        remember_capture(REDIS, new_assignment.id, sha256) # So run_ml can cache the verdict
     
-    # Send our response
-    response.report_success(file, file_size, assignment_id=new_assignment.id)
+    queue, stage, assignment, job, args = first_job(s3_key, file_size, new_assignment)
+    return enqueue_job(REDIS, queue, stage, assignment, job, *args)
+
+def first_job(s3_key: str, file_size: int, assignment: Assignment) -> tuple[Queue, Stage, Assignment, Callable, tuple]:
+    # Large captures are split first so several workers can extract their flows in parallel
+    if file_size > SHARD_SIZE:
+        stage, job = Stage.new_split_stage(), split_pcap
+    elif file_size <= FUSED_MAX_SIZE:
+        stage, job = Stage.new_cicflowmeter_stage(), run_fused # Flows scored by the same job, no second queue wait
+    else:
+        stage, job = Stage.new_cicflowmeter_stage(), run_cicflowmeter
+    
+    # Small captures skip past large ones, every later stage stays in the same lane
+    queue = get_pcap_queue(REDIS, lane_for_size(file_size))
+    
+    return queue, stage, assignment, job, (s3_key, assignment.id)
+
+# Direct uploads, the browser sends the capture straight to S3 instead of through an API worker:
+#     POST   /uploads                       -> UploadTicket with one presigned PUT URL, or one per part
+#     PUT    <each URL>                     -> parts go to S3 in parallel, the client keeps each ETag
+#     POST   /uploads/<upload_id>/complete  -> assemble the parts and start the assignment
+#     DELETE /uploads/<upload_id>           -> give up on the upload
+
+PENDING_UPLOAD_TTL = UPLOAD_URL_TTL * 2
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    response = UploadResponse.new()
+    
+    if S3_PUBLIC_ENDPOINT_URL is None:
+        response.message = "Direct uploads are not enabled on this server, use /upload instead."
+        return response.model_dump_json(), 501
+    
+    if not healthcheck().all_good():
+        response.message = "The API is having technical issues, please try again later!"
+        return response.model_dump_json(), 500
+    
+    try:
+        upload_request = UploadRequest.model_validate(request.get_json(silent=True) or {})
+    except ValidationError:
+        upload_request = None
+    
+    if upload_request is None or upload_request.size <= 0:
+        response.message = "Expected the file's name and its size in bytes!"
+        return response.model_dump_json(), 400
+    
+    # Completing the upload isn't checked again, by then the capture is in S3 already
+    refusal = admit(REDIS, [lane_for_size(upload_request.size)], client_address())
+    if refusal is not None:
+        response.message = refusal.message
+        return response.model_dump_json(), refusal.status, refusal.headers()
+    
+    pending = PendingUpload.new(upload_request.filename)
+    pending.s3_upload_id, part_size, urls = presign_upload(S3, S3_BUCKET, pending.s3_key, upload_request.size)
+    REDIS.set(f"upload:{pending.id}", pending.model_dump_json(), ex=PENDING_UPLOAD_TTL)
+    
+    return UploadTicket.new(pending.id, urls, part_size, multipart=pending.s3_upload_id is not None).model_dump_json(), 201
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+def complete_upload(upload_id: str):
+    response = UploadResponse.new()
+    
+    if not healthcheck().all_good():
+        response.message = "The API is having technical issues, please try again later!"
+        return response.model_dump_json(), 500
+    
+    try:
+        completion = UploadCompletion.model_validate(request.get_json(silent=True) or {})
+    except ValidationError:
+        response.message = "Expected the part numbers and ETags of your upload!"
+        return response.model_dump_json(), 400
+    
+    # Taken out of Redis first, so completing the same upload twice can't start two assignments
+    data = REDIS.getdel(f"upload:{upload_id}")
+    if data is None:
+        response.message = "This upload does not exist or has expired!"
+        return response.model_dump_json(), 404
+    
+    pending = PendingUpload.model_validate_json(data)
+    
+    try:
+        if pending.s3_upload_id is not None:
+            parts = sorted(completion.parts, key=lambda part: part.part_number)
+            S3.complete_multipart_upload(
+                Bucket=S3_BUCKET,
+                Key=pending.s3_key,
+                UploadId=pending.s3_upload_id,
+                MultipartUpload={"Parts": [{"PartNumber": part.part_number, "ETag": part.etag} for part in parts]}
+            )
+        
+        # Go by what actually landed in S3, not the size the client announced
+        file_size = S3.head_object(Bucket=S3_BUCKET, Key=pending.s3_key)["ContentLength"]
+        compression, capture_size = inspect_object(S3, S3_BUCKET, pending.s3_key, file_size)
+        
+        # The API never saw the bytes, read them back once for the hash /upload takes on the way in
+        with span("hash", stage="upload"):
+            sha256, _ = capture_digest(S3.get_object(Bucket=S3_BUCKET, Key=pending.s3_key)["Body"])
+    except ClientError as e:
+        REDIS.set(f"upload:{pending.id}", data, ex=PENDING_UPLOAD_TTL) # Let the client retry
+        response.message = f"Your upload is incomplete: {e.response['Error'].get('Message', e)}"
+        return response.model_dump_json(), 400
+    
+    # The current model has judged this exact capture before, answer right away like /upload
+    verdict = lookup_verdict(REDIS, sha256)
+    if verdict is not None:
+        S3.delete_object(Bucket=S3_BUCKET, Key=pending.s3_key) # Not needed anymore, /upload wouldn't have stored it
+        assignment = complete_job(REDIS, ML_QUEUE, Stage.new_cached_stage(), Assignment.new(), verdict.model_dump_json())
+        
+        response.report_success(pending.filename, file_size, assignment_id=assignment.id)
+        response.message = "This file was analyzed before, its results are ready!"
+        return response.model_dump_json(), 200
+    
+    assignment = start_assignment(pending.s3_key, capture_size, sha256)
+    
+    response.report_success(pending.filename, file_size, assignment_id=assignment.id)
     return response.model_dump_json(), 202
 
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def abort_upload(upload_id: str):
+    data = REDIS.getdel(f"upload:{upload_id}")
+    if data is None:
+        return '', 404
+    
+    pending = PendingUpload.model_validate_json(data)
+    if pending.s3_upload_id is not None:
+        S3.abort_multipart_upload(Bucket=S3_BUCKET, Key=pending.s3_key, UploadId=pending.s3_upload_id)
+    S3.delete_object(Bucket=S3_BUCKET, Key=pending.s3_key)
+    
+    return '', 204
+
+# Batches, many captures in one request instead of an /upload each:
+#     POST /batches             -> captures as multipart "file" fields, any of them a tar, tar.gz or zip archive of
+#                                  captures, or a tar/tar.gz as the request body (Content-Type: application/x-tar)
+#     GET  /batches/<batch_id>  -> BatchStatus, how far every capture got and the verdicts so far
+#
+# Captures are stored in S3 by a pool of threads while the rest of the request is read. Their assignments and
+# first jobs are all created at the end, in one Redis pipeline
+
+MAX_BATCH_CAPTURES = int(os.environ.get("MAX_BATCH_CAPTURES", 500))
+BATCH_UPLOAD_THREADS = int(os.environ.get("BATCH_UPLOAD_THREADS", 8))
+BATCH_SPOOL_SIZE = int(os.environ.get("BATCH_SPOOL_MB", 32)) * 1024 * 1024 # Larger captures wait for their upload on disk
+TAR_CONTENT_TYPES = ("application/x-tar", "application/x-gtar", "application/gzip", "application/x-gzip")
+
+def batch_key(batch_id: str) -> str:
+    return f"batch:{batch_id}"
+
+@app.route("/batches", methods=["POST"])
+def create_batch():
+    response = BatchResponse.new()
+    
+    if not healthcheck().all_good():
+        response.message = "The API is having technical issues, please try again later!"
+        return response.model_dump_json(), 500
+    
+    # A batch can hold captures for either lane, and its size is only known once it's read
+    client = client_address()
+    refusal = admit(REDIS, [FAST_LANE, BULK_LANE], client)
+    if refusal is not None:
+        response.message = refusal.message
+        return response.model_dump_json(), refusal.status, refusal.headers()
+    
+    if request.mimetype in TAR_CONTENT_TYPES:
+        sources = archive_members(request.stream, TAR) # Read as it arrives, never spooled as a whole
+    elif "file" in request.files:
+        sources = batch_sources(request.files.getlist("file"))
+    else:
+        response.message = "No files found in the request!"
+        return response.model_dump_json(), 400
+    
+    members: list[BatchMember] = []
+    captures: list[tuple[BatchMember, str, str, int]] = [] # Member, SHA-256, S3 key and raw size
+    verdicts: dict[str, MLJobResult | None] = {} # SHA-256 -> the current model's earlier verdict
+    uploads: dict[str, Future] = {} # S3 key -> its upload, identical captures are stored once
+    
+    try:
+        with ThreadPoolExecutor(BATCH_UPLOAD_THREADS) as pool, span("s3_upload", stage="batch"):
+            for filename, stream in sources:
+                if len(members) == MAX_BATCH_CAPTURES:
+                    response.message = f"Only the first {MAX_BATCH_CAPTURES} files of a batch are analyzed."
+                    break
+                
+                member = BatchMember.new(filename)
+                members.append(member)
+                
+                # Archive members can only be read once, the hash decides the S3 key before the upload can start
+                spool = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_SIZE)
+                sha256, file_size = capture_digest(stream, copy_to=spool)
+                compression, capture_size = inspect_upload(spool, file_size)
+                
+                if not is_capture(spool.read(HEAD_BYTES)):
+                    spool.close()
+                    member.message = "Not a pcap or pcapng capture."
+                    continue
+                spool.seek(0)
+                
+                s3_key = f"uploads/{sha256}.pcap{COMPRESSION_SUFFIX[compression]}"
+                captures.append((member, sha256, s3_key, capture_size))
+                
+                # Captures the current model has judged before get their verdict right away, like /upload
+                # does, and aren't stored at all. Identical captures are stored once
+                if sha256 not in verdicts:
+                    verdicts[sha256] = lookup_verdict(REDIS, sha256)
+                if verdicts[sha256] is not None or s3_key in uploads:
+                    spool.close()
+                    continue
+                uploads[s3_key] = pool.submit(store_capture, spool, s3_key)
+                
+                # Don't read further ahead of the uploads than the spooled captures they still hold
+                running = [upload for upload in uploads.values() if not upload.done()]
+                if len(running) >= 2 * BATCH_UPLOAD_THREADS:
+                    wait(running, return_when=FIRST_COMPLETED)
+    except ARCHIVE_ERRORS as e:
+        response.message = f"Could not read the archive: {e}"
+        return response.model_dump_json(), 400
+    
+    if not members:
+        response.message = "No files found in the request!"
+        return response.model_dump_json(), 400
+    
+    for member, _, s3_key, _ in captures:
+        if s3_key in uploads and uploads[s3_key].exception() is not None:
+            print(f"[batch] Could not store {member.filename}: {uploads[s3_key].exception()}")
+            member.message = "Could not store this capture, please try again later."
+    captures = [capture for capture in captures if capture[0].message is None]
+    
+    batch = Batch.new(members)
+    if not captures:
+        response.message = "None of the files could be analyzed, see each file's message."
+        response.batch = batch
+        return response.model_dump_json(), 400
+    
+    # The first capture was paid for on admission, the rest is charged even past the client's tokens,
+    # holding back its next requests instead of this one
+    if client is not None:
+        take_tokens(REDIS, client, len(captures) - 1, force=True)
+    
+    with REDIS.pipeline() as pipeline:
+        events, jobs = [], []
+        for member, sha256, s3_key, capture_size in captures:
+            assignment = Assignment.new()
+            member.assignment_id = assignment.id
+            
+            verdict = verdicts[sha256]
+            if verdict is not None:
+                events.append(record_finished_stage(REDIS, pipeline, ML_QUEUE, Stage.new_cached_stage(), assignment, verdict.model_dump_json()))
+            else:
+                remember_capture(pipeline, assignment.id, sha256)
+                jobs.append(first_job(s3_key, capture_size, assignment))
+        
+        events += enqueue_jobs(REDIS, pipeline, jobs)
+        pipeline.set(batch_key(batch.id), batch.model_dump_json(), ex=604800) # Same lifetime as its assignments
+        publish_assignment_events(REDIS, events, pipeline=pipeline)
+    
+    response.success = True
+    response.batch = batch
+    return response.model_dump_json(), 202
+
+def client_address() -> str | None:
+    # Who rate limits are kept for, the first address of the header is the original client
+    if RATE_LIMIT_CLIENT_HEADER and request.headers.get(RATE_LIMIT_CLIENT_HEADER):
+        return request.headers[RATE_LIMIT_CLIENT_HEADER].split(",")[0].strip()
+    return request.remote_addr
+
+def batch_sources(files: list[FileStorage]) -> Iterator[tuple[str, BinaryIO]]:
+    # Every file of a multipart batch, archives replaced by the files inside them
+    for file in files:
+        archive = detect_archive(file.stream.read(ARCHIVE_HEAD_BYTES))
+        file.stream.seek(0)
+        
+        if archive is None:
+            yield file.filename, file.stream
+        else:
+            yield from archive_members(file.stream, archive)
+
+def store_capture(spool: BinaryIO, s3_key: str):
+    with spool:
+        if not reusable_object(S3, S3_BUCKET, s3_key):
+            S3.upload_fileobj(spool, S3_BUCKET, s3_key)
+
+@app.route("/batches/<batch_id>", methods=["GET"])
+def get_batch(batch_id: str):
+    data = REDIS.get(batch_key(batch_id))
+    if data is None:
+        return '', 404
+    
+    batch = Batch.model_validate_json(data)
+    ids = [member.assignment_id for member in batch.members if member.assignment_id is not None]
+    statuses = dict(zip(ids, assignment_statuses(ids)))
+    
+    members = []
+    for member in batch.members:
+        status, prediction = assignment_progress(statuses[member.assignment_id]) if member.assignment_id is not None else ("skipped", None)
+        members.append(BatchMemberStatus(filename=member.filename, assignment_id=member.assignment_id, 
+                                         status=status, prediction=prediction, message=member.message))
+    
+    return BatchStatus(
+        id=batch.id,
+        counts=Counter(member.status for member in members),
+        predictions=Counter(member.prediction.value for member in members if member.prediction is not None),
+        done=all(member.status in ("finished", "failed", "expired", "skipped") for member in members),
+        members=members
+    ).model_dump_json()
+
+def assignment_progress(status: AssignmentStatus | None) -> tuple[str, Prediction | None]:
+    # Where an assignment stands, going by its latest stage: queued, started, finished with a verdict, failed or expired
+    if status is None or not status.jobs or status.jobs[-1] is None:
+        return "expired", None
+    
+    job = status.jobs[-1]
+    if job.status == "finished":
+        prediction = getattr(job.result, "prediction", None)
+        if prediction is not None:
+            return "finished", prediction
+        if job.result is not None and not job.result.success:
+            return "failed", None
+        return "started", None # The next stage is on its way
+    
+    if job.status in ("failed", "stopped", "canceled"):
+        return "failed", None
+    
+    return ("queued" if len(status.jobs) == 1 and job.status in ("queued", "deferred", "scheduled") else "started"), None
+
 @app.route("/assignment/<assignment_id>", methods=["GET"])
 def get_assignment_by_id(assignment_id: str):
     assignment = get_assignment(REDIS, assignment_id)
@@ -76,20 +424,61 @@ def get_assignment_by_id(assignment_id: str):
     
     return assignment.model_dump_json()
 
+MAX_BULK_ASSIGNMENTS = 500
+
+@app.route("/assignments", methods=["GET"])
+def get_assignments_by_ids():
+    # GET /assignments?ids=<id>,<id>,... for dashboards, every assignment and job in a handful of round-trips
+    ids = [id for id in request.args.get("ids", "").split(",") if id]
+    if not ids or len(ids) > MAX_BULK_ASSIGNMENTS:
+        return '', 400
+    
+    return AssignmentsResponse(assignments=assignment_statuses(ids)).model_dump_json()
+
+def assignment_statuses(ids: list[str]) -> list[AssignmentStatus | None]:
+    # Every assignment and job in a handful of round-trips, None for assignments that don't exist
+    assignments = get_assignments(REDIS, ids)
+    
+    job_ids = list({stage.id for assignment in assignments if assignment is not None for stage in assignment.stages if stage.id is not None})
+    jobs = dict(zip(job_ids, Job.fetch_many(job_ids, connection=REDIS)))
+    results = fetch_job_results(REDIS, [job for job in jobs.values() if job is not None and job.get_status(refresh=False) == "finished"])
+    
+    return [
+        AssignmentStatus(
+            assignment=assignment,
+            jobs=[job_response(jobs[stage.id], results.get(stage.id)) if jobs.get(stage.id) is not None else None for stage in assignment.stages]
+        ) if assignment is not None else None
+        for assignment in assignments
+    ]
+
+# Prometheus scrape target: phase durations recorded by the workers, queue depths and worker states
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return render_metrics(REDIS, get_pcap_queues(REDIS) + get_ml_queues(REDIS), healthcheck()), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Queue depths, estimated waits and whether uploads are admitted, so clients can tell a backlog coming
+@app.route("/queues", methods=["GET"])
+def get_queues():
+    queues = queue_states(REDIS, get_pcap_queues(REDIS) + get_ml_queues(REDIS))
+    return QueuesResponse(queues=queues, refusals=admission_stats(REDIS)).model_dump_json(), 200
+
 @app.route("/job/<job_id>", methods=["GET"])
 def get_job_by_id(job_id: str):
     job = get_job(REDIS, job_id)
     if job is None:
         return '', 404
     
+    return job_response(job, job.result if job.is_finished else None).model_dump_json()
+
+def job_response(job: Job, result: str | None) -> JobResponse:
     return JobResponse(
         id = job.id,
-        status = job.get_status(),
+        status = job.get_status(refresh=False), # Just fetched
         queue = job.origin,
         enqeued_at = str(round(job.enqueued_at.timestamp() * 1000)) if job.enqueued_at else None, # Get time in milliseconds
         ended_at = str(round(job.ended_at.timestamp() * 1000)) if job.ended_at else None,
-        result = JobResult.create_from(job.result) if job.is_finished else None
-    ).model_dump_json()
+        result = JobResult.create_from(result) if result is not None else None
+    )
 
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,233 @@
+# Where assignments spend their time, for capacity planning and catching regressions.
+#
+# Jobs time their phases (S3 transfers, flow extraction, parsing, prediction...) with span(). When the job ends,
+# the phase totals are written next to the assignment's stages (see redis_utils.get_assignments) and added to
+# histograms kept in Redis, so every worker reports through the same place and nothing has to scrape them.
+# main.py serves the histograms, queue depths and worker states on /metrics in Prometheus' text format.
+#
+#     metrics:histograms                   set of "<stage>:<phase>" pairs with a histogram
+#     metrics:histogram:<stage>:<phase>    hash of per-bucket counts, plus sum and count
+#     assignment:<id>:timings              hash of job ID -> {phase: seconds} JSON
+
+from redis_utils import *
+from verdict_cache import verdict_stats
+from prefilter import prefilter_stats
+from admission import admission_stats
+
+from rq import Worker, get_current_job
+from rq.registry import StartedJobRegistry, DeferredJobRegistry, FailedJobRegistry
+from contextlib import contextmanager
+from functools import wraps
+from typing import Iterable, Iterator
+import time
+import math
+
+# ================================================
+#                 Metrics Settings
+# ================================================
+
+METRICS_PREFIX = os.environ.get("METRICS_PREFIX", "network_threat_detector")
+
+# ================================================
+
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800) # Seconds
+HISTOGRAMS_KEY = "metrics:histograms"
+
+def histogram_key(stage: str, phase: str) -> str:
+    return f"metrics:histogram:{stage}:{phase}"
+
+def observe(redis_client: redis.Redis, stage: str, phase: str, seconds: float, pipeline: redis.client.Pipeline | None = None):
+    bucket = next((str(bound) for bound in HISTOGRAM_BUCKETS if seconds <= bound), "+Inf")
+    target = pipeline if pipeline is not None else redis_client.pipeline(transaction=False)
+
+    target.sadd(HISTOGRAMS_KEY, f"{stage}:{phase}")
+    target.hincrby(histogram_key(stage, phase), bucket, 1)
+    target.hincrbyfloat(histogram_key(stage, phase), "sum", seconds)
+    target.hincrby(histogram_key(stage, phase), "count", 1)
+
+    if pipeline is None:
+        target.execute()
+
+# ======== Timing jobs ========
+
+class StageTimer:
+    # Phase totals of the job running in this process. Phases that repeat (one per chunk) add up
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.timings: dict[str, float] = {}
+        self.job = get_current_job()
+
+        # Time spent in the queue (or waiting on other stages), until a worker picked it up
+        if self.job is not None and self.job.enqueued_at is not None and self.job.started_at is not None:
+            self.timings["queue_wait"] = max(0.0, (self.job.started_at - self.job.enqueued_at).total_seconds())
+
+    def add(self, phase: str, seconds: float):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def save(self, redis_client: redis.Redis, total: float):
+        self.timings["total"] = total
+
+        with redis_client.pipeline(transaction=False) as pipeline:
+            for phase, seconds in self.timings.items():
+                observe(redis_client, self.stage, phase, seconds, pipeline=pipeline)
+
+            assignment_id = self.job.meta.get("assignment_id") if self.job is not None else None
+            if assignment_id is not None:
+                timings = {phase: round(seconds, 3) for phase, seconds in self.timings.items()}
+                pipeline.hset(assignment_timings_key(assignment_id), self.job.id, json.dumps(timings))
+                pipeline.expire(assignment_timings_key(assignment_id), 604800) # Same lifetime as the assignment record
+
+            pipeline.execute()
+
+        print(f"[metrics] {self.stage}: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.timings.items()))
+
+_timer: StageTimer | None = None # Timer of the job running in this process, jobs never overlap within one
+
+def timed_stage(func: Callable) -> Callable:
+    # Decorates a job function so the spans inside it are recorded as the phases of its stage
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _timer
+        _timer = StageTimer(func.__name__)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer, _timer = _timer, None
+            try:
+                timer.save(get_redis_client(), time.perf_counter() - started)
+            except redis.exceptions.RedisError as e:
+                print(f"[metrics] Could not record the timings of {timer.stage}: {e}")
+
+    return wrapper
+
+@contextmanager
+def span(phase: str, stage: str = "worker"):
+    # Times a phase of the current job. Outside of a timed job (the API, batched predictions),
+    # the phase goes straight into the histogram of the given stage
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        if _timer is not None:
+            _timer.add(phase, seconds)
+        else:
+            try:
+                observe(get_redis_client(), stage, phase, seconds)
+            except redis.exceptions.RedisError as e:
+                print(f"[metrics] Could not record {stage}:{phase}: {e}")
+
+def timed(items: Iterable, phase: str, stage: str = "worker") -> Iterator:
+    # Times producing every item of items (reading a chunk, say), not what the caller does with it
+    iterator = iter(items)
+    while True:
+        with span(phase, stage):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+# ======== Prometheus exposition ========
+
+def _labels(**labels) -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def render_metrics(redis_client: redis.Redis, queues: list[Queue], health: Health | None = None) -> str:
+    lines: list[str] = []
+
+    def metric(name: str, type: str, help: str):
+        lines.append(f"# HELP {METRICS_PREFIX}_{name} {help}")
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} {type}")
+
+    def sample(name: str, value: float, **labels):
+        lines.append(f"{METRICS_PREFIX}_{name}{_labels(**labels) if labels else ''} {value}")
+
+    # ======== Phase durations ========
+
+    pairs = sorted(member.decode() for member in redis_client.smembers(HISTOGRAMS_KEY))
+    with redis_client.pipeline(transaction=False) as pipeline:
+        for pair in pairs:
+            pipeline.hgetall(histogram_key(*pair.split(":", 1)))
+        histograms = pipeline.execute()
+
+    metric("stage_phase_seconds", "histogram", "Time jobs spent in each phase of their stage.")
+    for pair, histogram in zip(pairs, histograms):
+        stage, phase = pair.split(":", 1)
+        cumulative = 0
+        for bound in [str(bound) for bound in HISTOGRAM_BUCKETS] + ["+Inf"]:
+            cumulative += int(histogram.get(bound.encode(), 0))
+            sample("stage_phase_seconds_bucket", cumulative, stage=stage, phase=phase, le=bound)
+        sample("stage_phase_seconds_sum", float(histogram.get(b"sum", 0)), stage=stage, phase=phase)
+        sample("stage_phase_seconds_count", int(histogram.get(b"count", 0)), stage=stage, phase=phase)
+
+    # ======== Queues ========
+
+    with redis_client.pipeline(transaction=False) as pipeline:
+        for queue in queues:
+            pipeline.llen(queue.key)
+            for registry in (StartedJobRegistry, DeferredJobRegistry, FailedJobRegistry):
+                pipeline.zcard(registry(queue.name, connection=redis_client).key)
+        counts = pipeline.execute()
+
+    metric("queue_jobs", "gauge", "Jobs per queue and state: queued, started, deferred (waiting on other stages) or failed.")
+    for index, queue in enumerate(queues):
+        for state, count in zip(("queued", "started", "deferred", "failed"), counts[index * 4:index * 4 + 4]):
+            sample("queue_jobs", count, queue=queue.name, state=state)
+
+    # Left out while unknown, before any job of the queue ended or without workers
+    metric("queue_estimated_wait_seconds", "gauge", "Seconds until a job enqueued now would start, what admission control checks.")
+    for queue in queues:
+        wait = estimate_queue_wait(redis_client, queue)
+        if wait is not None and math.isfinite(wait):
+            sample("queue_estimated_wait_seconds", round(wait, 3), queue=queue.name)
+
+    # ======== Workers ========
+
+    metric("workers", "gauge", "Registered workers per queue and state.")
+    for queue in queues:
+        states = {"busy": 0, "idle": 0}
+        for worker in Worker.all(queue=queue):
+            state = worker.get_state()
+            states[state] = states.get(state, 0) + 1
+        for state, count in states.items():
+            sample("workers", count, queue=queue.name, state=state)
+
+    # ======== Verdict cache ========
+
+    stats = verdict_stats(redis_client)
+    metric("verdict_cache_lookups_total", "counter", "Uploads answered from the verdict cache (hit) or sent through the pipeline (miss).")
+    for result, field in (("hit", "hits"), ("miss", "misses")):
+        sample("verdict_cache_lookups_total", stats[field], result=result)
+
+    # ======== Packet pre-filter ========
+
+    stats = prefilter_stats(redis_client)
+    metric("prefilter_packets_total", "counter", "Packets of captures seen by the pre-filter, by what it did with them.")
+    kept = stats["packets"] - stats["unflowable"] - stats["filtered"] - stats["duplicates"]
+    for result, count in (("kept", kept), ("unflowable", stats["unflowable"]),
+                          ("filtered", stats["filtered"]), ("duplicate", stats["duplicates"])):
+        sample("prefilter_packets_total", count, result=result)
+    metric("prefilter_bytes_total", "counter", "Bytes of the captures going into the pre-filter and of the reduced captures it wrote.")
+    for direction, field in (("in", "bytes_in"), ("out", "bytes_out")):
+        sample("prefilter_bytes_total", stats[field], direction=direction)
+    metric("prefilter_saved_seconds_total", "counter", "Estimated flow extraction time saved by the pre-filter, net of its own time.")
+    sample("prefilter_saved_seconds_total", stats["seconds_saved"])
+
+    # ======== Admission control ========
+
+    stats = admission_stats(redis_client)
+    metric("admission_refusals_total", "counter", "Uploads turned away, because of the queue backlog or the client's rate limit.")
+    for reason, count in stats.items():
+        sample("admission_refusals_total", count, reason=reason)
+
+    # ======== Health ========
+
+    if health is not None:
+        metric("service_up", "gauge", "Whether the API can reach each backing service.")
+        for service, status in vars(health).items():
+            sample("service_up", int(status.working), service=service)
+
+    return "\n".join(lines) + "\n"
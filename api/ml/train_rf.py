@@ -7,19 +7,35 @@ from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import classification_report
 import joblib
+import json
+import sys
+import os
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 
 from sklearn.linear_model import LogisticRegression
 from sklearn.svm import SVC
 
 import matplotlib.pyplot as plt
 
-DATA_DIR = Path("E:")
+DATA_DIR = Path(os.environ.get("CICIDS2018_DIR", "E:"))
 PATTERN = "*TrafficForML_CICFlowMeter.csv"
 TARGET_COL = "Label"
 NON_NUMERIC_COLS = ["Timestamp"]
+SKIPPED_FILES = ["Thuesday-20-02-2018"] #different columns (flow id, ips) than every other day
 
 #how much to sample from each file
 SAMPLE_FRAC = 0.05
+SAMPLE_SEED = 42
+
+#day files are sampled in parallel, each worker holding one chunk of CHUNK_ROWS rows at a time,
+#so peak memory is roughly SAMPLE_JOBS chunks plus the sample instead of a whole day file
+SAMPLE_JOBS = int(os.environ.get("SAMPLE_JOBS", os.cpu_count() or 1))
+CHUNK_ROWS = int(os.environ.get("CHUNK_ROWS", 200_000))
+
+#cleaned samples are kept here, keyed by the day files and the sampling settings, so retraining skips the csv parse
+CACHE_DIR = Path(__file__).resolve().parent / "cache"
 
 RARE_LABELS = {
     "SQL Injection",
@@ -33,9 +49,13 @@ def get_csv_files():
         raise RuntimeError(f"No CSV files matching {PATTERN} in {DATA_DIR}")
     return files
 
-def stratified_sample(df, frac, label_col=TARGET_COL):
-    #take a stratified random sample by label so each label contributes roughly frac of its rows
-    return df.groupby(label_col, group_keys=False).sample(frac=frac, random_state=42)
+def stratified_sample(df, frac, rng, label_col=TARGET_COL):
+    #keep every row with probability frac, decided per label, so each label contributes roughly frac of its rows.
+    #unlike sampling an exact share of every chunk, labels with a handful of rows per chunk aren't rounded away
+    keep = np.zeros(len(df), dtype=bool)
+    for _, rows in df.groupby(label_col, sort=False).indices.items():
+        keep[rows] = rng.random(len(rows)) < frac
+    return df[keep]
 
 def clean_and_split(df):
     #split into X, y, clean up values
@@ -52,59 +72,99 @@ def clean_and_split(df):
 
     return X,y, feature_cols
 
-def read_csv_safe(path):
-    try:
-        return pd.read_csv(
-            path,
-            encoding="latin1",
-            low_memory=False,
-            on_bad_lines="skip"
-        )
-    except UnicodeDecodeError:
-        print(f"   !! UTF-8 decode failed for {path.name}, trying latin1")
-        return pd.read_csv(
-            path,
-            encoding="latin1",
-            low_memory=False,
-            on_bad_lines="skip"
-        )
+def read_columns(path):
+    return list(pd.read_csv(path, encoding="latin1", nrows=0).columns)
+
+def read_csv_chunks(path, columns, numeric=True):
+    #only the columns we train on, numbers parsed straight to float64. the day files repeat their header
+    #line here and there, those rows come out as NaN and get dropped by clean_and_split
+    features = [c for c in columns if c not in (TARGET_COL, *NON_NUMERIC_COLS)]
+    return pd.read_csv(
+        path,
+        encoding="latin1",
+        usecols=features + [TARGET_COL],
+        dtype={**({c: "float64" for c in features} if numeric else {c: str for c in features}), TARGET_COL: str},
+        na_values={c: [c] for c in features},
+        chunksize=CHUNK_ROWS,
+        on_bad_lines="skip"
+    )
+
+def sample_file(path, frac=SAMPLE_FRAC, seed=SAMPLE_SEED):
+    #stream one day file and return its cleaned stratified sample, runs in a worker process
+    columns = read_columns(path)
 
-def load_sampled_data():
-    files = get_csv_files()
-    all_X = []
-    all_y = []
-    feature_cols = None
+    def sample_chunks(numeric):
+        rng = np.random.default_rng([seed, zlib.crc32(path.name.encode())]) #same sample on every run
+        rows, parts = 0, []
+        for chunk in read_csv_chunks(path, columns, numeric):
+            rows += len(chunk)
+            parts.append(clean_and_split(stratified_sample(chunk, frac, rng)))
+        return rows, parts
 
+    try:
+        rows, parts = sample_chunks(numeric=True)
+    except ValueError:
+        #something other than a repeated header in a numeric column, parse as text and coerce instead
+        print(f"   !! {path.name} has malformed values, parsing it as text")
+        rows, parts = sample_chunks(numeric=False)
+
+    X = pd.concat([X for X, _, _ in parts], ignore_index=True).astype(np.float64)
+    y = pd.concat([y for _, y, _ in parts], ignore_index=True)
+    print(f"  -> {path.name}: sampled {len(X)} clean rows from {rows}")
+    return X, y, parts[0][2]
+
+def sample_cache_path(files):
+    #day files are identified by name, size and modification time, like run_ml identifies model bundles.
+    #the draws depend on where the chunks start, so the chunk size is part of the key too
+    digest = hashlib.sha256(f"{SAMPLE_FRAC}:{SAMPLE_SEED}:{CHUNK_ROWS}:{sorted(RARE_LABELS)}\n".encode())
     for f in files:
-        if "Thuesday-20-02-2018" in f.name:
-            print(f"skipping bad file {f.name}")
-            continue
-        print(f"Loading {f.name}...")
-        df = read_csv_safe(f)
-        #df = pd.read_csv(f, encoding="latin1", low_memory=False, on_bad_lines="skip")
-        df_sample = stratified_sample(df,frac=SAMPLE_FRAC)
-        print(f"  -> sampled {len(df_sample)} rows from {len(df)}")
-
-        X_part, y_part, f_cols = clean_and_split(df_sample)
-        if feature_cols is None:
-            feature_cols = f_cols
-        else:
-            if feature_cols != f_cols:
-                raise ValueError("Feature columns mismatch in {f}")
-        all_X.append(X_part)
-        all_y.append(y_part)
-        print(f" sampled {len(X_part)} rows")
-
-    X = pd.concat(all_X, ignore_index=True)
-    y = pd.concat(all_y, ignore_index=True)
-
-    mask = ~y.isin(RARE_LABELS)
-    removed = len(y) - mask.sum()
-    if removed>0:
-        print(f"\nDropping {removed} rows from rare classes: {RARE_LABELS}")
-    
-    X = X[mask]
-    y = y[mask]
+        stat = f.stat()
+        digest.update(f"{f.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return CACHE_DIR / f"sample-{digest.hexdigest()[:16]}.npz"
+
+def save_sample(path, X, y, feature_cols):
+    #column major, so every feature is one contiguous run, and uncompressed so loading is a plain read
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savez(path, X=np.asfortranarray(X.to_numpy(dtype=np.float64)), y=y.to_numpy(dtype=str), feature_names=np.array(feature_cols, dtype=str))
+    print(f"Cached the cleaned sample in {path.resolve()}")
+
+def load_sample(path):
+    with np.load(path) as data:
+        feature_cols = data["feature_names"].tolist()
+        X = pd.DataFrame(data["X"], columns=feature_cols)
+        y = pd.Series(data["y"], name=TARGET_COL)
+    return X, y, feature_cols
+
+def load_sampled_data(use_cache=True):
+    files = [f for f in get_csv_files() if not any(skipped in f.name for skipped in SKIPPED_FILES)]
+
+    cache_path = sample_cache_path(files)
+    if use_cache and cache_path.exists():
+        print(f"Loading the cleaned sample from {cache_path}")
+        X, y, feature_cols = load_sample(cache_path)
+    else:
+        jobs = max(1, min(SAMPLE_JOBS, len(files)))
+        print(f"Sampling {len(files)} files with {jobs} processes, {CHUNK_ROWS} rows at a time...")
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            samples = list(pool.map(sample_file, files))
+
+        feature_cols = samples[0][2]
+        for f, (_, _, f_cols) in zip(files, samples):
+            if f_cols != feature_cols:
+                raise ValueError(f"Feature columns mismatch in {f}")
+
+        X = pd.concat([X_part for X_part, _, _ in samples], ignore_index=True)
+        y = pd.concat([y_part for _, y_part, _ in samples], ignore_index=True)
+
+        mask = ~y.isin(RARE_LABELS)
+        removed = len(y) - mask.sum()
+        if removed>0:
+            print(f"\nDropping {removed} rows from rare classes: {RARE_LABELS}")
+
+        X = X[mask].reset_index(drop=True)
+        y = y[mask].reset_index(drop=True)
+
+        save_sample(cache_path, X, y, feature_cols)
 
     print(f"\nTotal training rows after sampling and cleaning: {len(X)}")
     print("Label distribution:")
@@ -144,8 +204,108 @@ def save_rf_feature_importance_plot(rf_pipeline, feature_cols, out_png: Path, to
     print(f"saved feature importance plt to: {out_png.resolve()}")
 
 
+def _ordered_keys(x):
+    #map float64 to int64 keys that sort the same way as the floats
+    bits = x.view(np.int64)
+    return np.where(bits < 0, -(bits & np.int64(0x7FFFFFFFFFFFFFFF)), bits)
+
+def _floats_from_keys(keys):
+    bits = np.where(keys < 0, (-keys) | np.int64(-0x8000000000000000), keys)
+    return bits.view(np.float64)
+
+def fold_scaler_into_thresholds(threshold, mean, scale):
+    #sklearn tests float32((x - mean) / scale) <= threshold. that is monotone in x, so it equals x <= T for
+    #the largest float64 T that still passes. find T exactly by bisecting over the ordered float64 bit patterns
+    passes = lambda keys: ((_floats_from_keys(keys) - mean) / scale).astype(np.float32) <= threshold
+
+    lo = np.full(len(threshold), _ordered_keys(np.array([-np.finfo(np.float64).max]))[0])
+    hi = np.full(len(threshold), _ordered_keys(np.array([np.finfo(np.float64).max]))[0])
+    with np.errstate(over="ignore", invalid="ignore"):
+        for _ in range(65):
+            mid = (lo >> 1) + (hi >> 1) + (lo & hi & 1)
+            ok = passes(mid)
+            lo = np.where(ok, mid, lo)
+            hi = np.where(ok, hi, mid)
+
+    return _floats_from_keys(lo)
+
+def compile_forest(pipeline, feature_cols, out_dir: Path):
+    #flatten a StandardScaler + RandomForestClassifier pipeline into plain arrays that run_ml.CompiledForest
+    #can memory map. nodes of every tree are renumbered breadth first so siblings sit next to each other:
+    #an internal node goes to child[node] + (x[feature] > threshold), a leaf points at itself
+    scaler = pipeline.named_steps["standardscaler"]
+    rf = pipeline.named_steps["randomforestclassifier"]
+    trees = [estimator.tree_ for estimator in rf.estimators_]
+
+    sizes = np.array([tree.node_count for tree in trees])
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    left = np.concatenate([np.where(t.children_left >= 0, t.children_left + o, -1) for t, o in zip(trees, offsets)])
+    right = np.concatenate([np.where(t.children_right >= 0, t.children_right + o, -1) for t, o in zip(trees, offsets)])
+    feature = np.concatenate([t.feature for t in trees]).astype(np.int64)
+    threshold = np.concatenate([t.threshold for t in trees])
+    value = np.concatenate([t.value[:, 0, :] for t in trees])
+
+    #breadth first renumbering inside each tree's own block of ids (the root keeps the first one),
+    #one level of every tree at a time
+    tree_of = np.repeat(np.arange(len(trees)), sizes)
+    new_id = np.empty(len(left), dtype=np.int64)
+    new_id[offsets] = offsets
+    used = np.ones(len(trees), dtype=np.int64)
+    child = np.zeros(len(left), dtype=np.int64)
+    frontier = offsets
+    while len(frontier):
+        parents = frontier[left[frontier] >= 0]
+        tree = tree_of[parents]
+        counts = np.bincount(tree, minlength=len(trees))
+        rank = np.arange(len(parents)) - (np.cumsum(counts) - counts)[tree]
+        first_child = offsets[tree] + used[tree] + 2 * rank
+        used += 2 * counts
+        child[new_id[parents]] = first_child
+        new_id[left[parents]] = first_child
+        new_id[right[parents]] = first_child + 1
+        frontier = np.stack([left[parents], right[parents]], axis=1).ravel()
+
+    is_leaf = left < 0
+    order = np.argsort(new_id) #old node for every new id
+    leaf = is_leaf[order]
+
+    compiled_feature = np.where(leaf, 0, feature[order]).astype(np.int32)
+    compiled_child = np.where(leaf, np.arange(len(order)), child).astype(np.int32)
+
+    internal_features = feature[order][~leaf]
+    compiled_threshold = np.full(len(order), np.inf)
+    compiled_threshold[~leaf] = fold_scaler_into_thresholds(
+        threshold[order][~leaf], scaler.mean_[internal_features], scaler.scale_[internal_features])
+
+    #leaf probabilities exactly as DecisionTreeClassifier.predict_proba returns them. sklearn >= 1.4 already
+    #stores fractions, older versions store weighted counts and normalize at predict time. pure leaves
+    #(almost all of them in fully grown trees) only store their class, the rest index a small table
+    proba = value[order][leaf]
+    if not np.allclose(proba.sum(axis=1), 1.0):
+        normalizer = proba.sum(axis=1)
+        normalizer[normalizer == 0.0] = 1.0
+        proba /= normalizer[:, None]
+    pure = (np.count_nonzero(proba, axis=1) == 1) & (proba.max(axis=1) == 1.0)
+    leaf_code = np.zeros(len(order), dtype=np.int32)
+    leaf_code[np.flatnonzero(leaf)[pure]] = proba[pure].argmax(axis=1)
+    leaf_code[np.flatnonzero(leaf)[~pure]] = -1 - np.arange((~pure).sum())
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.save(out_dir / "feature.npy", compiled_feature)
+    np.save(out_dir / "threshold.npy", compiled_threshold)
+    np.save(out_dir / "child.npy", compiled_child)
+    np.save(out_dir / "roots.npy", offsets.astype(np.int32))
+    np.save(out_dir / "leaf.npy", leaf_code)
+    np.save(out_dir / "impure_proba.npy", proba[~pure])
+    np.save(out_dir / "classes.npy", np.asarray(rf.classes_).astype(str))
+    with open(out_dir / "meta.json", "w") as f:
+        json.dump({"feature_names": list(feature_cols), "n_trees": len(trees), "max_depth": int(max(t.max_depth for t in trees))}, f)
+
+    print(f"Compiled {len(trees)} trees ({len(order)} nodes, {(~pure).sum()} impure leaves) to {out_dir.resolve()}")
+
+
 def main():
-    X,y, feature_cols = load_sampled_data()
+    X,y, feature_cols = load_sampled_data(use_cache="--refresh-sample" not in sys.argv)
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=42)
     #pipeline to scale numeric features 
     #---------------RF-----------------
@@ -185,6 +345,9 @@ def main():
     )
     print(f"\nSaved model to {out_path.resolve()}")
 
+    #array-backed copy of the forest for run_ml's compiled engine
+    compile_forest(model, feature_cols, api_dir / "ml" / "rf_cicids2018.compiled")
+
     #RF feature importance plot
     out_png = api_dir/"ml"/"rf_feature_importance_top25.png"
     save_rf_feature_importance_plot(rf_model, feature_cols, out_png, top_n=25)
@@ -216,6 +379,16 @@ def main():
     _=evaluate_model("SVM RBF", svm_rbf_model, X_train,X_test,y_train,y_test)
 
 
+def compile_saved_bundle():
+    #re-export the compiled forest from an existing joblib bundle without retraining
+    api_dir = Path(__file__).resolve().parents[1]
+    bundle = joblib.load(api_dir / "ml" / "rf_cicids2018.joblib")
+    compile_forest(bundle["model"], bundle["feature_names"], api_dir / "ml" / "rf_cicids2018.compiled")
+
+
 if __name__ == "__main__":
-    main()
+    if "--compile-only" in sys.argv:
+        compile_saved_bundle()
+    else:
+        main()
 
@@ -0,0 +1,301 @@
+# Packet pre-filter, run on a capture before it reaches the flow extractor.
+#
+# CICFlowMeter's time grows with every packet it decodes, including the ones it can never turn into a flow.
+# The capture is memory-mapped and indexed (see flow_extractor.index_capture) and a reduced pcap is written
+# in its place, without:
+#
+#     - records the extractor makes no flow of: anything that isn't IPv4/IPv6 (ARP, STP...), and for the native
+#       extractor also ICMP, fragments and other IP protocols. CICFlowMeter turns those into Protocol 0 flows, so
+#       they stay in captures headed for it
+#     - packets rejected by PREFILTER_RULES, a subset of tcpdump's filter syntax
+#     - exact duplicates of a packet seen less than PREFILTER_DEDUP_WINDOW_US earlier (SPAN ports, mirrored taps)
+#     - bytes past PREFILTER_SNAPLEN in each packet
+#
+# pcapng captures headed for CICFlowMeter are always rewritten, as the classic pcap jnetpcap reads best.
+#
+#     prefilter:stats    hash of packet, byte and estimated extraction-seconds-saved counters
+
+from flow_extractor import (FLOW_EXTRACTOR, HEADER_WINDOW, PCAPNG_MAGIC, Packets, CaptureFormatError,
+                            index_capture, parse_packets, record_digests, write_pcap)
+
+from typing import Callable
+import numpy as np
+import ipaddress
+import redis
+import mmap
+import time
+import os
+import re
+
+# ================================================
+#               Pre-filter Settings
+# ================================================
+
+PREFILTER = int(os.environ.get("PREFILTER", 1)) # 0 hands captures to the extractor untouched
+PREFILTER_RULES = os.environ.get("PREFILTER_RULES", "") # Packets to keep, e.g. "not port 53 and not host 10.0.0.1"
+PREFILTER_DEDUP_WINDOW_US = int(os.environ.get("PREFILTER_DEDUP_WINDOW_US", 1_000)) # 0 keeps duplicates
+
+# CICFlowMeter measures packet lengths from the captured bytes, so only the native extractor (which reads the
+# IP length fields) can be given truncated packets. 0 keeps whole packets
+PREFILTER_SNAPLEN = int(os.environ.get("PREFILTER_SNAPLEN", 2 * HEADER_WINDOW if FLOW_EXTRACTOR == "native" else 0))
+
+# ================================================
+
+STATS_KEY = "prefilter:stats"
+
+class RuleError(ValueError):
+    pass
+
+# ================================================
+#                  Filter Rules
+# ================================================
+
+# Grammar, evaluated on the packets the extractor makes flows of (other IP protocols have ports 0):
+#
+#     expression := term (("or" | "||") term)*
+#     term       := factor (("and" | "&&") factor)*
+#     factor     := ("not" | "!") factor | "(" expression ")" | primitive
+#     primitive  := "tcp" | "udp" | "ip" | "ip6" [primitive]
+#                 | ["src" | "dst"] ("host" <address> | "net" <cidr> | "port" <n> | "portrange" <n>-<n>)
+
+Rule = Callable[[Packets], np.ndarray]
+
+TOKEN = re.compile(r"\(|\)|&&|\|\||!|[^\s()!]+")
+MAPPED = 0xFFFF00000000 # IPv4 addresses are stored IPv4-mapped, see flow_extractor._parse_chunk
+
+def compile_rules(rules: str) -> Rule | None:
+    tokens = TOKEN.findall(rules.lower())
+    if not tokens:
+        return None
+
+    position = 0
+
+    def peek() -> str | None:
+        return tokens[position] if position < len(tokens) else None
+
+    def take(what: str = "a filter rule") -> str:
+        nonlocal position
+        if position >= len(tokens):
+            raise RuleError(f"Expected {what} at the end of {rules!r}")
+        position += 1
+        return tokens[position - 1]
+
+    def expression() -> Rule:
+        rule = term()
+        while peek() in ("or", "||"):
+            take()
+            rule = _either(rule, term())
+        return rule
+
+    def term() -> Rule:
+        rule = factor()
+        while peek() in ("and", "&&"):
+            take()
+            rule = _both(rule, factor())
+        return rule
+
+    def factor() -> Rule:
+        token = take()
+        if token in ("not", "!"):
+            inner = factor()
+            return lambda packets: ~inner(packets)
+        if token == "(":
+            rule = expression()
+            if take("')'") != ")":
+                raise RuleError(f"Expected ')' in {rules!r}")
+            return rule
+        return primitive(token)
+
+    def primitive(token: str) -> Rule:
+        if token in ("tcp", "udp", "ip", "ip6"):
+            rule = _protocol(token)
+            if peek() in ("src", "dst", "host", "net", "port", "portrange"): # "tcp port 80" is "tcp and port 80"
+                rule = _both(rule, primitive(take()))
+            return rule
+
+        direction = None
+        if token in ("src", "dst"):
+            direction, token = token, take("host, net, port or portrange")
+
+        if token not in ("host", "net", "port", "portrange"):
+            raise RuleError(f"Unknown filter primitive {token!r} in {rules!r}")
+
+        argument = take(f"an argument for {token}")
+        try:
+            if token in ("host", "net"):
+                return _address(direction, ipaddress.ip_network(argument, strict=token == "host"))
+            low, _, high = argument.partition("-") if token == "portrange" else (argument, "", argument)
+            return _port(direction, int(low), int(high))
+        except ValueError:
+            raise RuleError(f"Invalid {token} {argument!r} in {rules!r}")
+
+    rule = expression()
+    if peek() is not None:
+        raise RuleError(f"Unexpected {peek()!r} in {rules!r}")
+
+    return rule
+
+def _either(first: Rule, second: Rule) -> Rule:
+    return lambda packets: first(packets) | second(packets)
+
+def _both(first: Rule, second: Rule) -> Rule:
+    return lambda packets: first(packets) & second(packets)
+
+def _endpoints(direction: str | None, src, dst) -> Rule:
+    # pcap semantics: without a direction either endpoint may match
+    if direction == "src":
+        return src
+    if direction == "dst":
+        return dst
+    return _either(src, dst)
+
+def _is_ipv4(hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    return (hi == 0) & ((lo >> np.uint64(32)) == np.uint64(0xFFFF))
+
+def _protocol(name: str) -> Rule:
+    if name == "tcp":
+        return lambda packets: packets.proto == 6
+    if name == "udp":
+        return lambda packets: packets.proto == 17
+    if name == "ip":
+        return lambda packets: _is_ipv4(packets.src_hi, packets.src_lo)
+    return lambda packets: ~_is_ipv4(packets.src_hi, packets.src_lo)
+
+def _address(direction: str | None, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> Rule:
+    # Compare the top prefixlen bits of the 128-bit address, IPv4 networks as their IPv4-mapped form
+    address, prefix = int(network.network_address), network.prefixlen
+    if network.version == 4:
+        address, prefix = address | MAPPED, prefix + 96
+
+    mask = ((1 << 128) - 1) ^ ((1 << (128 - prefix)) - 1)
+    hi, lo = np.uint64(address >> 64), np.uint64(address & (2 ** 64 - 1))
+    mask_hi, mask_lo = np.uint64(mask >> 64), np.uint64(mask & (2 ** 64 - 1))
+
+    def matches(address_hi: np.ndarray, address_lo: np.ndarray) -> np.ndarray:
+        return ((address_hi & mask_hi) == hi) & ((address_lo & mask_lo) == lo)
+
+    return _endpoints(direction,
+                      lambda packets: matches(packets.src_hi, packets.src_lo),
+                      lambda packets: matches(packets.dst_hi, packets.dst_lo))
+
+def _port(direction: str | None, low: int, high: int) -> Rule:
+    if not 0 <= low <= high <= 65535:
+        raise ValueError("Port out of range")
+
+    return _endpoints(direction,
+                      lambda packets: (packets.sport >= low) & (packets.sport <= high),
+                      lambda packets: (packets.dport >= low) & (packets.dport <= high))
+
+RULES = compile_rules(PREFILTER_RULES) # Fail on a bad rule when the worker starts, not on its first job
+
+# ================================================
+#                Capture Reduction
+# ================================================
+
+class Reduction:
+    # What the pre-filter took out of one capture
+
+    def __init__(self, packets: int, unflowable: int, filtered: int, duplicates: int,
+                 bytes_in: int, bytes_out: int, seconds: float):
+        self.packets = packets
+        self.unflowable = unflowable
+        self.filtered = filtered
+        self.duplicates = duplicates
+        self.kept = packets - unflowable - filtered - duplicates
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.seconds = seconds
+
+    def estimated_savings(self, extraction_seconds: float) -> float:
+        # The extractor's time grows with the packets it reads, so the packets removed would have cost
+        # about as much per packet as the ones it did read, minus what the pre-filter itself took
+        return extraction_seconds * (self.packets / max(self.kept, 1) - 1) - self.seconds
+
+def duplicate_records(data, index, records: np.ndarray, window: int = PREFILTER_DEDUP_WINDOW_US) -> np.ndarray:
+    # Marks each record whose bytes repeat an earlier record's at most window microseconds before it.
+    # Records are grouped on a digest of their leading bytes, only candidates are compared in full
+    duplicate = np.zeros(len(records), dtype=bool)
+    if window <= 0 or len(records) < 2:
+        return duplicate
+
+    digest, ts = record_digests(data, index, records), index.ts[records]
+    order = np.lexsort((ts, digest)) # Stable, so the first copy of a packet is the one kept
+    digest, ts = digest[order], ts[order]
+    candidates = np.flatnonzero((digest[1:] == digest[:-1]) & (ts[1:] - ts[:-1] <= window))
+
+    offsets, caplens = index.offset[records], index.caplen[records]
+    with memoryview(data) as view:
+        for first, second in zip(order[candidates].tolist(), order[candidates + 1].tolist()):
+            a, b = offsets[first], offsets[second]
+            if view[a:a + caplens[first]] == view[b:b + caplens[second]]:
+                duplicate[second] = True
+
+    return duplicate
+
+def prefilter_capture(path: str, rules: Rule | None = RULES, snaplen: int = PREFILTER_SNAPLEN) -> Reduction | None:
+    # Replace the capture at path with its reduced pcap. Returns None when it was left as it is:
+    # nothing to remove, not a capture we can read, or nothing at all would be left of it
+    started = time.perf_counter()
+    reduced_path = path + ".prefilter"
+
+    with open(path, "rb") as f:
+        bytes_in = os.fstat(f.fileno()).st_size
+        if bytes_in == 0:
+            return None
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            try:
+                index = index_capture(data)
+            except CaptureFormatError:
+                return None
+
+            if len(set(index.linktype.tolist())) > 1:
+                return None # Mixed link types can't be written back to one pcap
+
+            packets = parse_packets(data, index, other_ip=FLOW_EXTRACTOR != "native")
+            unflowable = len(index) - len(packets)
+
+            filtered = 0
+            if rules is not None:
+                keep = rules(packets)
+                filtered = len(packets) - int(keep.sum())
+                packets = packets.take(keep)
+
+            duplicate = duplicate_records(data, index, packets.record)
+            records = packets.record[~duplicate]
+
+            truncated = snaplen > 0 and bool((index.caplen[records] > snaplen).any())
+            converted = FLOW_EXTRACTOR != "native" and bytes(data[:4]) == PCAPNG_MAGIC
+            if len(records) == 0 or (len(records) == len(index) and not truncated and not converted):
+                return None
+
+            write_pcap(reduced_path, data, index, records, snaplen=snaplen)
+
+    os.replace(reduced_path, path)
+
+    return Reduction(len(index), unflowable, filtered, int(duplicate.sum()),
+                     bytes_in, os.path.getsize(path), time.perf_counter() - started)
+
+def report_reduction(redis_client: redis.Redis, name: str, reduction: Reduction, extraction_seconds: float):
+    saved = reduction.estimated_savings(extraction_seconds)
+
+    print(f"[prefilter] {name}: kept {reduction.kept:,} of {reduction.packets:,} packets "
+          f"({reduction.unflowable:,} without flows, {reduction.filtered:,} filtered, {reduction.duplicates:,} duplicates), "
+          f"{reduction.bytes_in / 1e6:.1f} -> {reduction.bytes_out / 1e6:.1f} MB in {reduction.seconds:.2f}s, "
+          f"saving about {saved:.2f}s of extraction")
+
+    try:
+        with redis_client.pipeline(transaction=False) as pipeline:
+            for field, value in (("packets", reduction.packets), ("unflowable", reduction.unflowable),
+                                 ("filtered", reduction.filtered), ("duplicates", reduction.duplicates),
+                                 ("bytes_in", reduction.bytes_in), ("bytes_out", reduction.bytes_out)):
+                pipeline.hincrby(STATS_KEY, field, value)
+            pipeline.hincrbyfloat(STATS_KEY, "seconds_saved", saved)
+            pipeline.execute()
+    except redis.exceptions.RedisError as e:
+        print(f"[prefilter] Could not record the reduction of {name}: {e}")
+
+def prefilter_stats(redis_client: redis.Redis) -> dict[str, float]:
+    stats = redis_client.hgetall(STATS_KEY)
+    fields = ("packets", "unflowable", "filtered", "duplicates", "bytes_in", "bytes_out", "seconds_saved")
+    return {name: float(stats.get(name.encode(), 0)) for name in fields}
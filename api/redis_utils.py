@@ -2,8 +2,17 @@ from api_types import *
 
 from collections.abc import Callable
 from rq.job import Job
-from rq import Queue
+from rq import Queue, Callback, Worker, SimpleWorker
+from rq.worker_registration import WORKERS_BY_QUEUE_KEY
+from rq.job import Dependency
+from rq.results import Result
+from rq.job import JobStatus
+from rq.utils import now
+from rq import get_current_job
+from typing import Any, Literal
 import redis
+import json
+import math
 import os
 
 # ================================================
@@ -13,20 +22,146 @@ import os
 REDIS_HOSTNAME = os.environ.get("REDIS_HOST", "redis")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", None)
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 32)) # Per process
 
 PCAP_JOBS_QUEUE = os.environ.get("PCAP_JOBS_QUEUE", "pcap_jobs")
 ML_JOBS_QUEUE = os.environ.get("ML_JOBS_QUEUE", "ml_jobs")
 
+# ================================================
+#                Scheduling Settings
+# ================================================
+
+# Captures up to FAST_LANE_MAX_MB go through the fast lane (the queues above), larger ones through the bulk lane
+FAST_LANE_MAX_SIZE = int(os.environ.get("FAST_LANE_MAX_MB", 32)) * 1024 * 1024
+PCAP_BULK_JOBS_QUEUE = os.environ.get("PCAP_BULK_JOBS_QUEUE", f"{PCAP_JOBS_QUEUE}_bulk")
+ML_BULK_JOBS_QUEUE = os.environ.get("ML_BULK_JOBS_QUEUE", f"{ML_JOBS_QUEUE}_bulk")
+
+WORKER_LANES = os.environ.get("WORKER_LANES", "fast,bulk").split(",") # Lanes a worker serves, "fast" dedicates it to small captures
+FAST_LANE_WEIGHT = int(os.environ.get("FAST_LANE_WEIGHT", 4)) # Fast jobs a worker serving both lanes takes before one bulk job
+
+JOB_TTL_MIN = int(os.environ.get("JOB_TTL_MIN", 300)) # Seconds a queued job waits for a worker at least, and all it gets without history
+JOB_TTL_MAX = int(os.environ.get("JOB_TTL_MAX", 24 * 60 * 60))
+JOB_TTL_FACTOR = float(os.environ.get("JOB_TTL_FACTOR", 3)) # Headroom over the estimated queue wait
+
 # ================================================
 
+_redis_clients: dict[int, redis.Redis] = {} # Process ID -> that process' shared client
+
 def get_redis_client() -> redis.Redis:
-    return redis.Redis(host=REDIS_HOSTNAME, port=REDIS_PORT, password=REDIS_PASSWORD)
+    # One pooled client per process. Keyed by PID so a forked job never reuses its parent's sockets
+    pid = os.getpid()
+    client = _redis_clients.get(pid)
+    if client is None:
+        pool = redis.BlockingConnectionPool(
+            host=REDIS_HOSTNAME,
+            port=REDIS_PORT,
+            password=REDIS_PASSWORD,
+            max_connections=REDIS_MAX_CONNECTIONS
+        )
+        client = _redis_clients.setdefault(pid, redis.Redis(connection_pool=pool)) # First thread in wins
+    
+    return client
+
+# ======== Lanes ========
+
+# Every stage has a fast and a bulk queue. The API picks the lane from the size of the capture, and each stage
+# enqueues the next one in its own lane, so a multi-gigabyte capture never sits in front of a small one.
+
+FAST_LANE = "fast"
+BULK_LANE = "bulk"
+
+def lane_for_size(file_size: int) -> str:
+    return FAST_LANE if file_size <= FAST_LANE_MAX_SIZE else BULK_LANE
+
+def current_lane() -> str:
+    # Lane of the job running in this worker, the API (no job) is always in the fast lane
+    job = get_current_job()
+    return job.meta.get("lane", FAST_LANE) if job is not None else FAST_LANE
+
+def get_pcap_queue(redis_client: redis.Redis, lane: str = FAST_LANE) -> Queue:
+    return Queue(name=PCAP_JOBS_QUEUE if lane == FAST_LANE else PCAP_BULK_JOBS_QUEUE, connection=redis_client)
+
+def get_ml_queue(redis_client: redis.Redis, lane: str = FAST_LANE) -> Queue:
+    return Queue(name=ML_JOBS_QUEUE if lane == FAST_LANE else ML_BULK_JOBS_QUEUE, connection=redis_client)
+
+def get_pcap_queues(redis_client: redis.Redis, lanes: list[str] = [FAST_LANE, BULK_LANE]) -> list[Queue]:
+    return [get_pcap_queue(redis_client, lane) for lane in lanes]
+
+def get_ml_queues(redis_client: redis.Redis, lanes: list[str] = [FAST_LANE, BULK_LANE]) -> list[Queue]:
+    return [get_ml_queue(redis_client, lane) for lane in lanes]
+
+def queue_lane(queue: Queue) -> str:
+    return BULK_LANE if queue.name in (PCAP_BULK_JOBS_QUEUE, ML_BULK_JOBS_QUEUE) else FAST_LANE
+
+class WeightedLaneWorker(Worker):
+    # Serves the fast lane first, but after FAST_LANE_WEIGHT fast jobs in a row the bulk lane goes first
+    # for one dequeue, so large captures keep moving while small ones arrive. An empty lane is skipped either way.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fast_in_a_row = 0
+        self._ordered_queues.sort(key=lambda queue: queue_lane(queue) != FAST_LANE)
+
+    def reorder_queues(self, reference_queue: Queue):
+        if queue_lane(reference_queue) == FAST_LANE:
+            self._fast_in_a_row += 1
+        else:
+            self._fast_in_a_row = 0
 
-def get_pcap_queue(redis_client: redis.Redis) -> Queue:
-    return Queue(name=PCAP_JOBS_QUEUE, connection=redis_client)
+        bulk_first = self._fast_in_a_row >= FAST_LANE_WEIGHT
+        self._ordered_queues.sort(key=lambda queue: (queue_lane(queue) == FAST_LANE) == bulk_first)
 
-def get_ml_queue(redis_client: redis.Redis) -> Queue:
-    return Queue(name=ML_JOBS_QUEUE, connection=redis_client)
+class SimpleWeightedLaneWorker(WeightedLaneWorker, SimpleWorker):
+    pass
+
+# ======== Job TTL ========
+
+# Jobs that aren't picked up within their TTL expire. Instead of a constant, the TTL covers a few times the
+# wait we expect right now: jobs ahead in the queue, spread over the workers serving it, each taking
+# as long as recent jobs of the queue took on average.
+
+SERVICE_TIME_KEY = "queues:service_seconds" # Queue name -> moving average of how long its jobs run
+SERVICE_TIME_ALPHA = 0.2 # Weight of the newest job in the moving average
+
+def record_service_time(redis_client: redis.Redis, job: Job):
+    # Called when a job ended. Two workers finishing at once may overwrite each other's update, which only
+    # drops one sample from the average
+    if job.started_at is None:
+        return
+    
+    seconds = max(0.0, ((job.ended_at or now()) - job.started_at).total_seconds())
+    average = redis_client.hget(SERVICE_TIME_KEY, job.origin)
+    average = seconds if average is None else (1 - SERVICE_TIME_ALPHA) * float(average) + SERVICE_TIME_ALPHA * seconds
+    redis_client.hset(SERVICE_TIME_KEY, job.origin, round(average, 3))
+
+def queue_load(redis_client: redis.Redis, queue: Queue) -> tuple[int, int, float | None]:
+    # Jobs waiting in the queue, workers serving it and how long its jobs run on average (None before any ended)
+    with redis_client.pipeline(transaction=False) as pipeline:
+        pipeline.llen(queue.key)
+        pipeline.scard(WORKERS_BY_QUEUE_KEY % queue.name)
+        pipeline.hget(SERVICE_TIME_KEY, queue.name)
+        queued, workers, average = pipeline.execute()
+    
+    return queued, workers, float(average) if average is not None else None
+
+def estimate_queue_wait(redis_client: redis.Redis, queue: Queue) -> float | None:
+    # Seconds until a job enqueued now would start, None before any job of the queue ended, infinite without workers
+    return queue_wait(*queue_load(redis_client, queue))
+
+def queue_wait(queued: int, workers: int, average: float | None) -> float | None:
+    if average is None:
+        return None
+    if not workers:
+        return math.inf
+    
+    return (queued // workers + 1) * average # Its own turn included
+
+def estimate_job_ttl(redis_client: redis.Redis, queue: Queue) -> int:
+    wait = estimate_queue_wait(redis_client, queue)
+    if wait is None:
+        return JOB_TTL_MIN # Nothing to go on yet
+    
+    return int(min(JOB_TTL_MAX, max(JOB_TTL_MIN, JOB_TTL_FACTOR * wait))) # Without workers, wait as long as allowed for one
 
 def enqueue_job(redis_client: redis.Redis, 
                 queue: Queue,
@@ -34,38 +169,257 @@ def enqueue_job(redis_client: redis.Redis,
                 assignment: Assignment,
                 func: Callable, 
                 *args, 
+                depends_on: Dependency | list[str] | None = None,
+                ttl: int | None | Literal["estimate"] = "estimate",
+                meta: dict[str, Any] | None = None,
                 **kwargs,
                 ) -> Assignment:
+    if ttl == "estimate":
+        ttl = estimate_job_ttl(redis_client, queue)
+    
     # Enqueue the job in redis queue  
     job = queue.enqueue(
                     func, 
                     args=args, 
                     kwargs=kwargs, 
                     connection=redis_client,
+                    depends_on=depends_on, # Held back until these jobs finish
                     result_ttl=604800, # Keep results for 7 days
-                    ttl=300 # Job expires in 5 minutes if not started
+                    ttl=ttl, # Expires if not started in time, None waits forever
+                    meta=job_meta(queue, stage, assignment, meta),
+                    on_success=Callback(publish_job_finished),
+                    on_failure=Callback(publish_job_failed)
                     )
     
-    # Write down the job's new ID
-    stage.id = job.id
+    # Record the new stage and announce it in one MULTI/EXEC, concurrent stages each push their own entry
+    with redis_client.pipeline() as pipeline:
+        event = record_stage(pipeline, stage, assignment, job)
+        publish_assignment_event(redis_client, event, pipeline=pipeline)
     
-    # Append the stage to the assignment
+    return assignment
+
+def enqueue_jobs(redis_client: redis.Redis,
+                 pipeline: redis.client.Pipeline,
+                 jobs: list[tuple[Queue, Stage, Assignment, Callable, tuple]]
+                 ) -> list[AssignmentEvent]:
+    # enqueue_job for many (queue, stage, assignment, func, args) at once, through RQ's bulk enqueue and without
+    # dependencies. Everything is queued on pipeline, the caller commits and announces the returned events
+    # with publish_assignment_events
+    ttls = {queue.name: estimate_job_ttl(redis_client, queue) for queue, *_ in jobs}
+    by_queue: dict[str, tuple[Queue, list[int]]] = {}
+    for position, (queue, *_) in enumerate(jobs):
+        by_queue.setdefault(queue.name, (queue, []))[1].append(position)
+    
+    enqueued: list[Job | None] = [None] * len(jobs)
+    for name, (queue, positions) in by_queue.items():
+        data = [Queue.prepare_data(
+                    func,
+                    args=args,
+                    result_ttl=604800,
+                    ttl=ttls[name],
+                    meta=job_meta(queue, stage, assignment),
+                    on_success=Callback(publish_job_finished),
+                    on_failure=Callback(publish_job_failed)
+                ) for queue, stage, assignment, func, args in (jobs[position] for position in positions)]
+        
+        for position, job in zip(positions, queue.enqueue_many(data, pipeline=pipeline)):
+            enqueued[position] = job
+    
+    return [record_stage(pipeline, stage, assignment, job) for (_, stage, assignment, _, _), job in zip(jobs, enqueued)]
+
+def job_meta(queue: Queue, stage: Stage, assignment: Assignment, meta: dict[str, Any] | None = None) -> dict[str, Any]:
+    return {"assignment_id": assignment.id, "stage": stage.name, "lane": queue_lane(queue), **(meta or {})}
+
+def record_stage(pipeline: redis.client.Pipeline, stage: Stage, assignment: Assignment, job: Job) -> AssignmentEvent:
+    # Write down the job's new ID, append the stage to the assignment and its record, and return the event announcing it
+    stage.id = job.id
     assignment.stages.append(stage)
     
-    # Record the assignment changes in Redis
-    redis_client.set(f"assignment:{assignment.id}", assignment.model_dump_json(), ex=604800) # Assignment record expires in 7 days
+    pipeline.rpush(assignment_stages_key(assignment.id), stage.model_dump_json())
+    pipeline.expire(assignment_stages_key(assignment.id), 604800) # Assignment record expires in 7 days
+    
+    return AssignmentEvent.new(assignment.id, job.id, job.get_status(refresh=False), stage=stage)
+
+def replay_result(result: str) -> str:
+    # Function of the jobs made by complete_job, they never run but RQ needs something to point at
+    return result
+
+def complete_job(redis_client: redis.Redis, 
+                 queue: Queue,
+                 stage: Stage, 
+                 assignment: Assignment,
+                 result: str,
+                 final: bool = True
+                 ) -> Assignment:
+    # Record a stage whose result is already known as a finished job, so clients read it like any other stage.
+    # Not final when the job recording it still has to finish, that job's own event ends the assignment then
+    with redis_client.pipeline() as pipeline:
+        event = record_finished_stage(redis_client, pipeline, queue, stage, assignment, result, final)
+        publish_assignment_event(redis_client, event, pipeline=pipeline)
     
     return assignment
 
+def record_finished_stage(redis_client: redis.Redis, 
+                          pipeline: redis.client.Pipeline, 
+                          queue: Queue,
+                          stage: Stage, 
+                          assignment: Assignment, 
+                          result: str, 
+                          final: bool = True
+                          ) -> AssignmentEvent:
+    # complete_job queued on pipeline, so many stages can be committed together. The caller announces the event
+    job = Job.create(
+                    replay_result,
+                    args=(result,),
+                    connection=redis_client,
+                    origin=queue.name,
+                    status=JobStatus.FINISHED,
+                    result_ttl=604800,
+                    meta={"assignment_id": assignment.id, "stage": stage.name, "replayed": True} # Never ran on a worker
+                    )
+    job.enqueued_at = job.started_at = job.ended_at = now()
+    
+    job.save(pipeline=pipeline)
+    pipeline.expire(job.key, 604800)
+    Result.create(job, Result.Type.SUCCESSFUL, ttl=604800, return_value=result, pipeline=pipeline)
+    
+    record_stage(pipeline, stage, assignment, job)
+    
+    return AssignmentEvent.new(assignment.id, job.id, "finished", stage=stage, result=JobResult.create_from(result), final=final)
+
+# Assignments are a list of stage JSON under assignment:<id>:stages, appended to with RPUSH.
+# Older ones are a single JSON blob under assignment:<id>, read and merged in front of the list.
+
+def assignment_stages_key(assignment_id: str) -> str:
+    return f"assignment:{assignment_id}:stages"
+
+def assignment_timings_key(assignment_id: str) -> str:
+    # Job ID -> the phase timings of its stage, written by metrics.StageTimer once the job ended
+    return f"assignment:{assignment_id}:timings"
+
 def get_assignment(redis_client: redis.Redis, id: str | None) -> Assignment | None:
     if id is None:
         return None
     
-    data = redis_client.get(f"assignment:{id}")
-    if data is None:
-        return None
+    return get_assignments(redis_client, [id])[0]
+
+def get_assignments(redis_client: redis.Redis, ids: list[str]) -> list[Assignment | None]:
+    # Any number of assignments in one round-trip, None for the ones that don't exist (anymore)
+    with redis_client.pipeline(transaction=False) as pipeline:
+        for id in ids:
+            pipeline.lrange(assignment_stages_key(id), 0, -1)
+            pipeline.get(f"assignment:{id}")
+            pipeline.hgetall(assignment_timings_key(id))
+        responses = pipeline.execute()
+    
+    assignments = []
+    for id, stages, legacy, timings in zip(ids, responses[::3], responses[1::3], responses[2::3]):
+        if not stages and legacy is None:
+            assignments.append(None)
+            continue
+        
+        assignment = Assignment.model_validate_json(legacy) if legacy is not None else Assignment(id=id, stages=[])
+        assignment.stages.extend(Stage.model_validate_json(stage) for stage in stages)
+        
+        for stage in assignment.stages:
+            if stage.id is not None and stage.id.encode() in timings:
+                stage.timings = json.loads(timings[stage.id.encode()])
+        
+        assignments.append(assignment)
+    
+    return assignments
+
+def fetch_job_results(redis_client: redis.Redis, jobs: list[Job]) -> dict[str, Any]:
+    # Return values of many finished jobs in one round-trip, job.result costs one per job
+    with redis_client.pipeline(transaction=False) as pipeline:
+        for job in jobs:
+            pipeline.xrevrange(Result.get_key(job.id), "+", "-", count=1)
+        responses = pipeline.execute()
+    
+    results = {}
+    for job, response in zip(jobs, responses):
+        if not response:
+            continue
+        
+        result_id, payload = response[0]
+        result = Result.restore(job.id, result_id.decode(), payload, connection=redis_client, serializer=job.serializer)
+        if result.type == Result.Type.SUCCESSFUL:
+            results[job.id] = result.return_value
+    
+    return results
+
+# ================================================
+#               Assignment Events
+# ================================================
+
+# Every stage transition is appended to a capped stream, so clients connecting late can catch up,
+# and published on the channel of the same name for the ones already listening (see event_server.py)
+
+ASSIGNMENT_EVENTS_MAXLEN = 1000
+
+def assignment_events_key(assignment_id: str) -> str:
+    return f"assignment:{assignment_id}:events"
+
+def publish_assignment_event(redis_client: redis.Redis, event: AssignmentEvent, pipeline: redis.client.Pipeline | None = None) -> str:
+    # Commands already queued on pipeline are committed together with the event.
+    # The channel message needs the stream ID, so it can only follow once the pipeline ran
+    return publish_assignment_events(redis_client, [event], pipeline)[0]
+
+def publish_assignment_events(redis_client: redis.Redis, events: list[AssignmentEvent], pipeline: redis.client.Pipeline | None = None) -> list[str]:
+    # Any number of events committed with the pipeline, then their channel messages in one more round-trip
+    if pipeline is None:
+        with redis_client.pipeline() as pipeline:
+            return publish_assignment_events(redis_client, events, pipeline)
+    
+    messages = []
+    for event in events:
+        key = assignment_events_key(event.assignment_id)
+        messages.append((key, event.model_dump_json()))
+        
+        pipeline.xadd(key, {"data": messages[-1][1]}, maxlen=ASSIGNMENT_EVENTS_MAXLEN, approximate=True)
+        pipeline.expire(key, 604800) # Same lifetime as the assignment record
+    
+    responses = pipeline.execute()
+    event_ids = [event_id.decode() if isinstance(event_id, bytes) else event_id 
+                 for event_id in responses[len(responses) - 2 * len(events)::2]]
+    
+    with redis_client.pipeline(transaction=False) as announcements:
+        for (key, data), event_id in zip(messages, event_ids):
+            announcements.publish(key, json.dumps({"id": event_id, "data": data}))
+        announcements.execute()
+    
+    return event_ids
+
+def publish_job_finished(job: Job, connection: redis.Redis, result, *args, **kwargs):
+    # RQ success callback, runs in the worker right after the job returned
+    record_service_time(connection, job)
+    
+    assignment_id = job.meta.get("assignment_id")
+    if assignment_id is None:
+        return
+    
+    job_result = JobResult.create_from(result) if isinstance(result, str) else None
+    
+    # Stages chain into each other, the assignment is over once something fails or the model has spoken,
+    # possibly in a stage this job recorded itself (see run_cicflowmeter.run_fused)
+    final = job_result is not None and (not job_result.success or getattr(job_result, "prediction", None) is not None)
+    final = final or job.meta.get("final", False)
+    final = final and not job.meta.get("continuous", False) # A window of a continuous assignment, see ingest.py
+    
+    publish_assignment_event(connection, AssignmentEvent.new(assignment_id, job.id, "finished", result=job_result, final=final))
+
+def publish_job_failed(job: Job, connection: redis.Redis, type, value, traceback):
+    # RQ failure callback, the job raised instead of returning a JobResult
+    record_service_time(connection, job)
+    
+    assignment_id = job.meta.get("assignment_id")
+    if assignment_id is None:
+        return
     
-    return Assignment.model_validate_json(data)
+    result = JobResult.new(message="This stage failed unexpectedly, please try again later.")
+    # A failed shard still gets merged, the merge stage reports on it. A failed window doesn't end a continuous assignment
+    final = not job.dependent_ids and not job.meta.get("continuous", False)
+    publish_assignment_event(connection, AssignmentEvent.new(assignment_id, job.id, "failed", result=result, final=final))
 
 def get_job(redis_client: redis.Redis, id: str) -> Job | None:
     try:
@@ -3,48 +3,106 @@ from s3_utils import *
 from api_types import *
 from utils import *
 
-from rq import Worker
-import os, subprocess, tempfile, uuid, shutil
-from run_ml import run_ml
+from rq import Worker, get_current_job
+import os, time, subprocess, tempfile, uuid, shutil, threading
+from run_ml import run_ml, load_model_bundle, predict_flow_file, verdict_result
+from extractor_daemon import extractor_available, request_extraction, start_extractor_daemon
+from flow_extractor import FLOW_EXTRACTOR, extract_flows_to_directory
+from flow_format import FLOW_FORMAT, flow_extension, csv_to_flows
+from prefilter import PREFILTER, prefilter_capture, report_reduction
+from captures import capture_filename, download_capture
+from metrics import span, timed_stage
 
-def run_cicflowmeter(s3_key, assignment_id: str) -> JobResult:
-    HEALTH = healthcheck()
+# ================================================
+#             Fused Pipeline Settings
+# ================================================
+
+# Captures up to this size are extracted and scored in one job, with no S3 round-trip or second queue wait
+# in between. Needs the model in the pcap worker's image, 0 always runs the two stages apart
+FUSED_MAX_SIZE = int(float(os.environ.get("FUSED_MAX_MB", 16)) * 1024 * 1024)
+
+# ================================================
+
+def extract_flows(pcap_directory: str, output_directory: str, engine: str = FLOW_EXTRACTOR, format: str = FLOW_FORMAT):
+    if engine == "native":
+        extract_flows_to_directory(pcap_directory, output_directory, format)
+        return
+
+    # Prefer the resident extractor, only fall back to a cold gradle run when it isn't serving
+    if extractor_available():
+        request_extraction(pcap_directory, output_directory)
+        return
+
+    subprocess.run(["gradle", "--no-daemon", f"-Pcmdargs={pcap_directory}:{output_directory}", "runcmd"], check=True, cwd="/worker")
+
+def extract_to_s3(S3, s3_key: str, flow_key: str) -> bool:
+    # Download a capture from S3, extract its flows and upload them under flow_key,
+    # as a CSV or a flow_format file depending on the key's extension
+    pcap_directory, output_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
     
-    if HEALTH.all_good():
-        S3 = get_s3_client()
+    try:
+        flow_filepath = extract_locally(S3, s3_key, flow_extension(flow_key), pcap_directory, output_directory)
+        if flow_filepath is None:
+            return False
         
-        REDIS = get_redis_client()
-        ML_QUEUE = get_ml_queue(REDIS)
-    else:
-        return HealthCheckResult.new(HEALTH).model_dump_json()
-    
-    result = JobResult.new()
+        # ======== Upload output flows to S3 ========
+        
+        with span("s3_upload"):
+            S3.upload_file(flow_filepath, S3_BUCKET, flow_key)
+        return True
+    finally:
+        shutil.rmtree(pcap_directory, ignore_errors=True)
+        shutil.rmtree(output_directory, ignore_errors=True)
+
+def extract_locally(S3, s3_key: str, format: str, pcap_directory: str, output_directory: str) -> str | None:
+    # Download a capture from S3 into pcap_directory and extract its flows into output_directory.
+    # Returns the flow file, None when the extractor produced nothing
     
     # ======== Download pcap from S3 ========
     
-    pcap_directory = tempfile.mkdtemp()
-    pcap_filepath = os.path.join(pcap_directory, os.path.basename(s3_key))
-    S3.download_file(S3_BUCKET, s3_key, pcap_filepath)
+    pcap_filepath = os.path.join(pcap_directory, capture_filename(s3_key))
+    with span("s3_download"):
+        download_capture(S3, S3_BUCKET, s3_key, pcap_filepath) # Decompressed on the way
+    
+    # ======== Drop the packets no flow is made of ========
+    
+    reduction = None
+    if PREFILTER:
+        with span("prefilter"):
+            reduction = prefilter_capture(pcap_filepath)
     
     # ======== Run CICFlowMeter on pcap file ========
-
-    output_directory = tempfile.mkdtemp()
     
-    subprocess.run(["gradle", "--no-daemon", f"-Pcmdargs={pcap_directory}:{output_directory}", "runcmd"], check=True, cwd="/worker")
+    started = time.perf_counter()
+    with span("flow_extraction"):
+        extract_flows(pcap_directory, output_directory, format=format)
+    
+    if reduction is not None:
+        report_reduction(get_redis_client(), os.path.basename(s3_key), reduction, time.perf_counter() - started)
 
-    # ======== Upload output CSV to S3 ========
+    # ======== Find the output flows ========
 
     for file in os.listdir(output_directory):
-        if file.endswith(".csv"):
-            flow_key = f"flows/{uuid.uuid4()}.csv"
-            S3.upload_file(os.path.join(output_directory, file), S3_BUCKET, flow_key)
-            break
-        
-    shutil.rmtree(pcap_directory, ignore_errors=True)
-    shutil.rmtree(output_directory, ignore_errors=True)
-        
-    # ======== Finally, enqueue ML job with flow information ========
+        flow_filepath = os.path.join(output_directory, file)
+        if flow_extension(file) not in ("csv", "npz"):
+            continue
+
+        if flow_extension(file) == "csv" and format == "npz":
+            # CICFlowMeter only writes CSV, convert once here so the ML stage never parses text
+            started = time.perf_counter()
+            csv_size = os.path.getsize(flow_filepath)
+            npz_filepath = flow_filepath.removesuffix(".csv") + ".npz"
+            with span("flow_conversion"):
+                rows = csv_to_flows(flow_filepath, npz_filepath)
+            flow_filepath = npz_filepath
+            print(f"[run_cicflowmeter] Converted {rows} flows from CSV ({csv_size / 1e6:.1f} MB) to npz "
+                  f"({os.path.getsize(flow_filepath) / 1e6:.1f} MB) in {time.perf_counter() - started:.2f}s")
+
+        return flow_filepath
     
+    return None
+
+def enqueue_ml_stage(REDIS, ML_QUEUE, flow_key: str, assignment_id: str) -> str:
     assignment = get_assignment(REDIS, assignment_id)
     
     #enqueue ML stage
@@ -58,14 +116,127 @@ def run_cicflowmeter(s3_key, assignment_id: str) -> JobResult:
         flow_key,
         assignment_id=assignment.id
     )
-    ml_job_id = stage.id
-    result.next_job_id = ml_job_id
+    
+    return stage.id
+
+@timed_stage
+def run_cicflowmeter(s3_key, assignment_id: str) -> JobResult:
+    HEALTH = healthcheck()
+    
+    if HEALTH.all_good():
+        S3 = get_s3_client()
+        
+        REDIS = get_redis_client()
+        ML_QUEUE = get_ml_queue(REDIS, current_lane())
+    else:
+        return HealthCheckResult.new(HEALTH).model_dump_json()
+    
+    return extract_for_ml_stage(S3, REDIS, ML_QUEUE, s3_key, assignment_id).model_dump_json()
+
+def extract_for_ml_stage(S3, REDIS, ML_QUEUE, s3_key: str, assignment_id: str) -> JobResult:
+    result = JobResult.new()
+    
+    flow_key = f"flows/{uuid.uuid4()}.{FLOW_FORMAT}"
+    if not extract_to_s3(S3, s3_key, flow_key):
+        result.message = "CICFlowMeter produced no flows for your capture."
+        return result
+        
+    # ======== Finally, enqueue ML job with flow information ========
+    
+    result.next_job_id = enqueue_ml_stage(REDIS, ML_QUEUE, flow_key, assignment_id)
         
     result.success = True
     result.message = "Prepared your .pcap file for machine learning analysis."
     
+    return result
+
+# ======== Fused pipeline for small captures ========
+
+def archive_flows(S3, flow_filepath: str, flow_key: str):
+    # Flows of fused jobs still end up in S3, like the ones the ML workers read
+    try:
+        with span("s3_upload"):
+            S3.upload_file(flow_filepath, S3_BUCKET, flow_key)
+    except Exception as e:
+        print(f"[run_cicflowmeter] Could not archive the flows to {flow_key}: {e}")
+
+@timed_stage
+def run_fused(s3_key, assignment_id: str) -> JobResult:
+    # Extraction and ML analysis in one job, scoring the flows straight from local disk. Both stages are
+    # recorded in the assignment, the ML one as an already finished job (see redis_utils.complete_job)
+    HEALTH = healthcheck()
+    
+    if HEALTH.all_good():
+        S3 = get_s3_client()
+        
+        REDIS = get_redis_client()
+        ML_QUEUE = get_ml_queue(REDIS, current_lane())
+    else:
+        return HealthCheckResult.new(HEALTH).model_dump_json()
+    
+    try:
+        with span("model_load"): # Next to nothing once the worker preloaded it
+            bundle = load_model_bundle()
+    except FileNotFoundError as e:
+        print(f"[run_cicflowmeter] No model in this worker, handing the flows to an ML worker: {e}")
+        return extract_for_ml_stage(S3, REDIS, ML_QUEUE, s3_key, assignment_id).model_dump_json()
+    
+    result = JobResult.new()
+    pcap_directory, output_directory = tempfile.mkdtemp(), tempfile.mkdtemp()
+    
+    # CICFlowMeter writes CSV, converting it only pays off when another process parses the flows again
+    format = FLOW_FORMAT if FLOW_EXTRACTOR == "native" else "csv"
+    
+    try:
+        flow_filepath = extract_locally(S3, s3_key, format, pcap_directory, output_directory)
+        if flow_filepath is None:
+            result.message = "CICFlowMeter produced no flows for your capture."
+            return result.model_dump_json()
+        
+        # ======== Score the local flows, archiving them meanwhile ========
+        
+        flow_key = f"flows/{uuid.uuid4()}.{flow_extension(flow_filepath)}"
+        archiver = threading.Thread(target=archive_flows, args=(S3, flow_filepath, flow_key))
+        archiver.start()
+        try:
+            prediction, rows = predict_flow_file(flow_filepath, bundle["model"], bundle["feature_names"])
+        finally:
+            archiver.join() # A forked job's threads die with it
+        
+        ml_result = verdict_result(prediction, rows, assignment_id)
+    finally:
+        shutil.rmtree(pcap_directory, ignore_errors=True)
+        shutil.rmtree(output_directory, ignore_errors=True)
+    
+    # ======== Record the ML stage, this job's own event then ends the assignment ========
+    
+    stage = Stage.new_ml_stage()
+    complete_job(REDIS, ML_QUEUE, stage, get_assignment(REDIS, assignment_id), ml_result.model_dump_json(), final=False)
+    
+    job = get_current_job()
+    if job is not None:
+        job.meta["final"] = True
+        job.save_meta()
+    
+    result.next_job_id = stage.id
+    result.success = True
+    result.message = "Extracted the flows of your capture and analyzed them right away."
+    
     return result.model_dump_json()
 
+def preload_fused_model():
+    # Jobs fork from the worker, load the model once there instead of in every fused job
+    if FUSED_MAX_SIZE <= 0:
+        return
+    
+    try:
+        load_model_bundle()
+    except FileNotFoundError as e:
+        print(f"[run_cicflowmeter] No model for fused jobs, their flows will go to the ML workers: {e}")
+
+def pcap_worker(redis_client: redis.Redis, name: str | None = None) -> Worker:
+    return WeightedLaneWorker(get_pcap_queues(redis_client, WORKER_LANES), name=name, connection=redis_client)
+
 if __name__ == "__main__":
     REDIS = get_redis_client()
     
@@ -75,5 +246,13 @@ if __name__ == "__main__":
         print("Could not connect to the Redis server!")
         exit(1)
     
-    worker = Worker(get_pcap_queue(REDIS))
+    start_health_monitor() # Jobs forked from this worker reuse its cached health instead of probing
+    
+    # Keep warm CICFlowMeter JVMs around for the lifetime of this worker
+    if FLOW_EXTRACTOR != "native":
+        start_extractor_daemon()
+    
+    preload_fused_model()
+    
+    worker = pcap_worker(REDIS)
     worker.work(burst=False)
\ No newline at end of file
@@ -2,20 +2,251 @@ from redis_utils import *
 from s3_utils import *
 from api_types import *
 from utils import *
+from verdict_cache import *
 
-from rq import Worker
+from rq import Worker, SimpleWorker, get_current_job
+from rq.exceptions import NoSuchJobError
 from pathlib import Path
+from typing import Iterator
 import os
+import gc
+import time
 import tempfile
 import shutil
 import pandas as pd
 import numpy as np
 import joblib
+import json
 import redis
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flow_format import flow_extension, iter_flows
+from metrics import span, timed, timed_stage
+
+# ================================================
+#                 ML Worker Settings
+# ================================================
+
+ML_BATCH_SIZE = int(os.environ.get("ML_BATCH_SIZE", 1)) # Jobs scored per model call, 1 disables batching
+ML_BATCH_WAIT_MS = int(os.environ.get("ML_BATCH_WAIT_MS", 50)) # How long to wait for a batch to fill up
+
+# fork:    stock RQ worker, every forked job unpickles the model again
+# preload: load the model before forking so every job shares the parent's copy
+# simple:  no forking at all, jobs run inside the worker process next to the resident model
+ML_WORKER_MODE = os.environ.get("ML_WORKER_MODE", "preload")
+
+# auto:     the compiled forest exported by ml/train_rf.py when it exists, the joblib pipeline otherwise
+# compiled: always the compiled forest
+# sklearn:  always the joblib pipeline
+ML_ENGINE = os.environ.get("ML_ENGINE", "auto")
+ML_THREADS = int(os.environ.get("ML_THREADS", os.cpu_count() or 1)) # Threads walking the compiled forest
+
+ML_CHUNK_ROWS = int(os.environ.get("ML_CHUNK_ROWS", 100_000)) # Flow CSV rows parsed and predicted at a time, 0 reads it whole
+ML_STREAM_DTYPE = os.environ.get("ML_STREAM_DTYPE", "float64") # float32 halves chunk memory but rounds the features
+
+# Distinct feature vectors whose label is remembered between chunks and jobs, 0 disables the cache and deduplication.
+# Only survives between jobs in processes that don't fork per job (ML_WORKER_MODE=simple), forked jobs start from the parent's
+ML_PREDICTION_CACHE = int(os.environ.get("ML_PREDICTION_CACHE", 100_000))
+
+# ================================================
 
 NON_NUMERIC_COLS = ["Timestamp"]
 MODEL_ENV_VAR = "RF_MODEL_PATH"
+COMPILED_MODEL_ENV_VAR = "RF_COMPILED_PATH"
 _model_bundle = None
+_model_version = None #identifies the loaded bundle's files, see verdict_cache.model_version
+
+class CompiledForest:
+    #array-backed random forest written by ml/train_rf.py compile_forest, with the scaler folded into the
+    #thresholds. the arrays are memory mapped, so every worker process on the host shares one copy
+
+    WALK_STEPS = 8 #levels walked between dropping samples that reached a leaf
+    ROW_BLOCK = 4096
+
+    def __init__(self, path: Path):
+        load = lambda name: np.asarray(np.load(path / f"{name}.npy", mmap_mode="r"))
+        self.feature = load("feature")
+        self.threshold = load("threshold")
+        self.child = load("child")
+        self.roots = load("roots")
+        self.leaf = load("leaf")
+        self.impure_proba = load("impure_proba")
+        self.classes_ = np.load(path / "classes.npy")
+
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        self.feature_names: list[str] = meta["feature_names"]
+        self.n_trees: int = meta["n_trees"]
+
+    def apply(self, X) -> np.ndarray:
+        #leaf reached in every tree, shape (n_samples, n_trees)
+        X = np.ascontiguousarray(X, dtype=np.float64)
+        leaves = np.empty((len(X), self.n_trees), dtype=np.int64)
+
+        tree_chunks = np.array_split(np.arange(self.n_trees), max(1, min(ML_THREADS, self.n_trees)))
+        tasks = [(rows, trees) for rows in range(0, len(X), self.ROW_BLOCK) for trees in tree_chunks if len(trees)]
+
+        def walk(task):
+            start, trees = task
+            block = X[start:start + self.ROW_BLOCK]
+            leaves[start:start + len(block), trees[0]:trees[-1] + 1] = self._walk(block, trees)
+
+        with ThreadPoolExecutor(max_workers=ML_THREADS) as pool: #numpy releases the GIL in the gathers
+            list(pool.map(walk, tasks))
+
+        return leaves
+
+    def _walk(self, X: np.ndarray, trees: np.ndarray) -> np.ndarray:
+        n, width = X.shape
+        flat = X.ravel()
+
+        #one entry per (tree, sample), tree by tree so consecutive lookups stay inside one tree's nodes
+        node = np.repeat(self.roots[trees], n)
+        row = np.tile(np.arange(n, dtype=np.int64) * width, len(trees))
+        position = np.arange(len(node))
+        reached = np.empty(len(node), dtype=np.int64)
+
+        while len(node):
+            for _ in range(self.WALK_STEPS):
+                #leaves point at themselves with an infinite threshold, so finished entries stay put
+                node = self.child[node] + (flat[row + self.feature[node]] > self.threshold[node])
+
+            done = self.child[node] == node
+            reached[position[done]] = node[done]
+            node, row, position = node[~done], row[~done], position[~done]
+
+        return reached.reshape(len(trees), n).T
+
+    def predict_proba(self, X) -> np.ndarray:
+        leaves = self.apply(X)
+        rows = np.arange(len(leaves))
+
+        #same accumulation as RandomForestClassifier: sum the normalized leaf values tree by tree, then average
+        proba = np.zeros((len(leaves), len(self.classes_)))
+        for tree in range(self.n_trees):
+            code = self.leaf[leaves[:, tree]]
+            pure = code >= 0
+            proba[rows[pure], code[pure]] += 1.0
+            if not pure.all():
+                proba[rows[~pure]] += self.impure_proba[-1 - code[~pure]]
+
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+
+def row_keys(values: np.ndarray, block_rows: int = 16_384) -> np.ndarray:
+    #128-bit hash of every row's exact bytes, as a (n,) array of 16-byte voids that np.unique can sort.
+    #every column word is scrambled by a multiply-xorshift (a bijection, so different words stay different),
+    #then the words are summed twice with independent odd weights, so two different rows only collide by chance
+    words = values.view(np.uint32 if values.dtype.itemsize == 4 else np.uint64)
+    width = words.shape[1]
+    multipliers = np.random.default_rng(0x9E3779B9).integers(1, 2**63, size=(3, width), dtype=np.uint64) | np.uint64(1)
+
+    keys = np.empty((len(values), 2), dtype=np.uint64)
+    for start in range(0, len(values), block_rows): #bounds the (rows, width) temporaries
+        mixed = words[start:start + block_rows] * multipliers[0]
+        mixed ^= mixed >> np.uint64(31)
+        for k in range(2):
+            keys[start:start + len(mixed), k] = (mixed * multipliers[k + 1]).sum(axis=1, dtype=np.uint64)
+
+    return keys.view(np.dtype((np.void, 16))).ravel()
+
+class PredictionCache:
+    #wraps a model so repeated flows (DNS lookups, health probes, scans) are scored once. every chunk is
+    #deduplicated on row hashes, rows seen in earlier chunks or jobs come from a bounded LRU, only the rest
+    #reach the model and the labels are scattered back to every row
+
+    def __init__(self, model, size: int = ML_PREDICTION_CACHE):
+        self.model = model
+        self.size = size
+        self.classes_ = model.classes_
+        self.labels: OrderedDict[bytes, object] = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.rows = 0 #rows asked for
+        self.unique = 0 #distinct rows among them, per chunk
+        self.scored = 0 #rows the model actually saw
+        self.predict_seconds = 0.0
+
+    def predict(self, X) -> np.ndarray:
+        values = np.ascontiguousarray(X.to_numpy() if isinstance(X, pd.DataFrame) else X)
+        keys, first, inverse = np.unique(row_keys(values), return_index=True, return_inverse=True)
+
+        labels = np.empty(len(keys), dtype=np.asarray(self.classes_).dtype)
+        keys = keys.tolist() #bytes, cheaper to hash than numpy scalars
+        missing, hits, cached = [], [], []
+        for i, key in enumerate(keys):
+            label = self.labels.get(key)
+            if label is None:
+                missing.append(i)
+            else:
+                hits.append(i)
+                cached.append(label)
+                self.labels.move_to_end(key)
+        labels[hits] = cached
+
+        if missing:
+            rows = first[missing]
+            started = time.perf_counter()
+            if len(rows) == len(values):
+                labels[missing] = self.model.predict(X)[rows] #nothing to skip, don't copy the chunk
+            else:
+                labels[missing] = self.model.predict(X.iloc[rows] if isinstance(X, pd.DataFrame) else values[rows])
+            self.predict_seconds += time.perf_counter() - started
+
+            #only the most recent fit when a chunk has more new rows than the cache holds
+            for i, label in zip(missing[-self.size:], labels[missing[-self.size:]].tolist()):
+                self.labels[keys[i]] = label
+            for _ in range(len(self.labels) - self.size):
+                self.labels.popitem(last=False)
+
+        self.rows += len(values)
+        self.unique += len(keys)
+        self.scored += len(missing)
+        return labels[inverse.ravel()]
+
+    def report(self) -> str:
+        if self.rows == 0:
+            return "[run_ml] Prediction cache: nothing predicted"
+
+        #the model's own pace on the rows it did score, applied to the ones it was spared
+        saved = self.predict_seconds / self.scored * (self.rows - self.scored) if self.scored else 0.0
+        return (f"[run_ml] Prediction cache: {self.rows} rows, {self.unique} distinct "
+                f"({1 - self.unique / self.rows:.1%} duplicates), {self.unique - self.scored} from cache, "
+                f"scored {self.scored} in {self.predict_seconds:.2f}s, saved ~{saved:.2f}s")
+
+_prediction_cache: PredictionCache | None = None
+
+def cached_model(model):
+    #the model behind the process' prediction cache, or the model itself when the cache is disabled
+    global _prediction_cache
+    if ML_PREDICTION_CACHE <= 0:
+        return model
+
+    if _prediction_cache is None or _prediction_cache.model is not model:
+        _prediction_cache = PredictionCache(model)
+
+    _prediction_cache.reset_stats()
+    return _prediction_cache
+
+def load_compiled_bundle() -> dict | None:
+    #compiled forest next to the joblib bundle, unless disabled or not exported yet
+    if ML_ENGINE == "sklearn":
+        return None
+
+    compiled_path = Path(os.environ.get(COMPILED_MODEL_ENV_VAR, Path(__file__).parent / "ml" / "rf_cicids2018.compiled"))
+    if not (compiled_path / "meta.json").exists():
+        if ML_ENGINE == "compiled":
+            raise FileNotFoundError(f"Could not find a compiled forest in {compiled_path}, run ml/train_rf.py --compile-only")
+        return None
+
+    print(f"[run_ml] Mapping compiled forest from {compiled_path}")
+    model = CompiledForest(compiled_path)
+    loaded_model_version(list(compiled_path.iterdir()))
+    return {"model": model, "feature_names": model.feature_names}
 
 def load_model_bundle():
     #lazy load RF bundle from disk
@@ -24,6 +255,12 @@ def load_model_bundle():
     if _model_bundle is not None: 
         return _model_bundle
     
+    started = time.perf_counter()
+    _model_bundle = load_compiled_bundle()
+    if _model_bundle is not None:
+        print(f"[run_ml] Loaded compiled forest in {time.perf_counter() - started:.2f}s, worker RSS {resident_memory_mb():.0f} MB")
+        return _model_bundle
+    
     #allow overriding via env var
     model_path_env = os.environ.get(MODEL_ENV_VAR)
     candidates: list[Path] = []
@@ -47,9 +284,23 @@ def load_model_bundle():
         )
     
     print(f"[run_ml] Loading model bundle from {model_path}")
+    started = time.perf_counter()
     _model_bundle = joblib.load(model_path)
+    loaded_model_version([model_path])
+    print(f"[run_ml] Loaded model bundle in {time.perf_counter() - started:.2f}s, worker RSS {resident_memory_mb():.0f} MB")
     return _model_bundle
 
+def loaded_model_version(paths: list[Path]):
+    #new bundle files mean a new version, verdicts cached for the previous one stop being served
+    global _model_version
+    _model_version = model_version(paths)
+    print(f"[run_ml] Model version {_model_version}")
+
+    try:
+        publish_model_version(get_redis_client(), _model_version)
+    except redis.exceptions.RedisError as e:
+        print(f"[run_ml] Could not publish the model version: {e}")
+
 def prepare_features(df: pd.DataFrame, feature_names: list[str]) -> tuple[pd.DataFrame, pd.Index]:
     #drop non num cols, convert to numeric, drop NaNs
     #return X: df with exact feature columns, kept_idx: index of rows kept
@@ -74,34 +325,93 @@ def prepare_features(df: pd.DataFrame, feature_names: list[str]) -> tuple[pd.Dat
     X = X[feature_names]
     return X, kept_idx
 
-def run_ml(flow_key: str, assignment_id: str) -> JobResult:
-    #ML job: download flow csv from s3, run RF model, upload predictions csv. 
+def iter_flow_features(path: str, feature_names: list[str], chunk_rows: int = ML_CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    #cleaned feature chunks straight from the flow file: only the model's columns, explicit dtypes, one chunk in memory.
+    #same rows as prepare_features: non-numeric, NaN and infinite values drop the row
+    dtype = np.dtype(ML_STREAM_DTYPE)
 
-    HEALTH = healthcheck()
-    if not HEALTH.all_good():
-        return HealthCheckResult.new(HEALTH).model_dump_json()
-    
-    S3 = get_s3_client()
-    result = MLJobResult.new()
+    def clean(values: np.ndarray) -> pd.DataFrame:
+        values = values.astype(dtype, copy=False)
+        return pd.DataFrame(values[np.isfinite(values).all(axis=1)], columns=feature_names)
+
+    if flow_extension(path) == "npz":
+        #columnar handoff from the pcap stage, already numeric so there is nothing to parse
+        for values in iter_flows(path, feature_names, chunk_rows):
+            yield clean(values)
+        return
+
+    columns = pd.read_csv(path, nrows=0).columns
+    missing = [c for c in feature_names if c not in columns]
+    if missing:
+        raise ValueError(f"Missing expected features in flow CSV: {missing[:10]}...")
+
+    read = lambda **kwargs: pd.read_csv(path, usecols=feature_names, chunksize=chunk_rows or None, **kwargs)
+
+    rows_read = 0
+    try:
+        for chunk in _chunks(read(dtype=dict.fromkeys(feature_names, dtype))):
+            rows_read += len(chunk)
+            yield clean(chunk[feature_names].to_numpy(dtype=dtype))
+        return
+    except ValueError:
+        print(f"[run_ml] Non-numeric values after row {rows_read}, parsing the rest of the flow CSV leniently")
+
+    for chunk in _chunks(read(dtype=str, skiprows=range(1, rows_read + 1))):
+        yield clean(chunk[feature_names].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=dtype))
+
+def _chunks(reader) -> Iterator[pd.DataFrame]:
+    #read_csv hands back a single frame without chunksize
+    if isinstance(reader, pd.DataFrame):
+        yield reader
+        return
+
+    with reader:
+        yield from reader
+
+def download_flows(S3, flow_key: str, directory: str) -> str:
+    local_flow_path = os.path.join(directory, os.path.basename(flow_key))
+    print(f"[run_ml] Downloading flows s3://{S3_BUCKET}/{flow_key} to {local_flow_path}")
+    with span("s3_download"):
+        S3.download_file(S3_BUCKET, flow_key, local_flow_path)
+    return local_flow_path
 
+def stream_predictions(S3, flow_key: str, model, feature_names: list[str]) -> tuple[str | None, int]:
+    #download the flow file from s3 and predict it
     tmpdir = tempfile.mkdtemp()
-    
-    #down flow csv from s3
-    local_flow_path = os.path.join(tmpdir, os.path.basename(flow_key))
-    print(f"[run_ml] Downloading flow CSV s3://{S3_BUCKET}/{flow_key} to {local_flow_path}")
-    S3.download_file(S3_BUCKET, flow_key, local_flow_path)
+    try:
+        return predict_flow_file(download_flows(S3, flow_key, tmpdir), model, feature_names)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    #local model and flow csv
-    bundle = load_model_bundle()
-    model = bundle["model"]
-    feature_names: list[str] = bundle["feature_names"]
+def predict_flow_file(path: str, model, feature_names: list[str]) -> tuple[str | None, int]:
+    #predict a local flow file chunk by chunk, returns the first row's label (the verdict) and the number of rows used
+    first, rows = None, 0
+    counts: dict[str, int] = {}
+    model = cached_model(model)
+
+    for X in timed(iter_flow_features(path, feature_names), "feature_parsing"):
+        if X.empty:
+            continue
+
+        with span("predict"):
+            y_pred = model.predict(X)
+        if first is None:
+            first = y_pred[0]
+        rows += len(y_pred)
+
+        for label, count in zip(*np.unique(y_pred, return_counts=True)):
+            counts[str(label)] = counts.get(str(label), 0) + int(count)
 
-    df = pd.read_csv(local_flow_path)
-    print(f"[run_ml] Loaded flow CSV with shape {df.shape}")
+    print(f"[run_ml] Predicted {rows} flows: {counts}, peak RSS {peak_memory_mb():.0f} MB")
+    if isinstance(model, PredictionCache):
+        print(model.report())
+    return first, rows
 
-    #prepare features
-    X, _ = prepare_features(df, feature_names)
-    if X.empty:
+def verdict_result(prediction: str | None, rows: int, assignment_id: str) -> MLJobResult:
+    #turn the predictions of an assignment's flows into its ML JobResult
+    result = MLJobResult.new()
+
+    if rows == 0:
         print("[run_ml] No valid rows after cleaning: aborting")
         result.success = False
         #if jobresult has a message field, record it
@@ -110,32 +420,247 @@ def run_ml(flow_key: str, assignment_id: str) -> JobResult:
         except AttributeError:
             pass
         result.next_job_id = None
-        return result.model_dump_json()
-    print(f"[run_ml] Using {len(X)} rows for prediction")
-
-    #predict
-    y_pred = model.predict(X)
-    prediction = y_pred[0]
+        return result
+    print(f"[run_ml] Used {rows} rows for prediction")
 
-    #update assignment record
-    REDIS = get_redis_client()
-    assignment = get_assignment(REDIS, assignment_id)
-    if assignment is not None:
-        #field for result key
-        REDIS.set(f"assignment:{assignment.id}",
-                    assignment.model_dump_json(),
-                    ex=604800
-                    )
-    
     #fill ML JobResult
     result.success = True
     result.next_job_id = None
     result.prediction = Prediction[prediction.upper()] # Either BENIGN or MALICIOUS
     result.message = f"Our model suggests your sample is {result.prediction}."
+
+    #identical captures uploaded later get this verdict without running the pipeline
+    record_verdict(get_redis_client(), assignment_id, _model_version, result.model_dump_json())
+
+    return result
+
+@timed_stage
+def run_ml(flow_key: str, assignment_id: str) -> JobResult:
+    #ML job: download flow csv from s3, run RF model, upload predictions csv. 
+
+    HEALTH = healthcheck()
+    if not HEALTH.all_good():
+        return HealthCheckResult.new(HEALTH).model_dump_json()
     
-    shutil.rmtree(tmpdir, ignore_errors=True)
+    S3 = get_s3_client()
+
+    #local model and flow csv
+    started = time.perf_counter()
+    with span("model_load"): #next to nothing once the worker preloaded it
+        bundle = load_model_bundle()
+    print(f"[run_ml] Model ready in {time.perf_counter() - started:.3f}s (pid {os.getpid()}, RSS {resident_memory_mb():.0f} MB)")
+    model = bundle["model"]
+    feature_names: list[str] = bundle["feature_names"]
+
+    #batching worker may have scored this job already
+    job = get_current_job()
+    batched = _batched_predictions.get(job.id) if job is not None else None
+
+    if batched is not None:
+        prediction, rows = batched
+    else:
+        prediction, rows = stream_predictions(S3, flow_key, model, feature_names)
+
+    return verdict_result(prediction, rows, assignment_id).model_dump_json()
+
+# ================================================
+#                 Batching Worker
+# ================================================
 
-    return result.model_dump_json()
+_batched_predictions: dict[str, tuple[str | None, int]] = {} # Job ID -> its verdict and rows, scored with its whole batch
+
+# RQ only parks a dequeued job somewhere recoverable (its intermediate queue) when the worker serves a single queue,
+# with several lanes it pops the job outright. The jobs a batching worker takes beyond the first are therefore
+# moved into its own list, and leave it once they're in the StartedJobRegistry:
+#
+#     ml:batch:<worker name>    jobs taken for the worker's batch that haven't started yet, in the batch's order
+#
+# A warm shutdown or an error puts them back at the front of their queues right away, the list of a worker that
+# died is put back by requeue_abandoned_batches, which every batching worker runs with its maintenance tasks
+BATCH_KEY_PREFIX = "ml:batch:"
+
+def requeue_batch(redis_client: redis.Redis, batch_key: str) -> int:
+    # Moves the jobs left in a batch list back to the front of their queues, keeping the batch's order.
+    # One at a time off its end, so two workers cleaning up the same list never requeue a job twice
+    requeued = 0
+    while (job_id := redis_client.rpop(batch_key)) is not None:
+        try:
+            job = Job.fetch(job_id.decode(), connection=redis_client)
+        except NoSuchJobError:
+            continue # Expired meanwhile
+
+        Queue(job.origin, connection=redis_client).push_job_id(job.id, at_front=True)
+        _batched_predictions.pop(job.id, None)
+        requeued += 1
+
+    return requeued
+
+def requeue_abandoned_batches(redis_client: redis.Redis) -> int:
+    # Batch lists whose worker is gone, its key expires once it stopped sending heartbeats
+    requeued = 0
+    for batch_key in redis_client.scan_iter(match=f"{BATCH_KEY_PREFIX}*"):
+        name = batch_key.decode().removeprefix(BATCH_KEY_PREFIX)
+        if not redis_client.exists(Worker.redis_worker_namespace_prefix + name):
+            requeued += requeue_batch(redis_client, batch_key.decode())
+
+    if requeued:
+        print(f"[run_ml] Put {requeued} jobs of dead batching workers back in their queues")
+    return requeued
+
+@timed_stage
+def predict_batch(jobs: list[Job]):
+    #score the flows of several run_ml jobs with shared model calls, run_ml then picks up its share.
+    #flow files are streamed like predict_flow_file does, each model call takes ML_CHUNK_ROWS rows from whichever jobs they came from
+    jobs = [job for job in jobs if job.func_name.endswith("run_ml") and job.args]
+    if not jobs:
+        return
+
+    bundle = load_model_bundle()
+    model = cached_model(bundle["model"])
+    feature_names: list[str] = bundle["feature_names"]
+
+    S3 = get_s3_client()
+    scored: dict[str, tuple[str | None, int]] = {} # Job ID -> first prediction and rows predicted so far
+    failed: set[str] = set()
+    buffered: list[tuple[str, pd.DataFrame]] = [] # Chunks waiting for the next model call, with their job's ID
+    buffered_rows, calls = 0, 0
+
+    def predict_buffered():
+        nonlocal buffered_rows, calls
+        X = pd.concat([features for _, features in buffered], ignore_index=True)
+        with span("predict"):
+            y_pred = model.predict(X)
+
+        offset = 0
+        for job_id, features in buffered:
+            first, rows = scored[job_id]
+            scored[job_id] = (y_pred[offset] if first is None else first), rows + len(features)
+            offset += len(features)
+
+        buffered.clear()
+        buffered_rows, calls = 0, calls + 1
+
+    for job in jobs:
+        scored[job.id] = (None, 0)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for X in timed(iter_flow_features(download_flows(S3, job.args[0], tmpdir), feature_names), "feature_parsing"):
+                if X.empty:
+                    continue
+
+                buffered.append((job.id, X))
+                buffered_rows += len(X)
+                if ML_CHUNK_ROWS and buffered_rows >= ML_CHUNK_ROWS:
+                    predict_buffered()
+        except Exception as e:
+            #leave it to run_ml, which fails the job with the real error
+            print(f"[run_ml] Could not prepare job {job.id} for batching: {e}")
+            failed.add(job.id)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if buffered:
+        predict_buffered()
+
+    for job_id in failed:
+        scored.pop(job_id)
+    _batched_predictions.update(scored)
+
+    print(f"[run_ml] Scored {len(scored)} jobs ({sum(rows for _, rows in scored.values())} rows) in {calls} model calls, peak RSS {peak_memory_mb():.0f} MB")
+    if isinstance(model, PredictionCache):
+        print(model.report())
+
+class BatchingWorker(WeightedLaneWorker):
+    # Pulls up to batch_size jobs (or whatever shows up within batch_wait seconds) off the queue and
+    # predicts them together. Every job still goes through execute_job, so results and failures stay per job.
+    # The first job is dequeued by RQ as usual, the rest wait in the worker's batch list (see BATCH_KEY_PREFIX).
+
+    def __init__(self, *args, batch_size: int = ML_BATCH_SIZE, batch_wait: float = ML_BATCH_WAIT_MS / 1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._pending: list[tuple[Job, Queue]] = []
+
+    @property
+    def batch_key(self) -> str:
+        return BATCH_KEY_PREFIX + self.name
+
+    def work(self, *args, **kwargs):
+        # A warm shutdown or an error ending the loop puts the batch's remaining jobs back for another worker
+        try:
+            return super().work(*args, **kwargs)
+        finally:
+            self.requeue_pending()
+
+    def requeue_pending(self):
+        self._pending = []
+        requeued = requeue_batch(self.connection, self.batch_key)
+        if requeued:
+            print(f"[run_ml] Put {requeued} batched jobs back in their queues")
+
+    def run_maintenance_tasks(self):
+        super().run_maintenance_tasks()
+        requeue_abandoned_batches(self.connection)
+
+    def dequeue_extra(self, queues: list[Queue]) -> tuple[Job, Queue] | None:
+        # Moves the next job of the first non-empty queue into the batch list, in one step so it's never in neither
+        for queue in queues:
+            while (job_id := self.connection.lmove(queue.key, self.batch_key, "LEFT", "RIGHT")) is not None:
+                try:
+                    return self.job_class.fetch(job_id.decode(), connection=self.connection, serializer=self.serializer), queue
+                except NoSuchJobError:
+                    self.connection.lrem(self.batch_key, 1, job_id) # Expired while queued
+
+        return None
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        if self._pending:
+            return self._pending.pop(0)
+        
+        result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+        if result is None or self.batch_size <= 1:
+            return result
+
+        # The first job's queue first, so a batch stays in its lane while it has jobs
+        queues = [result[1]] + [queue for queue in self.queues if queue.name != result[1].name]
+        batch = [result]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            extra = self.dequeue_extra(queues) # Doesn't block, the deadline bounds how long we wait
+            if extra is not None:
+                batch.append(extra)
+            elif time.monotonic() < deadline:
+                time.sleep(0.005)
+            else:
+                break
+
+        self._pending = batch[1:]
+        predict_batch([job for job, _ in batch])
+        
+        return batch[0]
+
+    def prepare_execution(self, job: Job):
+        execution = super().prepare_execution(job)
+        self.connection.lrem(self.batch_key, 1, job.id) # In the StartedJobRegistry now
+        return execution
+
+    def execute_job(self, job: Job, queue: Queue):
+        try:
+            return super().execute_job(job, queue)
+        finally:
+            _batched_predictions.pop(job.id, None)
+
+class SimpleBatchingWorker(BatchingWorker, SimpleWorker):
+    pass
+
+def ml_worker_class() -> type[Worker]:
+    if ML_WORKER_MODE == "simple":
+        return SimpleBatchingWorker if ML_BATCH_SIZE > 1 else SimpleWeightedLaneWorker
+    
+    return BatchingWorker if ML_BATCH_SIZE > 1 else WeightedLaneWorker
+
+def ml_worker(redis_client: redis.Redis, name: str | None = None) -> Worker:
+    return ml_worker_class()(get_ml_queues(redis_client, WORKER_LANES), name=name, connection=redis_client)
 
 
 if __name__ == "__main__":
@@ -147,5 +672,15 @@ if __name__ == "__main__":
         print("Could not connect to the Redis server!")
         exit(1)
     
-    worker = Worker(get_ml_queue(REDIS))
+    start_health_monitor() # Jobs forked from this worker reuse its cached health instead of probing
+    
+    started = time.perf_counter()
+    
+    if ML_WORKER_MODE in ("preload", "simple"):
+        load_model_bundle()
+        gc.freeze() # Keep the collector from touching (and un-sharing) the model's pages in forked jobs
+    
+    print(f"[run_ml] {ML_WORKER_MODE} worker started in {time.perf_counter() - started:.2f}s, RSS {resident_memory_mb():.0f} MB")
+    
+    worker = ml_worker(REDIS)
     worker.work(burst=False)
\ No newline at end of file
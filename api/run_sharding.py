@@ -0,0 +1,248 @@
+from redis_utils import *
+from s3_utils import *
+from api_types import *
+from utils import *
+
+from rq import get_current_job
+from rq.job import Dependency
+import os, mmap, math, tempfile, uuid, shutil
+import numpy as np
+from flow_extractor import CaptureFormatError, index_capture, shard_records, write_pcap
+from run_cicflowmeter import run_cicflowmeter, extract_to_s3, enqueue_ml_stage
+from flow_format import FLOW_FORMAT, flow_extension, merge_flows
+from metrics import span, timed_stage
+from captures import capture_filename, download_capture
+
+# ================================================
+#                Sharding Settings
+# ================================================
+
+SHARD_SIZE = int(os.environ.get("SHARD_SIZE_MB", 256)) * 1024 * 1024 # Captures larger than this are split
+MAX_SHARDS = int(os.environ.get("MAX_SHARDS", 16))
+
+# ================================================
+
+# Shards are cut on a hash of the bidirectional 5-tuple instead of time windows, so every packet of a
+# connection lands in the same shard. No flow can straddle two shards, and merging is a concatenation.
+
+def shard_count(file_size: int) -> int:
+    return max(1, min(MAX_SHARDS, math.ceil(file_size / SHARD_SIZE)))
+
+@timed_stage
+def split_pcap(s3_key: str, assignment_id: str) -> JobResult:
+    HEALTH = healthcheck()
+
+    if HEALTH.all_good():
+        S3 = get_s3_client()
+
+        REDIS = get_redis_client()
+        PCAP_QUEUE = get_pcap_queue(REDIS, current_lane()) # Shards stay in the lane of their capture
+    else:
+        return HealthCheckResult.new(HEALTH).model_dump_json()
+
+    result = JobResult.new()
+
+    # ======== Download pcap from S3 ========
+
+    work_directory = tempfile.mkdtemp()
+    pcap_filepath = os.path.join(work_directory, capture_filename(s3_key))
+    shard_paths = []
+
+    try:
+        with span("s3_download"):
+            download_capture(S3, S3_BUCKET, s3_key, pcap_filepath) # Decompressed on the way
+
+        # ======== Cut the capture into shards ========
+
+        shards = shard_count(os.path.getsize(pcap_filepath))
+
+        with span("sharding"), open(pcap_filepath, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            index = index_capture(data)
+
+            if shards > 1 and len(set(index.linktype.tolist())) == 1:
+                shard_of = shard_records(data, index, shards)
+
+                for shard in range(shards):
+                    shard_path = os.path.join(work_directory, f"{shard}.pcap")
+                    write_pcap(shard_path, data, index, np.flatnonzero(shard_of == shard))
+                    shard_paths.append(shard_path)
+    except (CaptureFormatError, ValueError) as e:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        result.message = f"Could not read your capture: {e}"
+        return result.model_dump_json()
+
+    assignment = get_assignment(REDIS, assignment_id)
+
+    if not shard_paths:
+        # Mixed link types can't be written to one pcap per shard, hand the whole capture to a single job
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+        stage = Stage.new_cicflowmeter_stage()
+        enqueue_job(REDIS, PCAP_QUEUE, stage, assignment, run_cicflowmeter, s3_key, assignment_id)
+
+        result.next_job_id = stage.id
+        result.success = True
+        result.message = "Your capture will be processed in one piece."
+        return result.model_dump_json()
+
+    # ======== Upload shards and fan out one extraction job per shard ========
+
+    prefix = f"{assignment_id}/{uuid.uuid4()}"
+    flow_keys = []
+    shard_job_ids = []
+
+    for shard, shard_path in enumerate(shard_paths):
+        shard_key = f"shards/{prefix}/{shard}.pcap"
+        flow_key = f"flows/{prefix}/{shard}.{FLOW_FORMAT}"
+        with span("s3_upload"):
+            S3.upload_file(shard_path, S3_BUCKET, shard_key)
+
+        stage = Stage.new_shard_stage(shard, len(shard_paths))
+        assignment = enqueue_job(
+            REDIS,
+            PCAP_QUEUE,
+            stage,
+            assignment,
+            run_cicflowmeter_shard,
+            shard_key,
+            flow_key,
+            ttl=None # Shards wait for each other on busy workers, don't let queued ones expire
+        )
+
+        flow_keys.append(flow_key)
+        shard_job_ids.append(stage.id)
+
+    shutil.rmtree(work_directory, ignore_errors=True)
+
+    # ======== Reduce step runs once every shard is done, failed or not ========
+
+    stage = Stage.new_merge_stage()
+    assignment = enqueue_job(
+        REDIS,
+        PCAP_QUEUE,
+        stage,
+        assignment,
+        merge_shard_flows,
+        flow_keys,
+        assignment_id,
+        depends_on=Dependency(jobs=shard_job_ids, allow_failure=True),
+        ttl=None
+    )
+
+    result.next_job_id = stage.id
+    result.success = True
+    result.message = f"Split your capture into {len(shard_paths)} shards for parallel processing."
+
+    return result.model_dump_json()
+
+@timed_stage
+def run_cicflowmeter_shard(shard_key: str, flow_key: str) -> JobResult:
+    HEALTH = healthcheck()
+
+    if HEALTH.all_good():
+        S3 = get_s3_client()
+    else:
+        return HealthCheckResult.new(HEALTH).model_dump_json()
+
+    result = JobResult.new()
+
+    # A shard without flows isn't a failure, it says so for the merge to skip it. An unsuccessful result would end
+    # the assignment for its followers while the other shards are still running
+    extracted = extract_to_s3(S3, shard_key, flow_key)
+    job = get_current_job()
+    if job is not None:
+        job.meta["flows"] = extracted
+        job.save_meta()
+
+    result.success = True
+    result.message = "Extracted the flows of this shard." if extracted else "CICFlowMeter produced no flows for this shard."
+
+    S3.delete_object(Bucket=S3_BUCKET, Key=shard_key)
+
+    return result.model_dump_json()
+
+@timed_stage
+def merge_shard_flows(flow_keys: list[str], assignment_id: str) -> JobResult:
+    HEALTH = healthcheck()
+
+    if HEALTH.all_good():
+        S3 = get_s3_client()
+
+        REDIS = get_redis_client()
+        ML_QUEUE = get_ml_queue(REDIS, current_lane())
+    else:
+        return HealthCheckResult.new(HEALTH).model_dump_json()
+
+    result = JobResult.new()
+
+    # ======== Every shard must have produced its flows, or reported that it had none ========
+
+    job = get_current_job()
+    shard_jobs = job.fetch_dependencies() if job else []
+    shard_results = fetch_job_results(REDIS, shard_jobs)
+
+    failed, empty = 0, set() # Flow keys of the shards that reported no flows
+    for shard_job in shard_jobs:
+        shard_result = shard_results.get(shard_job.id)
+        if not shard_job.is_finished or shard_result is None or not JobResult.model_validate_json(shard_result).success:
+            failed += 1
+        elif shard_job.meta.get("flows") is False:
+            empty.add(shard_job.args[1])
+
+    if failed:
+        result.message = f"{failed} of {len(flow_keys)} shards could not be processed."
+        return result.model_dump_json()
+
+    # ======== Concatenate shard flows ========
+
+    work_directory = tempfile.mkdtemp()
+    format = flow_extension(flow_keys[0])
+    merged_filepath = os.path.join(work_directory, f"merged.{format}")
+
+    shard_filepaths = []
+    for shard, flow_key in enumerate(flow_keys):
+        if flow_key in empty:
+            continue
+
+        shard_filepath = os.path.join(work_directory, f"{shard}.{format}")
+        try:
+            with span("s3_download"):
+                S3.download_file(S3_BUCKET, flow_key, shard_filepath)
+        except ClientError as e:
+            shutil.rmtree(work_directory, ignore_errors=True)
+            result.message = f"The flows of shard {shard + 1} of {len(flow_keys)} are missing: {e}"
+            return result.model_dump_json()
+        shard_filepaths.append(shard_filepath)
+
+    if not shard_filepaths:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        result.message = "CICFlowMeter produced no flows for your capture."
+        return result.model_dump_json()
+
+    if format == "npz":
+        with span("merge"):
+            merge_flows(shard_filepaths, merged_filepath)
+    else:
+        # Keep only the first header
+        with span("merge"), open(merged_filepath, "wb") as merged:
+            for shard_filepath in shard_filepaths:
+                with open(shard_filepath, "rb") as f:
+                    header = f.readline()
+                    if merged.tell() == 0:
+                        merged.write(header)
+                    shutil.copyfileobj(f, merged)
+
+    flow_key = f"flows/{uuid.uuid4()}.{format}"
+    with span("s3_upload"):
+        S3.upload_file(merged_filepath, S3_BUCKET, flow_key)
+
+    shutil.rmtree(work_directory, ignore_errors=True)
+
+    # ======== Finally, enqueue ML job with the merged flows ========
+
+    result.next_job_id = enqueue_ml_stage(REDIS, ML_QUEUE, flow_key, assignment_id)
+
+    result.success = True
+    result.message = f"Merged the flows of {len(flow_keys)} shards for machine learning analysis."
+
+    return result.model_dump_json()
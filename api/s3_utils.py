@@ -1,5 +1,9 @@
 import os
+import math
+import threading
+from datetime import datetime, timedelta, timezone
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # ================================================
@@ -11,18 +15,96 @@ AWS_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY", "password")
 AWS_DEFAULT_REGION = os.environ.get("AWS_DEFAULT_REGION", "us-east-1")
 S3_BUCKET = os.environ.get("S3_BUCKET", "network-threat-detector")
 S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "http://minio:9000")
+S3_MAX_CONNECTIONS = int(os.environ.get("S3_MAX_CONNECTIONS", 32)) # Per process
+S3_EXPIRATION_DAYS = int(os.environ.get("S3_EXPIRATION_DAYS", 7)) # Uploads, flows and shards are deleted after this long
+
+S3_PUBLIC_ENDPOINT_URL = os.environ.get("S3_PUBLIC_ENDPOINT_URL") or None # Where browsers reach S3 for direct uploads, unset disables them
+UPLOAD_PART_SIZE = int(os.environ.get("UPLOAD_PART_SIZE_MB", 16)) * 1024 * 1024 # Larger direct uploads go multipart
+UPLOAD_URL_TTL = int(os.environ.get("UPLOAD_URL_TTL", 3600)) # Seconds presigned upload URLs stay valid
 
 # ================================================
 
+_s3_clients: dict[int, boto3.client] = {} # Process ID -> that process' shared client
+
+# One session for every client, so the service models it loads are reused, by forked jobs too.
+# Creating clients off a shared session isn't thread safe, hence the lock
+_s3_session = boto3.session.Session()
+_s3_session_lock = threading.Lock()
+
+def _reset_s3_session_lock():
+    global _s3_session_lock
+    _s3_session_lock = threading.Lock() # Another thread may have held it when we forked
+
+os.register_at_fork(after_in_child=_reset_s3_session_lock)
+
 def get_s3_client() -> boto3.client:
-    return boto3.client(
-        "s3",
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_DEFAULT_REGION
-    )
+    # One client per process, boto3 clients are thread safe and keep their own connection pool.
+    # Keyed by PID so a forked job never reuses its parent's sockets
+    pid = os.getpid()
+    client = _s3_clients.get(pid)
+    if client is None:
+        client = _s3_clients.setdefault(pid, new_s3_client(Config(max_pool_connections=S3_MAX_CONNECTIONS)))
+    
+    return client
+
+def new_s3_client(config: Config | None = None, endpoint_url: str = S3_ENDPOINT_URL) -> boto3.client:
+    with _s3_session_lock:
+        return _s3_session.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            aws_access_key_id=AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+            region_name=AWS_DEFAULT_REGION,
+            config=config
+        )
+    
+_presign_clients: dict[int, boto3.client] = {}
+
+def get_presign_client() -> boto3.client:
+    # Signs URLs for the public endpoint, the host is part of the signature. Never sends requests itself
+    pid = os.getpid()
+    client = _presign_clients.get(pid)
+    if client is None:
+        config = Config(signature_version="s3v4", s3={"addressing_style": "path"})
+        client = _presign_clients.setdefault(pid, new_s3_client(config, endpoint_url=S3_PUBLIC_ENDPOINT_URL))
     
+    return client
+
+def upload_part_size(size: int) -> int:
+    # S3 allows at most 10,000 parts per upload
+    return max(UPLOAD_PART_SIZE, math.ceil(size / 10_000))
+
+def presign_upload(s3_client: boto3.client, bucket_name: str, key: str, size: int) -> tuple[str | None, int, list[str]]:
+    # Returns (multipart upload ID or None, part size, URLs). Small files get a single PUT URL
+    presign = get_presign_client()
+    part_size = upload_part_size(size)
+    
+    if size <= part_size:
+        url = presign.generate_presigned_url("put_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=UPLOAD_URL_TTL)
+        return None, part_size, [url]
+    
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=key)["UploadId"]
+    urls = [
+        presign.generate_presigned_url(
+            "upload_part",
+            Params={"Bucket": bucket_name, "Key": key, "UploadId": upload_id, "PartNumber": part},
+            ExpiresIn=UPLOAD_URL_TTL
+        )
+        for part in range(1, math.ceil(size / part_size) + 1)
+    ]
+    
+    return upload_id, part_size, urls
+
+def reusable_object(s3_client: boto3.client, bucket_name: str, key: str) -> bool:
+    # Whether the object exists and has at least a day left before the deletion policy removes it
+    try:
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+    except ClientError:
+        return False
+    
+    age = datetime.now(timezone.utc) - head["LastModified"]
+    return age < timedelta(days=S3_EXPIRATION_DAYS - 1)
+
 def create_s3_bucket(s3_client: boto3.client, bucket_name: str):
     existing_buckets = s3_client.list_buckets()
     if not any(bucket['Name'] == bucket_name for bucket in existing_buckets.get('Buckets', [])):
@@ -39,11 +121,13 @@ def apply_s3_deletion_policy(s3_client: boto3.client, bucket_name: str, prefix:
             raise
 
     # Define the new lifecycle rule
+    # One rule per prefix, they used to share an ID and replace each other
     new_rule = {
-        "ID": "DeleteOldUploads",
+        "ID": f"DeleteOld-{prefix.strip('/')}",
         "Filter": {"Prefix": prefix},
         "Status": "Enabled",
-        "Expiration": {"Days": 7},
+        "Expiration": {"Days": S3_EXPIRATION_DAYS},
+        "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1}, # Direct uploads that were never completed
     }
 
     # Deduplicate by ID or Filter if necessary
@@ -0,0 +1,302 @@
+# Runs a pool of RQ workers in one container and sizes it to the work waiting for them.
+#
+#     python3 supervisor.py pcap    flow extraction workers (run_cicflowmeter.py), sharing one resident CICFlowMeter daemon
+#     python3 supervisor.py ml      ML workers (run_ml.py), forked after the model is loaded so they share its memory
+#
+# Every few seconds the pool grows to cover the queued jobs of its lanes and shrinks again once workers sit idle,
+# between POOL_MIN_WORKERS and a maximum that the container's CPU and memory can actually carry:
+#     memory  each worker is budgeted POOL_WORKER_MEMORY_MB, plus a resident JVM (its -Xmx and some overhead) for CICFlowMeter
+#     CPU     busy workers are measured, one that already keeps several cores busy (threaded ML) leaves room for few others
+#
+# Workers are only ever stopped with RQ's warm shutdown, which lets a job in progress finish first.
+# On SIGTERM/SIGINT the supervisor does the same for the whole pool and waits for them, so give the container
+# a stop_grace_period longer than your longest job.
+
+from redis_utils import *
+from utils import *
+
+from rq import Worker
+import os, re, sys, math, time, uuid, signal, socket, multiprocessing
+
+# ================================================
+#                 Pool Settings
+# ================================================
+
+POOL_MIN_WORKERS = int(os.environ.get("POOL_MIN_WORKERS", 1))
+POOL_MAX_WORKERS = int(os.environ.get("POOL_MAX_WORKERS", os.cpu_count() or 1)) # Before the CPU and memory limits below
+POOL_JOBS_PER_WORKER = int(os.environ.get("POOL_JOBS_PER_WORKER", 2)) # Queued jobs one more worker is started for
+POOL_SCALE_INTERVAL = float(os.environ.get("POOL_SCALE_INTERVAL", 5)) # Seconds between sizing decisions
+POOL_SCALE_DOWN_AFTER = float(os.environ.get("POOL_SCALE_DOWN_AFTER", 60)) # Seconds a worker must be surplus before it stops
+POOL_CPU_TARGET = float(os.environ.get("POOL_CPU_TARGET", 0.9)) # Share of the container's cores the pool may keep busy
+POOL_MEMORY_MB = float(os.environ.get("POOL_MEMORY_MB", 0)) # Memory the pool may use, 0 reads the container's limit
+POOL_WORKER_MEMORY_MB = float(os.environ.get("POOL_WORKER_MEMORY_MB", 512)) # Budget of one worker and its job
+
+# ================================================
+
+JVM_OVERHEAD = 1.25 # Metaspace, thread stacks and native buffers on top of the heap
+
+# ======== What the container has ========
+
+def _read(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def available_cores() -> float:
+    # cgroup v2 CPU quota when the container has one, all cores otherwise
+    quota = (_read("/sys/fs/cgroup/cpu.max") or "max").split()
+    if quota[0] != "max":
+        return int(quota[0]) / int(quota[1])
+
+    return float(os.cpu_count() or 1)
+
+def available_memory_mb() -> float:
+    if POOL_MEMORY_MB > 0:
+        return POOL_MEMORY_MB
+
+    limit = _read("/sys/fs/cgroup/memory.max")
+    if limit is not None and limit != "max":
+        return int(limit) / 1024 / 1024
+
+    meminfo = _read("/proc/meminfo") or ""
+    total = re.search(r"MemTotal:\s+(\d+) kB", meminfo)
+    return int(total.group(1)) / 1024 if total else math.inf
+
+def cpu_seconds() -> float | None:
+    # CPU time the container used so far, forked jobs and JVMs included
+    usage = re.search(r"usage_usec (\d+)", _read("/sys/fs/cgroup/cpu.stat") or "")
+    if usage:
+        return int(usage.group(1)) / 1_000_000
+
+    stat = (_read("/proc/stat") or "").splitlines()
+    if not stat or not stat[0].startswith("cpu "):
+        return None
+
+    user, nice, system, idle, iowait, irq, softirq, steal = (int(value) for value in stat[0].split()[1:9])
+    return (user + nice + system + irq + softirq + steal) / os.sysconf("SC_CLK_TCK") # Whole host, outside of a cgroup
+
+def jvm_memory_mb(jvm_options: list[str]) -> float:
+    # -Xmx of the resident CICFlowMeter JVMs, with the JVM's default of a quarter of the memory when unset
+    for option in reversed(jvm_options):
+        size = re.fullmatch(r"-Xmx(\d+)([kKmMgG]?)", option)
+        if size:
+            factor = {"": 1 / 1024 / 1024, "k": 1 / 1024, "m": 1, "g": 1024}[size.group(2).lower()]
+            return int(size.group(1)) * factor * JVM_OVERHEAD
+
+    return available_memory_mb() / 4 * JVM_OVERHEAD
+
+# ======== Kinds of pools ========
+
+def uses_jvm(kind: str) -> bool:
+    from flow_extractor import FLOW_EXTRACTOR
+
+    return kind == "pcap" and FLOW_EXTRACTOR != "native"
+
+def memory_per_worker_mb(kind: str) -> float:
+    if uses_jvm(kind):
+        from extractor_daemon import EXTRACTOR_JVM_OPTS
+
+        return POOL_WORKER_MEMORY_MB + jvm_memory_mb(EXTRACTOR_JVM_OPTS) # Every worker gets a JVM of its own
+
+    return POOL_WORKER_MEMORY_MB
+
+def pool_queues(redis_client: redis.Redis, kind: str) -> list[Queue]:
+    return get_pcap_queues(redis_client, WORKER_LANES) if kind == "pcap" else get_ml_queues(redis_client, WORKER_LANES)
+
+def prepare(kind: str, size: int):
+    # Done once in the supervisor, the workers fork from it
+    if kind == "pcap":
+        from run_cicflowmeter import preload_fused_model
+
+        preload_fused_model()
+
+    if uses_jvm(kind):
+        from extractor_daemon import start_extractor_daemon
+
+        return start_extractor_daemon(concurrency=size) # One JVM for every worker the pool can grow to
+
+    if kind == "ml":
+        import gc
+        from run_ml import ML_WORKER_MODE, load_model_bundle
+
+        if ML_WORKER_MODE in ("preload", "simple"):
+            load_model_bundle()
+            gc.freeze() # Keep the collector from touching (and un-sharing) the model's pages in the workers
+
+    return None
+
+def run_worker(kind: str, name: str):
+    # Body of every worker process. Out of the supervisor's process group, so a Ctrl-C in the terminal reaches
+    # the supervisor alone: a second signal from it would turn RQ's warm shutdown into a cold one
+    os.setpgrp()
+
+    REDIS = get_redis_client()
+    start_health_monitor() # Its own, the supervisor's monitor thread doesn't survive the fork
+
+    if kind == "pcap":
+        from run_cicflowmeter import pcap_worker
+        worker = pcap_worker(REDIS, name)
+    else:
+        from run_ml import ml_worker
+        worker = ml_worker(REDIS, name)
+
+    worker.work(burst=False)
+
+# ======== Pool ========
+
+class WorkerPool:
+
+    def __init__(self, kind: str, min_size: int, max_size: int):
+        self.kind = kind
+        self.min_size = min_size
+        self.max_size = max_size
+        self.workers: dict[str, multiprocessing.Process] = {} # Worker name -> its process
+        self.stopping: set[str] = set() # Told to finish their job and exit
+        self.surplus_since: float | None = None
+        self.cpu_per_worker: float | None = None # Cores one busy worker keeps busy, moving average
+        self._context = multiprocessing.get_context("fork")
+        self._cpu = (time.monotonic(), cpu_seconds())
+
+    def start_worker(self):
+        name = f"{socket.gethostname()}.{self.kind}.{uuid.uuid4().hex[:8]}"
+        process = self._context.Process(target=run_worker, args=(self.kind, name), name=name)
+        process.start()
+        self.workers[name] = process
+
+    def stop_worker(self, name: str):
+        self.stopping.add(name)
+        os.kill(self.workers[name].pid, signal.SIGTERM) # RQ's warm shutdown, the current job finishes first
+
+    def reap(self):
+        for name, process in list(self.workers.items()):
+            if not process.is_alive():
+                process.join()
+                del self.workers[name]
+                if name not in self.stopping:
+                    print(f"[supervisor] Worker {name} exited unexpectedly with code {process.exitcode}")
+                self.stopping.discard(name)
+
+    def states(self, redis_client: redis.Redis) -> dict[str, str]:
+        # RQ's own view of every running worker: "busy", "idle", or "started" until it registered
+        names = [name for name in self.workers if name not in self.stopping]
+        with redis_client.pipeline(transaction=False) as pipeline:
+            for name in names:
+                pipeline.hget(Worker.redis_worker_namespace_prefix + name, "state")
+            states = pipeline.execute()
+
+        return {name: state.decode() if state is not None else "started" for name, state in zip(names, states)}
+
+    def measure_cpu(self, busy: int):
+        now, used = time.monotonic(), cpu_seconds()
+        (then, used_before), self._cpu = self._cpu, (now, used)
+        if busy == 0 or used is None or used_before is None or now <= then:
+            return
+
+        cores = (used - used_before) / (now - then) / busy
+        self.cpu_per_worker = cores if self.cpu_per_worker is None else 0.7 * self.cpu_per_worker + 0.3 * cores
+
+    def cpu_limit(self) -> int:
+        # Workers the cores can carry at the CPU one busy worker was seen using
+        if self.cpu_per_worker is None or self.cpu_per_worker < 0.05:
+            return self.max_size # Nothing measured yet, or the workers wait on I/O
+
+        return max(1, math.floor(available_cores() * POOL_CPU_TARGET / self.cpu_per_worker))
+
+    def desired_size(self, queued: int, busy: int) -> int:
+        wanted = busy + math.ceil(queued / POOL_JOBS_PER_WORKER)
+        return max(self.min_size, min(wanted, self.max_size, max(busy, self.cpu_limit())))
+
+    def scale(self, redis_client: redis.Redis, queues: list[Queue]):
+        self.reap()
+
+        with redis_client.pipeline(transaction=False) as pipeline:
+            for queue in queues:
+                pipeline.llen(queue.key)
+            queued = sum(pipeline.execute())
+
+        states = self.states(redis_client)
+        busy = sum(state == "busy" for state in states.values())
+        self.measure_cpu(busy)
+
+        running = len(states)
+        desired = self.desired_size(queued, busy)
+
+        if desired > running:
+            self.surplus_since = None
+            for _ in range(desired - running):
+                self.start_worker()
+            print(f"[supervisor] {queued} jobs queued, {busy} of {running} workers busy: grew to {desired}")
+
+        elif desired < running:
+            # Only after the surplus lasted a while, and one idle worker at a time
+            self.surplus_since = self.surplus_since or time.monotonic()
+            idle = [name for name, state in states.items() if state == "idle"]
+            if idle and time.monotonic() - self.surplus_since >= POOL_SCALE_DOWN_AFTER:
+                self.stop_worker(idle[0])
+                self.surplus_since = time.monotonic()
+                print(f"[supervisor] {queued} jobs queued, {busy} of {running} workers busy: shrinking to {running - 1}")
+
+        else:
+            self.surplus_since = None
+
+    def shutdown(self):
+        for name, process in self.workers.items():
+            if name not in self.stopping and process.is_alive():
+                self.stop_worker(name)
+
+        for process in self.workers.values():
+            process.join()
+
+def main(kind: str):
+    REDIS = get_redis_client()
+
+    try:
+        REDIS.ping()
+    except redis.exceptions.ConnectionError:
+        print("Could not connect to the Redis server!")
+        exit(1)
+
+    start_health_monitor()
+
+    memory_limit = math.floor(available_memory_mb() / memory_per_worker_mb(kind))
+    max_size = max(1, min(POOL_MAX_WORKERS, memory_limit))
+    min_size = min(POOL_MIN_WORKERS, max_size)
+    if max_size < POOL_MAX_WORKERS:
+        print(f"[supervisor] Memory fits {max_size} of the {POOL_MAX_WORKERS} {kind} workers asked for")
+
+    daemon = prepare(kind, max_size)
+    pool = WorkerPool(kind, min_size, max_size)
+    queues = pool_queues(REDIS, kind)
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"[supervisor] {kind} pool of {min_size} to {max_size} workers on {', '.join(queue.name for queue in queues)}")
+
+    while not stopping:
+        try:
+            pool.scale(REDIS, queues)
+        except redis.exceptions.RedisError as e:
+            print(f"[supervisor] Could not size the pool: {e}")
+        time.sleep(POOL_SCALE_INTERVAL)
+
+    print(f"[supervisor] Waiting for {len(pool.workers)} workers to finish their jobs...")
+    pool.shutdown()
+
+    if daemon is not None:
+        daemon.terminate()
+        daemon.wait()
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("pcap", "ml"):
+        print("Usage: python3 supervisor.py pcap|ml")
+        exit(2)
+
+    main(sys.argv[1])
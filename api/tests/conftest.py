@@ -0,0 +1,5 @@
+# The API modules import each other by their plain names, the way the containers run them from this directory
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+# Jobs a batching worker takes for its batch must never be lost: they wait in its batch list until they start,
+# and go back to their queues when the worker stops or dies. Runs RQ against fakeredis, so it also guards the
+# RQ internals the lane workers build on (rq is pinned in requirements.txt)
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from redis_utils import FAST_LANE_WEIGHT, WeightedLaneWorker, get_ml_queues
+from run_ml import SimpleBatchingWorker, requeue_abandoned_batches
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+def enqueue(redis_client, fast: int, bulk: int) -> tuple[list[str], list[str]]:
+    fast_queue, bulk_queue = get_ml_queues(redis_client)
+    return ([fast_queue.enqueue(len, "flows").id for _ in range(fast)],
+            [bulk_queue.enqueue(len, "flows").id for _ in range(bulk)])
+
+def batching_worker(redis_client, batch_size: int) -> SimpleBatchingWorker:
+    worker = SimpleBatchingWorker(get_ml_queues(redis_client), connection=redis_client, batch_size=batch_size, batch_wait=0)
+    worker.register_birth()
+    return worker
+
+def queued(redis_client) -> tuple[list[str], list[str]]:
+    return tuple(queue.get_job_ids() for queue in get_ml_queues(redis_client))
+
+def test_bulk_lane_goes_first_after_fast_lane_weight_jobs(redis_client):
+    fast_queue, bulk_queue = get_ml_queues(redis_client)
+    worker = WeightedLaneWorker([bulk_queue, fast_queue], connection=redis_client)
+    assert [queue.name for queue in worker._ordered_queues] == [fast_queue.name, bulk_queue.name]
+
+    for _ in range(FAST_LANE_WEIGHT):
+        worker.reorder_queues(fast_queue)
+    assert [queue.name for queue in worker._ordered_queues] == [bulk_queue.name, fast_queue.name]
+
+    worker.reorder_queues(bulk_queue)
+    assert [queue.name for queue in worker._ordered_queues] == [fast_queue.name, bulk_queue.name]
+
+def test_batch_waits_in_the_worker_list(redis_client):
+    fast, bulk = enqueue(redis_client, fast=2, bulk=2)
+    worker = batching_worker(redis_client, batch_size=4)
+
+    job, _ = worker.dequeue_job_and_maintain_ttl(None)
+    assert job.id == fast[0]
+    assert queued(redis_client) == ([], [])
+    assert [job_id.decode() for job_id in redis_client.lrange(worker.batch_key, 0, -1)] == [fast[1]] + bulk
+
+    # A job leaves the list once it's in the StartedJobRegistry
+    job, _ = worker.dequeue_job_and_maintain_ttl(None)
+    worker.prepare_execution(job)
+    assert job.id in job.started_job_registry.get_job_ids()
+    assert [job_id.decode() for job_id in redis_client.lrange(worker.batch_key, 0, -1)] == bulk
+
+def test_stopped_worker_puts_its_batch_back(redis_client):
+    fast, bulk = enqueue(redis_client, fast=1, bulk=3)
+    worker = batching_worker(redis_client, batch_size=3)
+    worker.dequeue_job_and_maintain_ttl(None)
+
+    worker.requeue_pending()
+    assert queued(redis_client) == ([], bulk)
+    assert not redis_client.exists(worker.batch_key)
+
+def test_dead_worker_batch_is_requeued(redis_client):
+    fast, bulk = enqueue(redis_client, fast=3, bulk=1)
+    worker = batching_worker(redis_client, batch_size=4)
+    worker.dequeue_job_and_maintain_ttl(None)
+
+    # Still alive, its batch stays with it
+    assert requeue_abandoned_batches(redis_client) == 0
+
+    redis_client.delete(worker.key) # Killed, its key expired without heartbeats
+    assert requeue_abandoned_batches(redis_client) == 3
+    assert queued(redis_client) == (fast[1:], bulk)
+    assert not redis_client.exists(worker.batch_key)
@@ -0,0 +1,106 @@
+# The native extractor against a small hand-built capture, flow boundaries and feature values worked out
+# from CICFlowMeter-V3's rules. Checks against CICFlowMeter itself need the JVM, see flow_extractor.py --compare
+
+import struct
+
+import numpy as np
+import pytest
+
+from flow_extractor import FIN, SYN, ACK, PSH, assemble_flows, compute_features, read_packets
+
+CLIENT, SERVER, RESOLVER, LOOKUP, PROBE, TARGET = "10.0.0.1", "10.0.0.2", "10.0.0.3", "10.0.0.4", "10.0.0.5", "10.0.0.6"
+SECOND = 1_000_000 # Microseconds
+
+def ip(address: str) -> bytes:
+    return bytes(int(part) for part in address.split("."))
+
+def tcp(src: str, sport: int, dst: str, dport: int, flags: int, payload: int = 0, window: int = 1024) -> bytes:
+    segment = struct.pack("!HHIIBBHHH", sport, dport, 0, 0, 5 << 4, flags, window, 0, 0) + bytes(payload)
+    return ipv4(src, dst, 6, segment)
+
+def udp(src: str, sport: int, dst: str, dport: int, payload: int = 0) -> bytes:
+    return ipv4(src, dst, 17, struct.pack("!HHHH", sport, dport, 8 + payload, 0) + bytes(payload))
+
+def ipv4(src: str, dst: str, proto: int, segment: bytes) -> bytes:
+    header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(segment), 0, 0, 64, proto, 0, ip(src), ip(dst))
+    return b"\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x01\x08\x00" + header + segment # Ethernet
+
+def write_capture(path, packets: list[tuple[int, bytes]]):
+    # Classic pcap, microsecond timestamps, Ethernet link type
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for ts, frame in sorted(packets, key=lambda packet: packet[0]):
+            f.write(struct.pack("<IIII", ts // SECOND, ts % SECOND, len(frame), len(frame)) + frame)
+
+@pytest.fixture(scope="module")
+def flows(tmp_path_factory):
+    start = 1_700_000_000 * SECOND
+    packets = [
+        # A whole TCP connection, closed by the client's FIN. The server's FIN after it opens a flow of its own
+        (start, tcp(CLIENT, 40000, SERVER, 80, SYN, window=8192)),
+        (start + 1_000, tcp(SERVER, 80, CLIENT, 40000, SYN | ACK, window=4096)),
+        (start + 2_000, tcp(CLIENT, 40000, SERVER, 80, ACK | PSH, payload=100)),
+        (start + 5_000, tcp(SERVER, 80, CLIENT, 40000, ACK | PSH, payload=300)),
+        (start + 6_000, tcp(CLIENT, 40000, SERVER, 80, FIN | ACK)),
+        (start + 7_000, tcp(SERVER, 80, CLIENT, 40000, FIN | ACK)),
+        # Lookups over 130 seconds, the flow timeout (120 seconds) splits them in two flows of the same direction
+        (start, udp(RESOLVER, 5353, LOOKUP, 53, payload=40)),
+        (start + SECOND, udp(LOOKUP, 53, RESOLVER, 5353, payload=80)),
+        (start + 130 * SECOND, udp(RESOLVER, 5353, LOOKUP, 53, payload=40)),
+        (start + 131 * SECOND, udp(LOOKUP, 53, RESOLVER, 5353, payload=80)),
+        # A lone packet that times out is discarded, like CICFlowMeter does
+        (start, udp(PROBE, 6000, TARGET, 161, payload=10)),
+        (start + 200 * SECOND, udp(PROBE, 6000, TARGET, 161, payload=10)),
+        (start + 201 * SECOND, udp(TARGET, 161, PROBE, 6000, payload=20)),
+    ]
+
+    path = tmp_path_factory.mktemp("capture") / "sample.pcap"
+    write_capture(path, packets)
+    # CICFlowMeter's defaults, whatever the environment sets
+    return compute_features(assemble_flows(read_packets(str(path)), flow_timeout=120 * SECOND), activity_timeout=5 * SECOND)
+
+def flow(flows, dst_port: int, nth: int = 0):
+    return flows[flows["Dst Port"] == dst_port].sort_values("Timestamp").iloc[nth]
+
+def test_flow_count(flows):
+    # TCP: closed by FIN and the server's FIN alone, UDP lookups: split by the timeout, probe: its lone packet dropped
+    assert len(flows) == 5
+    assert sorted(flows["Dst Port"].tolist()) == [53, 53, 80, 161, 40000]
+
+def test_fin_closes_the_flow(flows):
+    connection = flow(flows, 80)
+    assert connection["Protocol"] == 6
+    assert (connection["Tot Fwd Pkts"], connection["Tot Bwd Pkts"]) == (3, 2)
+    assert (connection["TotLen Fwd Pkts"], connection["TotLen Bwd Pkts"]) == (100, 300)
+    assert connection["Flow Duration"] == 6_000
+    assert connection["FIN Flag Cnt"] == 1
+    assert connection["SYN Flag Cnt"] == 2
+    assert connection["PSH Flag Cnt"] == 2
+    assert (connection["Init Fwd Win Byts"], connection["Init Bwd Win Byts"]) == (8192, 4096)
+    assert connection["Flow IAT Mean"] == pytest.approx(1_500)
+    assert connection["Flow IAT Max"] == 3_000
+    assert connection["Fwd Header Len"] == 3 * 20
+    assert connection["Fwd Act Data Pkts"] == 1
+    assert connection["Pkt Len Mean"] == pytest.approx(80)
+    assert connection["Flow Pkts/s"] == pytest.approx(5 / 0.006)
+
+    # The packet after the FIN starts a flow in its own direction
+    closing = flow(flows, 40000)
+    assert (closing["Tot Fwd Pkts"], closing["Tot Bwd Pkts"]) == (1, 0)
+    assert closing["Flow Duration"] == 0
+
+def test_timeout_splits_the_flow(flows):
+    for nth in (0, 1):
+        lookups = flow(flows, 53, nth)
+        assert lookups["Protocol"] == 17
+        assert (lookups["Tot Fwd Pkts"], lookups["Tot Bwd Pkts"]) == (1, 1) # The second flow keeps the first's direction
+        assert (lookups["TotLen Fwd Pkts"], lookups["TotLen Bwd Pkts"]) == (40, 80)
+        assert lookups["Flow Duration"] == SECOND
+        assert lookups["Down/Up Ratio"] == 1
+        assert lookups["Init Fwd Win Byts"] == -1
+
+def test_lone_timed_out_packet_is_dropped(flows):
+    probe = flow(flows, 161)
+    assert (probe["Tot Fwd Pkts"], probe["Tot Bwd Pkts"]) == (1, 1)
+    assert probe["Flow Duration"] == SECOND
+    assert np.isclose(probe["Flow Byts/s"], 30)
@@ -0,0 +1,53 @@
+# Cached predictions must be exactly what the model says for the same rows, duplicated or not
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+from run_ml import PredictionCache
+
+FEATURES = [f"f{i}" for i in range(6)]
+
+@pytest.fixture(scope="module")
+def model():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(size=(500, len(FEATURES))), columns=FEATURES)
+    y = np.where(X["f0"] + X["f1"] > 0, "Malicious", "Benign")
+    return RandomForestClassifier(n_estimators=10, random_state=0).fit(X, y)
+
+def flows(rows: int, distinct: int, seed: int) -> pd.DataFrame:
+    # Rows drawn from a few distinct flows, the way DNS lookups and health checks repeat
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(distinct, len(FEATURES)))
+    return pd.DataFrame(values[rng.integers(0, distinct, rows)], columns=FEATURES)
+
+def test_duplicated_rows_match_the_model(model):
+    X = flows(2_000, 50, seed=1)
+    cache = PredictionCache(model)
+
+    np.testing.assert_array_equal(cache.predict(X), model.predict(X))
+    assert cache.scored == 50
+
+def test_rows_from_earlier_chunks_match_the_model(model):
+    cache = PredictionCache(model)
+    first, second = flows(1_000, 40, seed=2), flows(1_000, 40, seed=2).sample(frac=1, random_state=3)
+
+    cache.predict(first)
+    cache.reset_stats()
+    np.testing.assert_array_equal(cache.predict(second), model.predict(second))
+    assert cache.scored == 0 # Every row of the second chunk came from the cache
+
+def test_evicted_rows_match_the_model(model):
+    cache = PredictionCache(model, size=10)
+    for seed in range(4, 8):
+        X = flows(300, 30, seed=seed)
+        np.testing.assert_array_equal(cache.predict(X), model.predict(X))
+    assert len(cache.labels) == 10
+
+@pytest.mark.filterwarnings("ignore:X does not have valid feature names")
+def test_arrays_match_the_model(model):
+    X = flows(500, 20, seed=8)
+    cache = PredictionCache(model)
+
+    np.testing.assert_array_equal(cache.predict(X.to_numpy()), model.predict(X))
@@ -0,0 +1,66 @@
+# The pre-filter must not change the flows the extractor produces, only how many packets it has to read.
+# A capture with ICMP and ARP next to TCP/UDP, extracted with the pre-filter on and off for either engine
+
+import mmap
+import shutil
+import struct
+
+import pandas as pd
+import pytest
+
+import prefilter
+from flow_extractor import ACK, FIN, PSH, SYN, assemble_flows, compute_features, index_capture, parse_packets
+from test_flow_extractor import CLIENT, LOOKUP, RESOLVER, SECOND, SERVER, ipv4, tcp, udp, write_capture
+
+def icmp(src: str, dst: str, kind: int, sequence: int) -> bytes:
+    return ipv4(src, dst, 1, struct.pack("!BBHHH", kind, 0, 0, 1, sequence) + bytes(32))
+
+def arp() -> bytes:
+    return b"\xff" * 6 + b"\x00\x00\x00\x00\x00\x01\x08\x06" + bytes(28)
+
+@pytest.fixture
+def capture(tmp_path):
+    start = 1_700_000_000 * SECOND
+    packets = [
+        (start, tcp(CLIENT, 40000, SERVER, 80, SYN)),
+        (start + 1_000, tcp(SERVER, 80, CLIENT, 40000, SYN | ACK)),
+        (start + 2_000, tcp(CLIENT, 40000, SERVER, 80, ACK | PSH, payload=100)),
+        (start + 3_000, tcp(CLIENT, 40000, SERVER, 80, FIN | ACK)),
+        (start, udp(RESOLVER, 5353, LOOKUP, 53, payload=40)),
+        (start + 500, udp(LOOKUP, 53, RESOLVER, 5353, payload=80)),
+        (start + 100, icmp(CLIENT, SERVER, 8, 1)),
+        (start + 200, icmp(SERVER, CLIENT, 0, 1)),
+        (start + 300, arp()),
+    ]
+
+    path = tmp_path / "sample.pcap"
+    write_capture(path, packets)
+    return path
+
+def flows(path, other_ip: bool) -> pd.DataFrame:
+    # other_ip reads the packets CICFlowMeter makes flows of, not only the native extractor's TCP/UDP
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        packets = parse_packets(data, index_capture(data), other_ip)
+
+    features = compute_features(assemble_flows(packets, flow_timeout=120 * SECOND), activity_timeout=5 * SECOND)
+    return features.sort_values(["Timestamp", "Dst Port"]).reset_index(drop=True)
+
+def filtered_copy(path, engine: str, monkeypatch):
+    monkeypatch.setattr(prefilter, "FLOW_EXTRACTOR", engine)
+    filtered = path.with_name(f"{engine}.pcap")
+    shutil.copy(path, filtered)
+    return filtered, prefilter.prefilter_capture(str(filtered), rules=None, snaplen=0)
+
+def test_native_capture_drops_other_protocols(capture, monkeypatch):
+    filtered, reduction = filtered_copy(capture, "native", monkeypatch)
+    assert (reduction.packets, reduction.unflowable, reduction.kept) == (9, 3, 6)
+
+    pd.testing.assert_frame_equal(flows(filtered, other_ip=False), flows(capture, other_ip=False))
+
+def test_cicflowmeter_capture_keeps_other_protocols(capture, monkeypatch):
+    filtered, reduction = filtered_copy(capture, "cicflowmeter", monkeypatch)
+    assert (reduction.packets, reduction.unflowable, reduction.kept) == (9, 1, 8) # Only the ARP frame
+
+    before, after = flows(capture, other_ip=True), flows(filtered, other_ip=True)
+    pd.testing.assert_frame_equal(after, before)
+    assert sorted(after["Protocol"].tolist()) == [1, 6, 17]
@@ -2,40 +2,135 @@ from redis_utils import *
 from s3_utils import *
 from api_types import *
 
-import boto3
+import os
+import time
+import threading
+
+# ================================================
+#                Health Settings
+# ================================================
+
+HEALTH_TTL = float(os.environ.get("HEALTH_TTL", 10)) # Seconds a health check result is reused
+HEALTH_TIMEOUT = float(os.environ.get("HEALTH_TIMEOUT", 1)) # Seconds before Redis or S3 counts as unreachable
+
+# ================================================
 
 # Healthcheck Functions
 
-def healthcheck() -> Health:
-    health = Health(redis=Service.new(), s3=Service.new())
+class HealthMonitor:
+    # Keeps a recent Health around so jobs and API requests don't have to probe Redis and S3 themselves.
+    # start() refreshes it in the background, get() only probes inline once the cached result is stale.
 
-    # Check Redis connectivity
-    r = redis.Redis(host=REDIS_HOSTNAME, port=REDIS_PORT, password=REDIS_PASSWORD, socket_connect_timeout=1, socket_timeout=1)
-    try:
-        r.ping() # Simple call to check connectivity
-    except redis.exceptions.ConnectionError as e:
-        health.redis.working = False
-        health.redis.message = str(e)
-    r.close()
-    
-    # Check S3 connectivity
-    s3 = boto3.client(
-        "s3",
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=AWS_DEFAULT_REGION
-    )
+    def __init__(self, health: Health | None = None, checked_at: float = 0.0, ttl: float = HEALTH_TTL):
+        self.health = health
+        self.checked_at = checked_at
+        self.ttl = ttl
+        self._redis: redis.Redis | None = None
+        self._s3 = None
+        self._thread: threading.Thread | None = None
+
+    def get(self) -> Health:
+        if self.health is None or time.monotonic() - self.checked_at > self.ttl:
+            return self.refresh()
+        
+        return self.health
+
+    def refresh(self) -> Health:
+        health = Health(redis=Service.new(), s3=Service.new())
+        self._check_redis(health.redis)
+        self._check_s3(health.s3)
+        
+        self.health, self.checked_at = health, time.monotonic()
+        return health
+
+    def start(self) -> "HealthMonitor":
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        
+        return self
+
+    def _run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.ttl / 2) # Well before the cached result goes stale
+
+    def _check_redis(self, service: Service):
+        # Separate client with short timeouts, the shared one must not give up on slow commands
+        if self._redis is None:
+            self._redis = redis.Redis(host=REDIS_HOSTNAME, port=REDIS_PORT, password=REDIS_PASSWORD, 
+                                      socket_connect_timeout=HEALTH_TIMEOUT, socket_timeout=HEALTH_TIMEOUT)
+        
+        try:
+            self._redis.ping() # Simple call to check connectivity
+        except redis.exceptions.RedisError as e:
+            service.working = False
+            service.message = str(e)
+
+    def _check_s3(self, service: Service):
+        if self._s3 is None:
+            self._s3 = new_s3_client(Config(connect_timeout=HEALTH_TIMEOUT, read_timeout=HEALTH_TIMEOUT, retries={"max_attempts": 1}))
+        
+        try:
+            self._s3.head_bucket(Bucket=S3_BUCKET) # Checks connectivity and the bucket in one call
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchBucket"):
+                self._create_bucket(service) # Ensure the bucket exists
+            else:
+                service.working = False
+                service.message = str(e)
+        except Exception as e:
+            service.working = False
+            service.message = str(e)
+
+    def _create_bucket(self, service: Service):
+        try:
+            self._s3.create_bucket(Bucket=S3_BUCKET)
+        except self._s3.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        except Exception as e:
+            service.working = False
+            service.message = str(e)
+
+_health_monitors: dict[int, HealthMonitor] = {} # Process ID -> that process' monitor
+
+def get_health_monitor() -> HealthMonitor:
+    # One monitor per process. A forked job starts from its parent's last result, so as long as the
+    # parent's monitor keeps that fresh, the job never probes anything itself
+    pid = os.getpid()
+    monitor = _health_monitors.get(pid)
+    if monitor is None:
+        parent = next(reversed(_health_monitors.values()), None)
+        inherited = HealthMonitor(parent.health, parent.checked_at) if parent is not None else HealthMonitor()
+        monitor = _health_monitors.setdefault(pid, inherited)
     
+    return monitor
+
+def start_health_monitor() -> HealthMonitor:
+    # Long-running processes (API, workers) call this once at startup
+    return get_health_monitor().start()
+
+def healthcheck() -> Health:
+    return get_health_monitor().get()
+
+# Process Functions
+
+def resident_memory_mb() -> float:
+    # Current resident set size of this process, falls back to the peak where /proc isn't available
+    return _process_memory_mb("VmRSS:")
+
+def peak_memory_mb() -> float:
+    # Highest resident set size this process has reached
+    return _process_memory_mb("VmHWM:")
+
+def _process_memory_mb(field: str) -> float:
     try:
-        s3.list_buckets() # Simple call to check connectivity
-        s3.create_bucket(Bucket=S3_BUCKET) # Ensure the bucket exists
-    except s3.exceptions.BucketAlreadyOwnedByYou:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 1024
+    except OSError:
         pass
-    except Exception as e:
-        health.s3.working = False
-        health.s3.message = str(e)
-        
-    s3.close()
-
-    return health
\ No newline at end of file
+    
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
\ No newline at end of file
@@ -0,0 +1,129 @@
+# Verdicts of captures we have already analyzed, so the same pcap uploaded again skips the whole pipeline.
+#
+#     verdicts:model                the model version the ML workers loaded last, looked up by the API
+#     verdict:<model>:<sha256>      MLJobResult JSON of a capture, expires VERDICT_TTL after it was last used
+#     verdicts:<model>:recent       capture hashes by last use, trimmed to VERDICT_CACHE_SIZE (least recently used go first)
+#     assignment:<id>:capture       hash of the capture an assignment analyzes, so run_ml knows what to record
+#     verdicts:stats                hit and miss counters
+#
+# Keys carry the model version, so loading a new model bundle makes every older verdict unreachable
+# and they age out on their own.
+
+from api_types import *
+
+from pathlib import Path
+from typing import BinaryIO
+import redis
+import hashlib
+import time
+import os
+
+# ================================================
+#              Verdict Cache Settings
+# ================================================
+
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", 10_000)) # Verdicts kept per model, 0 disables the cache
+VERDICT_TTL = int(os.environ.get("VERDICT_TTL", 7 * 24 * 60 * 60)) # Seconds an unused verdict is kept
+
+# ================================================
+
+MODEL_VERSION_KEY = "verdicts:model"
+STATS_KEY = "verdicts:stats"
+
+def capture_digest(stream: BinaryIO, chunk_size: int = 1024 * 1024, copy_to: BinaryIO | None = None) -> tuple[str, int]:
+    # SHA-256 and size of a capture, read in chunks from where the stream is, which is left at the end.
+    # With copy_to, the capture is also written there on the way, for streams that can only be read once
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := stream.read(chunk_size):
+        digest.update(chunk)
+        size += len(chunk)
+        if copy_to is not None:
+            copy_to.write(chunk)
+
+    return digest.hexdigest(), size
+
+def model_version(paths: list[Path]) -> str:
+    # Identifies a model bundle by the name, size and modification time of its files, without reading them
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = path.stat()
+        digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+    return digest.hexdigest()[:16]
+
+def publish_model_version(redis_client: redis.Redis, version: str):
+    # Called by ML workers once they loaded their model, from then on the API looks up verdicts of this version
+    redis_client.set(MODEL_VERSION_KEY, version)
+
+def verdict_key(version: str, sha256: str) -> str:
+    return f"verdict:{version}:{sha256}"
+
+def recent_verdicts_key(version: str) -> str:
+    return f"verdicts:{version}:recent"
+
+def capture_key(assignment_id: str) -> str:
+    return f"assignment:{assignment_id}:capture"
+
+def remember_capture(redis_client: redis.Redis, assignment_id: str, sha256: str):
+    if VERDICT_CACHE_SIZE > 0:
+        redis_client.set(capture_key(assignment_id), sha256, ex=604800) # Same lifetime as the assignment record
+
+def lookup_verdict(redis_client: redis.Redis, sha256: str) -> MLJobResult | None:
+    # The verdict the current model gave this capture before, if any. Counts the hit or miss
+    return lookup_verdicts(redis_client, [sha256])[0]
+
+def lookup_verdicts(redis_client: redis.Redis, hashes: list[str]) -> list[MLJobResult | None]:
+    # lookup_verdict for many captures in one round-trip after the model version
+    if VERDICT_CACHE_SIZE <= 0 or not hashes:
+        return [None] * len(hashes)
+
+    version = redis_client.get(MODEL_VERSION_KEY)
+    found = [None] * len(hashes)
+    if version is not None:
+        version = version.decode()
+
+        with redis_client.pipeline() as pipeline:
+            for sha256 in hashes:
+                key = verdict_key(version, sha256)
+                pipeline.get(key)
+                pipeline.expire(key, VERDICT_TTL)
+                pipeline.zadd(recent_verdicts_key(version), {sha256: time.time()}, xx=True) # Most recently used now
+            found = pipeline.execute()[::3]
+
+    hits = sum(data is not None for data in found)
+    with redis_client.pipeline() as pipeline:
+        if hits:
+            pipeline.hincrby(STATS_KEY, "hits", hits)
+        if hits < len(hashes):
+            pipeline.hincrby(STATS_KEY, "misses", len(hashes) - hits)
+        pipeline.execute()
+
+    return [MLJobResult.model_validate_json(data) if data is not None else None for data in found]
+
+def record_verdict(redis_client: redis.Redis, assignment_id: str, version: str, result: str):
+    # Keep a successful ML result for the capture of this assignment, evicting the least recently used past the limit
+    if VERDICT_CACHE_SIZE <= 0:
+        return
+
+    sha256 = redis_client.get(capture_key(assignment_id))
+    if sha256 is None:
+        return # Not hashed when it was uploaded, or from before the cache existed
+
+    sha256 = sha256.decode()
+    recent = recent_verdicts_key(version)
+
+    with redis_client.pipeline() as pipeline:
+        pipeline.set(verdict_key(version, sha256), result, ex=VERDICT_TTL)
+        pipeline.zadd(recent, {sha256: time.time()})
+        pipeline.expire(recent, VERDICT_TTL)
+        pipeline.zcard(recent)
+        size = pipeline.execute()[-1]
+
+    if size > VERDICT_CACHE_SIZE:
+        evicted = redis_client.zpopmin(recent, size - VERDICT_CACHE_SIZE)
+        redis_client.delete(*[verdict_key(version, member.decode()) for member, _ in evicted])
+
+def verdict_stats(redis_client: redis.Redis) -> dict[str, int]:
+    stats = redis_client.hgetall(STATS_KEY)
+    return {name: int(stats.get(name.encode(), 0)) for name in ("hits", "misses")}
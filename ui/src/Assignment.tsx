@@ -1,10 +1,10 @@
 // 
 
 import { useParams } from '@solidjs/router';
-import { createMemo, createResource, createSignal, onCleanup, onMount, Show, type Accessor, type JSX, type ResourceActions } from 'solid-js'
+import { createEffect, createMemo, createResource, createSignal, onCleanup, onMount, Show, type Accessor, type JSX, type ResourceActions } from 'solid-js'
 import { compare, getAssignment, validateUUID } from './utils';
 import { Feedback, ProgressTracker } from './elements';
-import type { JobResult, MLJobResult } from './types';
+import type { Assignment as AssignmentType, AssignmentEvent, JobResult, MLJobResult } from './types';
 
 export default function Assignment(): JSX.Element {
     const [finalResult, setFinalResult] = createSignal<JobResult | undefined>(undefined);
@@ -17,8 +17,9 @@ export default function Assignment(): JSX.Element {
 
         results.push(result);
 
-        if (results.length >= 2)
-            setFinalResult(results[results.length - 1]);
+        // Large captures fan out into more stages, so wait for the prediction (or the first failure)
+        if (!result.success || (result as MLJobResult).prediction != undefined)
+            setFinalResult(result);
     };
 
     // ===========================
@@ -37,8 +38,20 @@ export default function Assignment(): JSX.Element {
         return undefined as any;
     });
 
+    // Progress is pushed by the event server, polling only takes over when it can't be reached
+    const [statuses, setStatuses] = createSignal<Record<string, string>>({});
+    const live = valid ? subscribe(assignment_id, onCleanup, options, (job_id, status) => setStatuses({ ...statuses(), [job_id]: status })) : () => false;
+
+    // Events that arrived before the assignment itself finished loading may have added stages
+    createEffect(() => {
+        if (assignment() != undefined && live.missedStages) {
+            live.missedStages = false;
+            options.refetch();
+        }
+    });
+
     // If we have a valid assignment ID, set up the refresh countdown
-    const refreshCountdown = valid ? refresh(onMount, onCleanup, options, finished) : undefined;
+    const refreshCountdown = valid ? refresh(onMount, onCleanup, options, () => finished() || live()) : undefined;
 
     return (
         // Main container
@@ -67,10 +80,17 @@ export default function Assignment(): JSX.Element {
                         <>
                             <ProgressTracker
                                 assignment={assignment}
+                                statuses={statuses}
                                 onFinish={countFinished}
                             />
 
-                            <Show when={!finished()}>
+                            <Show when={!finished() && live()}>
+                                <p class="ml-4 text-sm italic font-semibold">
+                                    Watching your file live, this page updates as soon as anything changes.
+                                </p>
+                            </Show>
+
+                            <Show when={!finished() && !live()}>
                                 <p class="ml-4 text-sm italic font-semibold">
                                     Checking again in {refreshCountdown!()} seconds...
                                     <a class="hover:font-bold hover:underline" onClick={options.refetch}>(Check now)</a>
@@ -103,20 +123,74 @@ export default function Assignment(): JSX.Element {
 }
 
 
+type Subscription = Accessor<boolean> & { missedStages: boolean };
+
+function subscribe(
+    assignment_id: string,
+    onCleanup: (fn: () => void) => void,
+    options: ResourceActions<any, unknown>,
+    onStatus: (job_id: string, status: string) => void
+): Subscription {
+    const [live, setLive] = createSignal(true);
+    const subscription = live as Subscription;
+    subscription.missedStages = false;
+
+    const source = new EventSource(`/api/assignment/${assignment_id}/events`);
+
+    source.onmessage = (message) => {
+        const event = JSON.parse(message.data) as AssignmentEvent;
+
+        // New stages are appended in place, so the stages already on screen keep their state
+        if (event.stage != null) {
+            const stage = event.stage;
+            options.mutate((assignment: AssignmentType | undefined) => {
+                if (assignment == undefined) {
+                    subscription.missedStages = true;
+                    return assignment;
+                }
+
+                if (assignment.stages.some(existing => existing.id === stage.id))
+                    return assignment;
+
+                return { ...assignment, stages: [...assignment.stages, stage] };
+            });
+        }
+
+        if (event.job_id != null)
+            onStatus(event.job_id, event.status);
+    };
+
+    // The server is done with this assignment, don't let the browser reconnect
+    source.addEventListener("end", () => source.close());
+
+    source.onerror = () => {
+        // Browsers retry dropped streams on their own, CLOSED means the event server isn't there at all
+        if (source.readyState === EventSource.CLOSED)
+            setLive(false);
+    };
+
+    onCleanup(() => source.close());
+
+    return subscription;
+}
+
 function refresh(
     onMount: (fn: () => void) => void,
     onCleanup: (fn: () => void) => void,
     options: ResourceActions<any, unknown>,
-    finished: Accessor<boolean>
+    paused: Accessor<boolean>
 ): Accessor<number> {
     let refetchCount = 3; // Start with 2^3 = 8 seconds
     const [refreshCountdown, setRefreshCountdown] = createSignal(Math.pow(2, refetchCount)); // In seconds
     const raiseCountdown = (current: number) => setRefreshCountdown(current >= 2048 ? 2048 : current * Math.pow(2, ++refetchCount));
     let refetchTask: number | undefined;
     onMount(async () => {
-        setInterval(() => {
+        refetchTask = setInterval(() => {
+            if (paused())
+                return;
+
             const count = refreshCountdown();
-            if (count <= 1 && !finished()) {
+            if (count <= 1) {
                 options.refetch();
                 raiseCountdown(count);
             } else
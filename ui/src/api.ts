@@ -1,3 +1,5 @@
+import type { UploadCompletion, UploadedPart, UploadRequest, UploadTicket } from './types';
+
 export async function getFromAPI<V>(endpoint: string): Promise<V> {
     const response = await fetch(`/api/${endpoint}`, {
         method: 'GET',
@@ -118,3 +120,132 @@ export async function* uploadFileToAPIWithProgress<V>(
 
   if (error) throw error;
 }
+
+// Files above this go straight to S3 through presigned URLs (POST /uploads) instead of through an API worker
+export const DIRECT_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const DIRECT_UPLOAD_CONCURRENCY = 4;
+
+export class DirectUploadUnavailable extends Error {}
+
+export async function* uploadFileWithProgress<V>(file: File): AsyncGenerator<number | V, void, unknown> {
+  if (file.size > DIRECT_UPLOAD_THRESHOLD) {
+    try {
+      yield* uploadFileDirectWithProgress<V>(file);
+      return;
+    } catch (error) {
+      // The server has no public S3 endpoint configured, send the file through the API after all
+      if (!(error instanceof DirectUploadUnavailable))
+        throw error;
+    }
+  }
+
+  yield* uploadFileToAPIWithProgress<V>("upload", file);
+}
+
+function putWithProgress(url: string, body: Blob, onProgress: (loaded: number) => void): Promise<string> {
+  // Resolves to the part's ETag, which S3 needs to assemble a multipart upload
+  return new Promise((resolve, reject) => {
+    const xhr = new XMLHttpRequest();
+
+    xhr.upload.onprogress = (event) => onProgress(event.loaded);
+    xhr.onload = () => {
+      if (xhr.status >= 200 && xhr.status < 300)
+        resolve(xhr.getResponseHeader("ETag") ?? "");
+      else
+        reject(new Error(`Direct upload failed: ${xhr.status} ${xhr.statusText}`));
+    };
+    xhr.onerror = () => reject(new Error("Network error during upload"));
+
+    xhr.open("PUT", url);
+    xhr.send(body);
+  });
+}
+
+export async function* uploadFileDirectWithProgress<V>(file: File): AsyncGenerator<number | V, void, unknown> {
+  const request: UploadRequest = { filename: file.name, size: file.size };
+  const response = await fetch(`/api/uploads`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(request),
+  });
+
+  if (response.status === 501)
+    throw new DirectUploadUnavailable();
+  if (!response.ok)
+    throw new Error(`API upload request failed: ${response.status} ${response.statusText}`);
+
+  const ticket = await response.json() as UploadTicket;
+
+  // Upload the parts a few at a time, tracking the bytes sent for each one
+  const loaded = ticket.urls.map(() => 0);
+  const parts: UploadedPart[] = [];
+  let next = 0;
+
+  let notify: (() => void) | null = null;
+  let done = false;
+  let error: Error | null = null;
+
+  const wake = () => {
+    if (notify) {
+      const n = notify;
+      notify = null;
+      n();
+    }
+  };
+
+  const uploadParts = async () => {
+    while (next < ticket.urls.length) {
+      const index = next++;
+      const part = file.slice(index * ticket.part_size, (index + 1) * ticket.part_size);
+
+      const etag = await putWithProgress(ticket.urls[index], part, (bytes) => {
+        loaded[index] = bytes;
+        wake();
+      });
+
+      loaded[index] = part.size;
+      parts.push({ part_number: index + 1, etag });
+    }
+  };
+
+  Promise.all(Array.from({ length: Math.min(DIRECT_UPLOAD_CONCURRENCY, ticket.urls.length) }, uploadParts))
+    .catch((e) => { error = e instanceof Error ? e : new Error(String(e)); })
+    .finally(() => {
+      done = true;
+      wake();
+    });
+
+  let last = -1;
+  while (true) {
+    // Hold back 100% until the server has accepted the upload
+    const percent = Math.min(99, Math.floor((loaded.reduce((sum, bytes) => sum + bytes, 0) / file.size) * 100));
+    if (percent !== last) {
+      yield percent;
+      last = percent;
+    }
+
+    if (done) break;
+    await new Promise<void>((res) => (notify = res));
+  }
+
+  if (error) {
+    fetch(`/api/uploads/${ticket.upload_id}`, { method: 'DELETE' }); // Don't leave the parts lying around
+    throw error;
+  }
+
+  const completion: UploadCompletion = { parts: ticket.multipart ? parts : [] };
+  const result = await fetch(`/api/uploads/${ticket.upload_id}/complete`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(completion),
+  });
+
+  // Failed completions still carry an UploadResponse explaining what went wrong
+  const body = await result.json() as V;
+  yield 100;
+  yield body;
+}
@@ -1,7 +1,7 @@
-import { createEffect, createMemo, createResource, createSignal, For, Show, Suspense, SuspenseList, type JSX, type Resource } from 'solid-js'
+import { createEffect, createMemo, createResource, createSignal, For, Show, Suspense, SuspenseList, type Accessor, type JSX, type Resource } from 'solid-js'
 import type { Assignment, Health, JobResult, MLJobResult, Service, Stage, UploadResponse } from './types';
 import { allGood, Rotate, getAPIHealth, getJob, unixTimestampToDateString } from './utils';
-import { uploadFileToAPIWithProgress } from './api';
+import { uploadFileWithProgress } from './api';
 
 export function Upload(props: {
     class?: string | undefined
@@ -22,7 +22,7 @@ export function Upload(props: {
         setResult(null);
 
         try {
-            for await (const update of uploadFileToAPIWithProgress<UploadResponse>("upload", file)) {
+            for await (const update of uploadFileWithProgress<UploadResponse>(file)) {
                 if (typeof update === "number")
                     setProgress(update);
                 else
@@ -53,7 +53,7 @@ export function Upload(props: {
                         <input
                             type="file"
                             class="hidden"
-                            accept=".pcap"
+                            accept=".pcap,.pcapng,.gz,.zst"
                             onChange={uploadFile}
                         />
                         <div class="flex items-center gap-3 px-6 py-4 rounded-xl bg-gradient-to-r from-sky-600 to-indigo-600 text-white font-medium shadow-lg shadow-sky-900/40 hover:from-sky-500 hover:to-indigo-500 active:scale-[0.98] transition-all">
@@ -74,7 +74,7 @@ export function Upload(props: {
                             <span class="text-lg">Upload Traffic File</span>
                         </div>
                     </label>
-                    <p class="text-xs text-neutral-300 ">Accepted: .pcap</p>
+                    <p class="text-xs text-neutral-300 ">Accepted: .pcap, .pcapng, gzip or zstd compressed (.pcap.gz, .pcap.zst)</p>
                 </div>
             </Show>
             <Show when={state() === 'Uploading'}>
@@ -180,6 +180,8 @@ function StatusButton(props: {
         switch (props.status) {
             case "queued":
                 return { name: "Queued", emoji: "⏳" };
+            case "deferred":
+                return { name: "Waiting", emoji: "⏸️" };
             case "started":
                 return { name: "In Progress", emoji: "🔄" }
             case "failed":
@@ -204,13 +206,18 @@ function StatusButton(props: {
 function Status(props: {
     class?: string | undefined
     stage: Stage
+    status?: string | undefined
     onFinish: (result: JobResult | MLJobResult | undefined) => void
 }): JSX.Element {
     type View = 'Closed' | 'Status' | 'Results';
 
     const [view, setView] = createSignal<View>('Closed');
 
-    const [job] = createResource(() => props.stage.id != null ? getJob(props.stage.id) : undefined);
+    // Fetched once, then again whenever the event stream reports a new status for this job
+    const [job] = createResource(
+        () => props.stage.id != null ? [props.stage.id, props.status] as const : undefined,
+        ([id]) => getJob(id)
+    );
 
     createEffect(() => {
         if (job() != undefined && job()?.status === 'finished')
@@ -293,6 +300,7 @@ function Status(props: {
 export function ProgressTracker(props: {
     class?: string | undefined,
     assignment: Resource<Assignment>,
+    statuses?: Accessor<Record<string, string>>,
     onFinish: (result: JobResult | MLJobResult | undefined) => void
 }): JSX.Element {
     const COLORS = new Rotate(
@@ -327,13 +335,14 @@ export function ProgressTracker(props: {
                                 <Suspense fallback={<p class="text-sm italic text-slate-100">Loading stage...</p>}>
                                     <div class="relative flex-1 -ml-8 z-20">
                                         <div
-                                            class={`flex items-center justify-center min-w-64 h-full px-10 py-8 ${COLORS[index()]} ring-1 ring-neutral-50/60 shadow-lg [clip-path:polygon(0%_0%,90%_0%,100%_50%,90%_100%,0%_100%,10%_50%)]`}>
+                                            class={`flex items-center justify-center min-w-64 h-full px-10 py-8 ${COLORS.get(index())} ring-1 ring-neutral-50/60 shadow-lg [clip-path:polygon(0%_0%,90%_0%,100%_50%,90%_100%,0%_100%,10%_50%)]`}>
                                             <div class="ml-5">
                                                 <p class="text-lg mb-1">{stage.name}</p>
                                                 <p class="text-sm text-slate-100 opacity-95 mb-3">{stage.description}</p>
 
                                                 <Status
                                                     stage={stage}
+                                                    status={stage.id != null ? props.statuses?.()[stage.id] : undefined}
                                                     onFinish={props.onFinish}
                                                 />
                                             </div>
@@ -11,10 +11,21 @@ export interface Assignment {
   id: string;
   stages: Stage[];
 }
+export interface AssignmentEvent {
+  assignment_id: string;
+  job_id: string | null;
+  status: string;
+  stage: Stage | null;
+  result: JobResult | MLJobResult | null;
+  final: boolean;
+}
 export interface Stage {
   id: string | null;
   name: string;
   description: string | null;
+  timings?: {
+    [k: string]: number;
+  } | null;
 }
 export interface Health {
   redis: Service;
@@ -56,3 +67,80 @@ export interface UploadResponse {
   message: string | null;
   assignment_id: string | null;
 }
+export interface UploadRequest {
+  filename: string;
+  size: number;
+}
+export interface UploadTicket {
+  upload_id: string;
+  multipart: boolean;
+  part_size: number;
+  urls: string[];
+}
+export interface UploadedPart {
+  part_number: number;
+  etag: string;
+}
+export interface UploadCompletion {
+  parts?: UploadedPart[];
+}
+export interface PendingUpload {
+  id: string;
+  filename: string;
+  s3_key: string;
+  s3_upload_id: string | null;
+}
+export interface AssignmentStatus {
+  assignment: Assignment;
+  jobs: (JobResponse | null)[];
+}
+export interface AssignmentsResponse {
+  assignments: (AssignmentStatus | null)[];
+}
+export interface BatchMember {
+  filename: string;
+  assignment_id: string | null;
+  message: string | null;
+}
+export interface Batch {
+  id: string;
+  members: BatchMember[];
+}
+export interface BatchResponse {
+  success: boolean;
+  message: string | null;
+  batch: Batch | null;
+}
+export interface BatchMemberStatus {
+  filename: string;
+  assignment_id: string | null;
+  status: string;
+  prediction: Prediction | null;
+  message: string | null;
+}
+export interface BatchStatus {
+  id: string;
+  counts: {
+    [k: string]: number;
+  };
+  predictions: {
+    [k: string]: number;
+  };
+  done: boolean;
+  members: BatchMemberStatus[];
+}
+export interface QueueState {
+  name: string;
+  lane: string;
+  queued: number;
+  workers: number;
+  job_seconds: number | null;
+  estimated_wait: number | null;
+  admitting: boolean;
+}
+export interface QueuesResponse {
+  queues: QueueState[];
+  refusals: {
+    [k: string]: number;
+  };
+}
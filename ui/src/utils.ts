@@ -1,5 +1,5 @@
 import { getFromAPI } from "./api";
-import type { Assignment, Health, JobResponse, JobResult, MLJobResult, Service } from "./types";
+import type { Assignment, AssignmentsResponse, Health, JobResponse, JobResult, MLJobResult, Service } from "./types";
 
 export async function getAPIHealth(): Promise<Health> {
     return getFromAPI<Health>("");
@@ -9,6 +9,10 @@ export async function getAssignment(assignment_id: string): Promise<Assignment>
     return getFromAPI<Assignment>(`assignment/${assignment_id}`);
 }
 
+export async function getAssignments(assignment_ids: string[]): Promise<AssignmentsResponse> {
+    return getFromAPI<AssignmentsResponse>(`assignments?ids=${assignment_ids.join(",")}`);
+}
+
 export async function getJob(job_id: string): Promise<JobResponse> {
     return getFromAPI<JobResponse>(`job/${job_id}`);
 }